@@ -57,6 +57,13 @@ class FlatRenderer:
         egl.eglDestroySurface(self.display, self.egl_surf)
         egl.eglDestroyContext(self.display, self.opengl_context)
 
+    def make_current(self):
+        # EGL contexts are bound to one thread at a time; rebind before rendering from a worker thread
+        egl.eglMakeCurrent(self.display, self.egl_surf, self.egl_surf, self.opengl_context)
+
+    def release_current(self):
+        egl.eglMakeCurrent(self.display, egl.EGL_NO_SURFACE, egl.EGL_NO_SURFACE, egl.EGL_NO_CONTEXT)
+
     def render(self, vertex_positions, vertex_texcoord, face_indices, matrix_model=None, matrix_view=None,
                matrix_proj=None):
 
@@ -49,17 +49,20 @@ class MyROMP(ROMP):
 
 # https://github.com/Arthur151/ROMP/blob/master/simple_romp/README.md
 class SMPL_Regressor:
-    def __init__(self,use_bev=True, fix_body=False):
+    def __init__(self,use_bev=True, fix_body=False, weight_paths=None):
 
-        self.regressor_model = self.create_romp_model() if not use_bev else self.create_bev_model(fix_body)
+        self.regressor_model = self.create_romp_model() if not use_bev else self.create_bev_model(fix_body, weight_paths)
         self.smpl = SMPLModel()
         #self.smpl.beta[0]+=1.2
         self.smpl.beta[1]+=1.2#todo:???
         self.smpl.update()
 
-    def create_bev_model(self,fix_body=False):
+    def create_bev_model(self,fix_body=False, weight_paths=None):
         settings = bev.main.default_settings
         settings.mode = 'video'
+        # settings attribute -> local file, e.g. {'model_path': ...} from util/weight_cache.py
+        for attr, path in (weight_paths or {}).items():
+            setattr(settings, attr, path)
         bev_model = MyBEV(settings,fix_body=fix_body)
         return bev_model
 
@@ -158,9 +161,29 @@ class SMPL_Regressor:
         return verts_tran
 
 
-    def forward(self, img, roi=False,size=1.2,roi_img_size=512):
+    def forward_with_state(self, img, temporal_state, signal_ID=0):
+        # the stream's filters are lent to BEV/ROMP for this frame and taken back afterwards,
+        # so the model keeps no per-stream history; callers serialise calls (one model instance)
+        filters = getattr(self.regressor_model, 'OE_filters', None)
+        if filters is None:
+            return self.regressor_model.forward(img, signal_ID=signal_ID)
+        if temporal_state.pose_filter is not None:
+            filters[signal_ID] = temporal_state.pose_filter
+        else:
+            filters.pop(signal_ID, None)
+        try:
+            return self.regressor_model.forward(img, signal_ID=signal_ID)
+        finally:
+            temporal_state.pose_filter = filters.pop(signal_ID, None)
+
+    def forward(self, img, roi=False,size=1.2,roi_img_size=512, signal_ID=0, temporal_state=None):
         # ['cam', 'global_orient', 'body_pose', 'smpl_betas', 'smpl_thetas', 'center_preds', 'center_confs', 'cam_trans', 'verts', 'joints', 'pj2d_org']
-        outputs = self.regressor_model.forward(img)
+        # temporal_state (VITON.temporal_state.TemporalState) carries the stream's pose filters;
+        # without it the filters stay in the model under signal_ID
+        if temporal_state is not None:
+            outputs = self.forward_with_state(img, temporal_state, signal_ID)
+        else:
+            outputs = self.regressor_model.forward(img, signal_ID=signal_ID)
         #outputs = self.romp_model.smpl_parser.forward(outputs)
         #print(outputs['pj2d_org'].shape)
         #print(outputs['joints'].shape)
@@ -6,6 +6,9 @@ from io import BytesIO
 from OffscreenRenderer.flat_renderer import FlatRenderer
 import glm
 
+# renderers kept for different frame sizes (one EGL context and framebuffer each)
+MAX_RENDER_SIZES = 4
+
 
 class UpperBodySMPL:
     def __init__(self):
@@ -15,6 +18,7 @@ class UpperBodySMPL:
         self.uv = model.visual.uv
         self.texPath = './assets/color_pattern/board_300x300.png'
         self.flat_render = None  # FlatRenderer(texPath=self.texPath)
+        self.flat_renders = dict()  # (height, width) -> FlatRenderer
         self.base_render = None  # BaseRenderer()
         self.uv_render = None
         self.model = np.array(glm.mat4(1).to_list())
@@ -23,11 +27,20 @@ class UpperBodySMPL:
 
     def render(self, verts,height=512,width=512):
         projection = np.array(glm.perspective(np.pi / 3, width / height, 0.1, 100).to_list())
+        # the render must have the frame's size: the pose's ROI transform is in frame pixels
+        self.flat_render = self.flat_renders.pop((height, width), None)
         if self.flat_render is None:
             self.flat_render = FlatRenderer(texPath=self.texPath,height=height,width=width)
+        self.flat_renders[(height, width)] = self.flat_render
+        while len(self.flat_renders) > MAX_RENDER_SIZES:
+            self.flat_renders.pop(next(iter(self.flat_renders)))
         #print(verts.shape)
         #print(self.uv_map_matrix.shape)
         amputated_verts = self.uv_map_matrix.dot(verts)
-        return self.flat_render.render(amputated_verts, self.uv/16,self.f_uv.reshape(-1),self.model,self.view,projection)
+        self.flat_render.make_current()
+        try:
+            return self.flat_render.render(amputated_verts, self.uv/16,self.f_uv.reshape(-1),self.model,self.view,projection)
+        finally:
+            self.flat_render.release_current()
 
 
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+
+class QualityLevel:
+    """One rung of the degradation ladder; every field makes some stage cheaper"""
+
+    def __init__(self, name, densepose_scale=1.0, pose_every=1, roi_size=512, jpeg_quality=90,
+                 admit_sessions=True):
+        self.name = name
+        # DensePose runs on the frame scaled by this factor
+        self.densepose_scale = densepose_scale
+        # the pose is regressed on every pose_every-th frame and reused in between
+        self.pose_every = pose_every
+        # generator input/output size (the model is fully convolutional; multiple of 16)
+        self.roi_size = roi_size
+        self.jpeg_quality = jpeg_quality
+        self.admit_sessions = admit_sessions
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+DEFAULT_LADDER = [
+    QualityLevel('full'),
+    QualityLevel('jpeg80', jpeg_quality=80),
+    QualityLevel('densepose75', densepose_scale=0.75, jpeg_quality=80),
+    QualityLevel('pose_reuse', densepose_scale=0.75, pose_every=2, jpeg_quality=80),
+    QualityLevel('roi384', densepose_scale=0.75, pose_every=2, roi_size=384, jpeg_quality=70),
+    QualityLevel('minimal', densepose_scale=0.5, pose_every=3, roi_size=256, jpeg_quality=60),
+    QualityLevel('busy', densepose_scale=0.5, pose_every=3, roi_size=256, jpeg_quality=60, admit_sessions=False),
+]
+
+
+class DegradationController:
+    """Steps through a ladder of cheaper quality levels to hold a frame-time SLO.
+
+    record() takes the end-to-end time of every served frame (and optionally its per-stage
+    times). After each window of frames the p95 frame time is compared to the SLO: above it
+    the controller moves one level down the ladder, and after recover_windows consecutive
+    windows below recover_ratio * SLO it moves one level back up. The last level stops
+    admitting new sessions. A level change is followed by one window of settling, and after
+    idle_reset_s without frames the controller returns to full quality.
+    """
+
+    def __init__(self, slo_ms, ladder=None, window=30, recover_ratio=0.7, recover_windows=3, idle_reset_s=5.0):
+        self.slo_ms = slo_ms
+        self.ladder = ladder or DEFAULT_LADDER
+        self.window = window
+        self.recover_ratio = recover_ratio
+        self.recover_windows = recover_windows
+        self.idle_reset_s = idle_reset_s
+        self.last_record = time.time()
+        self.lock = threading.Lock()
+        self.level = 0
+        self.frame_times = deque(maxlen=window)
+        self.stage_times = defaultdict(lambda: deque(maxlen=window))
+        self.frames_in_window = 0
+        self.good_windows = 0
+        self.settling = False
+        self.transitions = deque(maxlen=50)
+        self.rejected_sessions = 0
+        self.last_p95 = 0.0
+
+    @property
+    def quality(self):
+        return self.ladder[self.level]
+
+    def admit(self):
+        """Whether a new session may start; counts the rejection when not"""
+        with self.lock:
+            if self.level > 0 and time.time() - self.last_record > self.idle_reset_s:
+                # nothing is being served, so the overload is over
+                self.change_level(0, 0.0)
+                self.frame_times.clear()
+                self.frames_in_window = 0
+            if self.ladder[self.level].admit_sessions:
+                return True
+            self.rejected_sessions += 1
+            return False
+
+    def record(self, frame_ms, timings=None):
+        with self.lock:
+            self.last_record = time.time()
+            self.frame_times.append(frame_ms)
+            for stage, ms in (timings or {}).items():
+                self.stage_times[stage].append(ms)
+            self.frames_in_window += 1
+            if self.frames_in_window >= self.window:
+                self.evaluate()
+
+    def evaluate(self):
+        # called with self.lock held
+        self.frames_in_window = 0
+        p95 = float(np.percentile(self.frame_times, 95))
+        self.last_p95 = p95
+        if self.settling:
+            # the window straddled a level change
+            self.settling = False
+            return
+        if p95 > self.slo_ms:
+            self.good_windows = 0
+            if self.level < len(self.ladder) - 1:
+                self.change_level(self.level + 1, p95)
+        elif p95 < self.slo_ms * self.recover_ratio:
+            self.good_windows += 1
+            if self.good_windows >= self.recover_windows and self.level > 0:
+                self.good_windows = 0
+                self.change_level(self.level - 1, p95)
+        else:
+            self.good_windows = 0
+
+    def change_level(self, level, p95):
+        # called with self.lock held
+        stages = ' '.join(f"{stage} {np.median(times):.0f}ms" for stage, times in self.stage_times.items())
+        direction = 'Degrading' if level > self.level else 'Restoring'
+        print(f"{'⚠' if level > self.level else '✓'} {direction} to quality level {self.ladder[level].name} "
+              f"(p95 {p95:.0f}ms, SLO {self.slo_ms:.0f}ms | {stages})")
+        self.transitions.append({'time': round(time.time(), 1), 'from': self.ladder[self.level].name,
+                                 'to': self.ladder[level].name, 'p95_ms': round(p95, 1)})
+        self.level = level
+        self.settling = True
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'slo_ms': self.slo_ms,
+                'level': self.level,
+                'quality': self.ladder[self.level].to_dict(),
+                'p95_frame_ms': round(self.last_p95, 1),
+                'stage_p50_ms': {stage: round(float(np.median(times)), 1)
+                                 for stage, times in self.stage_times.items()},
+                'rejected_sessions': self.rejected_sessions,
+                'transitions': list(self.transitions)[-10:],
+            }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"quality {stats['quality']['name']} (level {stats['level']}) | p95 {stats['p95_frame_ms']:.0f}ms "
+                f"SLO {stats['slo_ms']:.0f}ms | rejected {stats['rejected_sessions']}")
@@ -0,0 +1,127 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from OpticalFlow.optical_flow import OpticalFlow
+from OpticalFlow.advect_img import advect_numpy_image
+
+
+class FlowPropagator:
+    """Carries the last generated garment over to the following frames with optical flow.
+
+    The generator runs on keyframes only. In between, the keyframe and the current frame are
+    both cropped to the keyframe's garment ROI at flow_size pixels, RAFT (small) estimates the
+    flow from one to the other, and the keyframe's garment RGBA is advected along it
+    (advect_numpy_image) and composited with the keyframe's ROI transform. A new keyframe is
+    forced when
+      - max_interval frames were propagated since the last one,
+      - the mean flow under the garment exceeds max_motion ROI pixels (the person moved too
+        far for the crop, or the flow is unreliable), or
+      - drift: the keyframe crop advected the same way differs from the current crop by more
+        than max_error grey levels under the garment (occlusion, disocclusion, lighting).
+
+    The settings, the flow model and the counters are shared by all streams; each stream's
+    keyframe lives in its TemporalState.
+    """
+
+    def __init__(self, max_interval=4, max_error=12.0, max_motion=24.0, flow_size=256, optical_flow=None):
+        self.max_interval = max_interval
+        self.max_error = max_error
+        self.max_motion = max_motion
+        # multiple of 8 for RAFT
+        self.flow_size = max(flow_size // 8 * 8, 64)
+        self.optical_flow = optical_flow if optical_flow is not None else OpticalFlow(small=True)
+        self.flow_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.propagated = 0
+        self.keyframes = dict(first=0, interval=0, motion=0, drift=0)
+        self.flow_ms = 0.0
+
+    def crop(self, raw_image, trans2roi, roi_size):
+        trans = np.array(trans2roi, dtype=np.float64) * (self.flow_size / float(roi_size))
+        return cv2.warpAffine(raw_image, trans, (self.flow_size, self.flow_size), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+    def keyframe(self, state, raw_image, layer_key, trans2roi, roi_size, roi_target, roi_alpha, inv_trans2roi):
+        """Remember a frame the generator ran on"""
+        state.flow_keyframe = {
+            'key': layer_key,
+            'trans2roi': trans2roi,
+            'roi_size': roi_size,
+            'crop': self.crop(raw_image, trans2roi, roi_size),
+            'rgba': np.dstack([roi_target, roi_alpha]),
+            'mask': cv2.resize(roi_alpha, (self.flow_size, self.flow_size), interpolation=cv2.INTER_AREA) > 127,
+            'inv_trans2roi': inv_trans2roi,
+        }
+        state.flow_propagated = 0
+
+    def propagate(self, state, raw_image, layer_key):
+        """(roi_target, roi_alpha, inv_trans2roi) for this frame, or None when it must be a keyframe"""
+        keyframe = state.flow_keyframe
+        with self.lock:
+            self.frames += 1
+            if keyframe is None or keyframe['key'] != layer_key:
+                self.keyframes['first'] += 1
+                return None
+            if state.flow_propagated >= self.max_interval:
+                self.keyframes['interval'] += 1
+                return None
+
+        start = time.perf_counter()
+        crop = self.crop(raw_image, keyframe['trans2roi'], keyframe['roi_size'])
+        with self.flow_lock:
+            flow = self.optical_flow(cv2.cvtColor(keyframe['crop'], cv2.COLOR_BGR2RGB),
+                                     cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)).cpu()
+        mask = keyframe['mask']
+        motion = float(np.linalg.norm(flow[0].permute(1, 2, 0).numpy()[mask], axis=1).mean()) if mask.any() else 0.0
+        reason = None
+        if motion > self.max_motion:
+            reason = 'motion'
+        else:
+            advected = advect_numpy_image(keyframe['crop'], flow)
+            error = cv2.absdiff(cv2.cvtColor(advected, cv2.COLOR_BGR2GRAY), cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY))
+            if mask.any() and float(error[mask].mean()) > self.max_error:
+                reason = 'drift'
+        state.flow_motion = motion
+        if reason is not None:
+            with self.lock:
+                self.keyframes[reason] += 1
+                self.flow_ms += (time.perf_counter() - start) * 1000.0
+            return None
+
+        # the flow was estimated on the small crop: bring it to the generator's ROI size
+        roi_size = keyframe['rgba'].shape[0]
+        scale = roi_size / float(self.flow_size)
+        roi_flow = torch.nn.functional.interpolate(flow, size=(roi_size, roi_size), mode='bilinear',
+                                                   align_corners=False) * scale
+        rgba = advect_numpy_image(keyframe['rgba'], roi_flow)
+        state.flow_propagated += 1
+        with self.lock:
+            self.propagated += 1
+            self.flow_ms += (time.perf_counter() - start) * 1000.0
+        return np.ascontiguousarray(rgba[:, :, :3]), np.ascontiguousarray(rgba[:, :, 3]), keyframe['inv_trans2roi']
+
+    def get_stats(self):
+        with self.lock:
+            flowed = self.propagated + self.keyframes['motion'] + self.keyframes['drift']
+            return {
+                'max_interval': self.max_interval,
+                'max_error': self.max_error,
+                'max_motion': self.max_motion,
+                'frames': self.frames,
+                'propagated': self.propagated,
+                'propagated_rate': round(self.propagated / self.frames, 3) if self.frames else 0.0,
+                'keyframes': dict(self.keyframes),
+                'avg_flow_ms': round(self.flow_ms / flowed, 1) if flowed else 0.0,
+            }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        reasons = ' '.join(f"{reason} {count}" for reason, count in stats['keyframes'].items())
+        return (f"propagated {stats['propagated']}/{stats['frames']} frames ({stats['propagated_rate'] * 100:.0f}%), "
+                f"flow {stats['avg_flow_ms']:.1f}ms | keyframes: {reasons}")
+
@@ -0,0 +1,178 @@
+import queue
+import time
+from threading import Thread
+
+
+class FrameTask:
+    def __init__(self, frame_id, raw_image, tag=None):
+        self.frame_id = frame_id
+        self.raw_image = raw_image
+        # opaque caller data returned with the result (e.g. the client's frame id)
+        self.tag = tag
+        # set as soon as a stage decides the frame is finished (e.g. no person found)
+        self.output = None
+        self.vertices = None
+        self.trans2roi = None
+        self.inv_trans2roi = None
+        self.roi_vm = None
+        self.raw_IUV = None
+        self.roi_dpi_img = None
+        self.roi_target = None
+        self.roi_alpha = None
+
+
+class PipelineStage:
+    def __init__(self, name, fn, in_queue, out_queue):
+        self.name = name
+        self.fn = fn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.busy_time = 0.0
+        self.frames = 0
+        self.thread = Thread(target=self.run, args=(), name='pipeline-' + name)
+        self.thread.daemon = True
+
+    def run(self):
+        while True:
+            task = self.in_queue.get()
+            if task is None:
+                self.out_queue.put(None)
+                break
+            start = time.perf_counter()
+            if task.output is None:
+                try:
+                    self.fn(task)
+                except Exception as e:
+                    print(f"Pipeline stage '{self.name}' failed on frame {task.frame_id}: {e}")
+                    task.output = task.raw_image
+            self.busy_time += time.perf_counter() - start
+            self.frames += 1
+            self.out_queue.put(task)
+
+
+class PipelinedFrameProcessor:
+    """Runs the FrameProcessor stages on one worker thread each, connected by bounded queues.
+
+    Every stage has exactly one worker and the queues are FIFO, so frames leave in the order
+    they were submitted and the stateful stages (pose filters, renderer) see them in order too.
+    """
+
+    stage_names = ['pose', 'render', 'densepose', 'sdp', 'generator', 'compose']
+
+    def __init__(self, frame_processor, queue_size=2):
+        self.frame_processor = frame_processor
+        self.queue_size = queue_size
+        self.next_frame_id = 0
+        self.start_time = time.perf_counter()
+        # temporal state of the stream being served; new_stream() replaces it
+        self.state = frame_processor.new_state()
+
+        stage_fns = [self.run_pose, self.run_render, self.run_densepose, self.run_sdp,
+                     self.run_generator, self.run_compose]
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stage_fns) + 1)]
+        self.stages = []
+        for i, (name, fn) in enumerate(zip(self.stage_names, stage_fns)):
+            self.stages.append(PipelineStage(name, fn, self.queues[i], self.queues[i + 1]))
+        self.input_queue = self.queues[0]
+        self.output_queue = self.queues[-1]
+        for stage in self.stages:
+            stage.thread.start()
+
+    def run_pose(self, task):
+        if self.frame_processor.viton_model is None:
+            task.output = task.raw_image
+            return
+        pose = self.frame_processor.regress_pose(task.raw_image, self.state)
+        if pose is None:
+            task.output = task.raw_image
+            return
+        task.vertices, task.trans2roi, task.inv_trans2roi = pose
+
+    def run_render(self, task):
+        # ROI arrays travel with the frame to the generator stage, which returns them to the
+        # pool; frames that finish earlier return them in get()
+        roi_shape = (self.frame_processor.resolution, self.frame_processor.resolution, 3)
+        task.roi_vm = self.frame_processor.buffers.acquire(roi_shape)
+        task.roi_vm = self.frame_processor.render_body(task.raw_image, task.vertices, task.trans2roi,
+                                                       out=task.roi_vm)
+
+    def run_densepose(self, task):
+        task.raw_IUV = self.frame_processor.extract_iuv(task.raw_image)
+        if task.raw_IUV is None:
+            task.output = task.raw_image
+
+    def run_sdp(self, task):
+        roi_shape = (self.frame_processor.resolution, self.frame_processor.resolution, 3)
+        task.roi_dpi_img = self.frame_processor.buffers.acquire(roi_shape)
+        task.roi_dpi_img = self.frame_processor.iuv_to_roi_sdp(task.raw_IUV, task.trans2roi, out=task.roi_dpi_img)
+        task.raw_IUV = None
+
+    def run_generator(self, task):
+        try:
+            generated = self.frame_processor.generate(task.roi_vm, task.roi_dpi_img)
+        finally:
+            self.release_roi(task)
+        if generated is None:
+            task.output = task.raw_image
+            return
+        task.roi_target, task.roi_alpha = generated
+
+    def run_compose(self, task):
+        task.output = self.frame_processor.compose(task.raw_image, task.roi_target, task.roi_alpha,
+                                                   task.inv_trans2roi)
+
+    def release_roi(self, task):
+        self.frame_processor.buffers.release(task.roi_vm)
+        self.frame_processor.buffers.release(task.roi_dpi_img)
+        task.roi_vm = task.roi_dpi_img = None
+
+    def new_stream(self):
+        # called between streams, once the previous stream's frames have left the pipeline
+        self.state = self.frame_processor.new_state()
+
+    def submit(self, frame, tag=None):
+        """Queue a frame; blocks while the first stage is full. Returns the frame id."""
+        frame_id = self.next_frame_id
+        self.next_frame_id += 1
+        self.input_queue.put(FrameTask(frame_id, frame, tag))
+        return frame_id
+
+    def get(self, timeout=None):
+        """Return the next finished (frame_id, frame, tag) in submission order; raises queue.Empty on timeout."""
+        task = self.output_queue.get(timeout=timeout)
+        if task is None:
+            return None
+        # a frame finished before the generator (no DensePose, a failed stage) still holds its ROI buffers
+        self.release_roi(task)
+        return task.frame_id, task.output, task.tag
+
+    def __call__(self, frame):
+        # synchronous convenience wrapper; only useful when nothing else is in flight
+        self.submit(frame)
+        return self.get()[1]
+
+    def get_stats(self):
+        elapsed = max(time.perf_counter() - self.start_time, 1e-6)
+        stats = {}
+        for stage in self.stages:
+            stats[stage.name] = {
+                'occupancy': stage.busy_time / elapsed,
+                'avg_ms': stage.busy_time * 1000.0 / stage.frames if stage.frames else 0.0,
+                'frames': stage.frames,
+            }
+        return stats
+
+    def reset_stats(self):
+        self.start_time = time.perf_counter()
+        for stage in self.stages:
+            stage.busy_time = 0.0
+            stage.frames = 0
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return ' | '.join(f"{name} {s['occupancy'] * 100:.0f}% {s['avg_ms']:.1f}ms" for name, s in stats.items())
+
+    def stop(self):
+        self.input_queue.put(None)
+        for stage in self.stages:
+            stage.thread.join(timeout=5)
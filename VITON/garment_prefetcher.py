@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+import urllib.request
+from collections import Counter
+from threading import Thread
+
+
+def load_plan(source, timeout=5.0):
+    """Read a prefetch plan (see prefetch_planner.py) from a JSON file or an http(s) URL"""
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    with open(source) as f:
+        return json.load(f)
+
+
+class GarmentPrefetcher:
+    """Warms garment generators in the order given by the web tier's prefetch plan.
+
+    warm_ranked() fills host memory with the most popular garments (the best ones go to the
+    GPU while it has room); on_garment_selected() warms the garments shoppers most often try
+    next after the one just selected. refresh() can run before the models exist, so that
+    ranked_ids() orders the startup preload; start() hands over the residency manager.
+    Plan garment ids are product ids ('jin_17'), matched against the server's garment names
+    ('jin_17_vmsdp2ta'). Prefetching never evicts.
+    """
+
+    def __init__(self, garment_name_list, source, refresh_s=300.0, gpu_ahead=1):
+        self.garment_name_list = garment_name_list
+        self.source = source
+        # set by start(), once the models exist
+        self.residency = None
+        self.refresh_s = refresh_s
+        # how many of the predicted next garments are promoted to the GPU, not only host memory
+        self.gpu_ahead = gpu_ahead
+        self.lock = threading.Lock()
+        self.plan = None
+        self.predicted = set()
+        self.counters = Counter()
+        self.stop_event = threading.Event()
+        self.refresh_thread = None
+
+    def index_of(self, plan_garment_id):
+        for i, name in enumerate(self.garment_name_list):
+            if name == plan_garment_id or name.startswith(plan_garment_id + '_'):
+                return i
+        return None
+
+    def indices(self, plan_garment_ids):
+        found = [self.index_of(g) for g in plan_garment_ids]
+        return [i for i in found if i is not None]
+
+    def refresh(self):
+        """Reload the plan; keeps the previous one if the source is unreachable"""
+        try:
+            plan = load_plan(self.source)
+        except Exception as e:
+            print(f"⚠ Could not load prefetch plan from {self.source}: {e}")
+            return False
+        with self.lock:
+            self.plan = plan
+        print(f"✓ Prefetch plan from {plan.get('generated_at')}: {plan.get('ranking', [])[:5]}")
+        return True
+
+    def ranked_ids(self):
+        """Garment ids by popularity, followed by the garments the plan does not know"""
+        with self.lock:
+            ranking = self.indices(self.plan.get('ranking', [])) if self.plan else []
+        rest = [i for i in range(len(self.garment_name_list)) if i not in ranking]
+        return ranking + rest
+
+    def next_ids(self, garment_id):
+        with self.lock:
+            if not self.plan:
+                return []
+            name = self.garment_name_list[garment_id]
+            for plan_id, next_garments in self.plan.get('next', {}).items():
+                if name == plan_id or name.startswith(plan_id + '_'):
+                    return [i for i in self.indices(next_garments) if i != garment_id]
+        return []
+
+    def warm_ranked(self):
+        residency = self.residency
+        warmed = []
+        for n, garment_id in enumerate(self.ranked_ids()):
+            # the most popular garments also go to the GPU while it has room
+            if not residency.prefetch(garment_id, to_gpu=n < self.gpu_ahead):
+                break
+            warmed.append(garment_id)
+        print(f"Prefetched garments {warmed} | {residency.format_stats()}")
+        return warmed
+
+    def on_garment_selected(self, garment_id):
+        """Record whether the selection was predicted and warm its likely successors"""
+        with self.lock:
+            self.counters['selections'] += 1
+            if garment_id in self.predicted:
+                self.counters['predicted_hits'] += 1
+        next_garments = self.next_ids(garment_id) if garment_id >= 0 and self.residency is not None else []
+        with self.lock:
+            self.predicted = set(next_garments)
+        if next_garments:
+            t = Thread(target=self.warm_next, args=(next_garments,))
+            t.daemon = True
+            t.start()
+
+    def warm_next(self, next_garments):
+        residency = self.residency
+        try:
+            for n, garment_id in enumerate(next_garments):
+                start = time.perf_counter()
+                if not residency.prefetch(garment_id, to_gpu=n < self.gpu_ahead):
+                    break
+                with self.lock:
+                    self.counters['prefetches'] += 1
+                print(f"Prefetched likely next garment {garment_id} "
+                      f"({residency.tier_of(garment_id)}, {(time.perf_counter() - start) * 1000.0:.0f}ms)")
+        except Exception as e:
+            print(f"✗ Garment prefetch failed: {e}")
+
+    def run_refresh_loop(self):
+        while not self.stop_event.wait(self.refresh_s):
+            if self.refresh():
+                self.warm_ranked()
+
+    def start(self, residency):
+        """Start warming garments in residency and keep the plan fresh"""
+        self.residency = residency
+        if self.refresh_s > 0:
+            self.refresh_thread = Thread(target=self.run_refresh_loop, name='prefetch-refresh')
+            self.refresh_thread.daemon = True
+            self.refresh_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_stats(self):
+        with self.lock:
+            selections = self.counters['selections']
+            return {
+                'plan_generated_at': self.plan.get('generated_at') if self.plan else None,
+                'selections': selections,
+                'predicted_hits': self.counters['predicted_hits'],
+                'predicted_hit_rate': self.counters['predicted_hits'] / selections if selections else 0.0,
+                'prefetches': self.counters['prefetches'],
+                'predicted_next': sorted(self.predicted),
+            }
@@ -0,0 +1,268 @@
+import threading
+import time
+from collections import Counter
+
+import torch
+
+TIER_GPU = 'gpu'
+TIER_HOST = 'host'
+TIER_DISK = 'disk'
+
+MB = 1024 * 1024
+
+
+def model_nbytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def pin_model(model):
+    # page-locked host memory makes the later host -> GPU copy fast and asynchronous
+    if torch.cuda.is_available():
+        model._apply(lambda t: t if t.is_pinned() else t.pin_memory())
+    return model
+
+
+class GarmentEntry:
+    def __init__(self, garment_id, model, nbytes):
+        self.garment_id = garment_id
+        self.model = model
+        self.nbytes = nbytes
+        self.tier = TIER_HOST
+        self.uses = 0
+        self.last_used = 0
+
+
+class GarmentResidencyManager:
+    """Keeps garment generators in a GPU tier, a pinned host-memory tier or on disk.
+
+    Each garment lives in exactly one tier. get() promotes a garment to the GPU, demoting
+    the least recently (policy='lru') or least frequently (policy='lfu') used garments to
+    host memory when the GPU budget is exceeded, and dropping host garments back to disk
+    when the host budget is exceeded. Garments marked active (in use by a session) or held
+    (being staged or run) are never evicted. Budgets are in bytes; 0 means unlimited.
+
+    pin_memory=False keeps host models in pageable memory: freshly loaded ones as they come
+    from load_fn, e.g. mapped from a shared checkpoint store instead of copied into private
+    page-locked memory, and ones demoted from the GPU as plain CPU copies.
+    """
+
+    def __init__(self, load_fn, gpu_budget_bytes=2048 * MB, host_budget_bytes=8192 * MB, policy='lru',
+                 pin_memory=True):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"unknown residency policy: {policy}")
+        # load_fn(garment_id) -> model on the CPU, read from its checkpoint
+        self.load_fn = load_fn
+        self.gpu_budget = gpu_budget_bytes
+        self.host_budget = host_budget_bytes
+        self.policy = policy
+        self.pin_memory = pin_memory
+        self.entries = dict()
+        self.loading = set()
+        # garments being copied host -> GPU; the copy runs without the lock
+        self.promoting = set()
+        self.active = set()
+        self.held = Counter()
+        self.cond = threading.Condition()
+        self.clock = 0
+        # size of the largest garment seen, used to check whether a prefetch still fits
+        self.typical_nbytes = 0
+
+        self.counters = Counter()
+        self.disk_load_time = 0.0
+        self.promote_time = 0.0
+
+    def tier_bytes(self, tier):
+        # a garment being promoted already counts against the GPU budget
+        return sum(e.nbytes for e in self.entries.values()
+                   if e.tier == tier or (tier == TIER_GPU and e.garment_id in self.promoting))
+
+    def tier_of(self, garment_id):
+        entry = self.entries.get(garment_id)
+        return entry.tier if entry is not None else TIER_DISK
+
+    def set_active(self, garment_ids):
+        """Garments currently worn by a session; they stay resident"""
+        with self.cond:
+            self.active = set(garment_ids)
+
+    def hold(self, garment_id):
+        """Protect a garment from eviction until the matching unhold()"""
+        with self.cond:
+            self.held[garment_id] += 1
+
+    def unhold(self, garment_id):
+        with self.cond:
+            self.held[garment_id] -= 1
+            if self.held[garment_id] <= 0:
+                del self.held[garment_id]
+
+    def fits(self, tier, nbytes):
+        budget = self.gpu_budget if tier == TIER_GPU else self.host_budget
+        return budget <= 0 or self.tier_bytes(tier) + nbytes <= budget
+
+    def pick_victim(self, tier, keep):
+        candidates = [e for e in self.entries.values()
+                      if e.tier == tier and e.garment_id not in self.active and e.garment_id not in self.held
+                      and e.garment_id != keep]
+        if not candidates:
+            return None
+        if self.policy == 'lfu':
+            return min(candidates, key=lambda e: (e.uses, e.last_used))
+        return min(candidates, key=lambda e: e.last_used)
+
+    def make_room(self, tier, nbytes, keep):
+        # called with self.cond held
+        while not self.fits(tier, nbytes):
+            victim = self.pick_victim(tier, keep)
+            if victim is None:
+                print(f"⚠ {tier} garment budget exceeded, all resident garments are in use")
+                return
+            if tier == TIER_GPU:
+                self.demote_to_host(victim)
+            else:
+                self.evict_to_disk(victim)
+
+    def demote_to_host(self, entry):
+        self.make_room(TIER_HOST, entry.nbytes, keep=entry.garment_id)
+        entry.model = entry.model.cpu()
+        if self.pin_memory:
+            entry.model = pin_model(entry.model)
+        entry.tier = TIER_HOST
+        self.counters['gpu_evictions'] += 1
+        torch.cuda.empty_cache()
+
+    def evict_to_disk(self, entry):
+        del self.entries[entry.garment_id]
+        entry.model = None
+        self.counters['host_evictions'] += 1
+
+    def ensure_host(self, garment_id):
+        """Make sure the garment is at least in host memory. Returns True if it was read from disk."""
+        with self.cond:
+            while garment_id in self.loading:
+                self.cond.wait()
+            if garment_id in self.entries:
+                return False
+            self.loading.add(garment_id)
+        try:
+            # reading the checkpoint takes seconds: do it without blocking the other garments
+            start = time.perf_counter()
+            model = self.load_fn(garment_id).cpu()
+            if self.pin_memory:
+                model = pin_model(model)
+            model.eval()
+            load_time = time.perf_counter() - start
+        except Exception:
+            with self.cond:
+                self.loading.discard(garment_id)
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            entry = GarmentEntry(garment_id, model, model_nbytes(model))
+            self.typical_nbytes = max(self.typical_nbytes, entry.nbytes)
+            self.make_room(TIER_HOST, entry.nbytes, keep=garment_id)
+            self.entries[garment_id] = entry
+            self.disk_load_time += load_time
+            self.counters['disk_loads'] += 1
+            self.loading.discard(garment_id)
+            self.cond.notify_all()
+        return True
+
+    def get(self, garment_id):
+        """Return the garment's model on the GPU, loading or promoting it as needed"""
+        while True:
+            from_disk = self.ensure_host(garment_id)
+            with self.cond:
+                while garment_id in self.promoting:
+                    self.cond.wait()
+                entry = self.entries.get(garment_id)
+                if entry is None:
+                    # evicted again between loading and promotion, only under extreme host pressure
+                    continue
+                self.clock += 1
+                entry.last_used = self.clock
+                entry.uses += 1
+                if entry.tier == TIER_GPU:
+                    self.counters['gpu_hits'] += 1
+                    return entry.model
+                self.counters['misses' if from_disk else 'host_hits'] += 1
+                self.promote(entry)
+                return entry.model
+
+    def promote(self, entry):
+        # called with self.cond held; released during the copy so other garments' lookups go on,
+        # like ensure_host does for disk loads. The garment is held so it is not evicted meanwhile.
+        garment_id = entry.garment_id
+        start = time.perf_counter()
+        self.make_room(TIER_GPU, entry.nbytes, keep=garment_id)
+        self.promoting.add(garment_id)
+        self.held[garment_id] += 1
+        self.cond.release()
+        try:
+            model = entry.model.to('cuda', non_blocking=True)
+            model.eval()
+        except Exception:
+            # back to host memory entirely, in case only some tensors were moved
+            entry.model.cpu()
+            raise
+        finally:
+            self.cond.acquire()
+            self.promoting.discard(garment_id)
+            self.held[garment_id] -= 1
+            if self.held[garment_id] <= 0:
+                del self.held[garment_id]
+            self.cond.notify_all()
+        entry.model = model
+        entry.tier = TIER_GPU
+        self.promote_time += time.perf_counter() - start
+        self.counters['promotions'] += 1
+
+    def prefetch(self, garment_id, to_gpu=False):
+        """Warm a garment without evicting anything. Returns False if it does not fit."""
+        with self.cond:
+            if garment_id not in self.entries and garment_id not in self.loading:
+                if self.typical_nbytes and not self.fits(TIER_HOST, self.typical_nbytes):
+                    return False
+        self.ensure_host(garment_id)
+        if to_gpu:
+            with self.cond:
+                entry = self.entries.get(garment_id)
+                if entry is None or garment_id in self.promoting:
+                    return entry is not None
+                if entry.tier != TIER_GPU:
+                    if not self.fits(TIER_GPU, entry.nbytes):
+                        return False
+                    self.promote(entry)
+        return True
+
+    def get_stats(self):
+        with self.cond:
+            requests = self.counters['gpu_hits'] + self.counters['host_hits'] + self.counters['misses']
+            return {
+                'policy': self.policy,
+                'gpu_garments': sorted(e.garment_id for e in self.entries.values() if e.tier == TIER_GPU),
+                'host_garments': sorted(e.garment_id for e in self.entries.values() if e.tier == TIER_HOST),
+                'gpu_mb': self.tier_bytes(TIER_GPU) / MB,
+                'host_mb': self.tier_bytes(TIER_HOST) / MB,
+                'gpu_budget_mb': self.gpu_budget / MB,
+                'host_budget_mb': self.host_budget / MB,
+                'requests': requests,
+                'gpu_hits': self.counters['gpu_hits'],
+                'host_hits': self.counters['host_hits'],
+                'misses': self.counters['misses'],
+                'gpu_hit_rate': self.counters['gpu_hits'] / requests if requests else 0.0,
+                'gpu_evictions': self.counters['gpu_evictions'],
+                'host_evictions': self.counters['host_evictions'],
+                'avg_disk_load_ms': self.disk_load_time * 1000.0 / self.counters['disk_loads']
+                if self.counters['disk_loads'] else 0.0,
+                'avg_promote_ms': self.promote_time * 1000.0 / self.counters['promotions']
+                if self.counters['promotions'] else 0.0,
+            }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"gpu {stats['gpu_garments']} {stats['gpu_mb']:.0f}/{stats['gpu_budget_mb']:.0f}MB | "
+                f"host {stats['host_garments']} {stats['host_mb']:.0f}/{stats['host_budget_mb']:.0f}MB | "
+                f"hits gpu {stats['gpu_hits']} host {stats['host_hits']} miss {stats['misses']} | "
+                f"evictions gpu {stats['gpu_evictions']} host {stats['host_evictions']} | "
+                f"disk {stats['avg_disk_load_ms']:.0f}ms promote {stats['avg_promote_ms']:.1f}ms")
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from threading import Thread
+
+import numpy as np
+import torch
+
+
+class GeneratorRequest:
+    def __init__(self, garment_id, input_tensor):
+        self.garment_id = garment_id
+        self.input_tensor = input_tensor
+        # only requests with the same garment and input size can share a batch
+        self.key = (garment_id, tuple(input_tensor.shape[1:]))
+        self.future = Future()
+        self.enqueue_time = time.perf_counter()
+
+
+class GeneratorBatcher:
+    """Gathers generator inputs from concurrent sessions and runs them as one batch per garment.
+
+    Requests wait at most batch_window_ms after the oldest pending one arrived, or until
+    max_batch_size requests for the same garment are pending. The oldest request's garment
+    is served first so no garment can starve the others.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, batch_window_ms=5.0):
+        # run_batch(garment_id, input_tensor) -> output tensor with the same batch size, or None
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.pending = []
+        self.cond = threading.Condition()
+        self.stopped = False
+
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.queue_wait_time = 0.0
+        self.forward_time = 0.0
+        self.latencies = deque(maxlen=1000)
+
+        self.thread = Thread(target=self.run, args=(), name='generator-batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, garment_id, input_tensor):
+        request = GeneratorRequest(garment_id, input_tensor)
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+        return request.future
+
+    def forward(self, garment_id, input_tensor, timeout=None):
+        """Blocking helper: submit one (1,C,H,W) input and wait for its (1,C',H,W) output."""
+        return self.submit(garment_id, input_tensor).result(timeout=timeout)
+
+    def next_batch(self):
+        with self.cond:
+            while not self.pending and not self.stopped:
+                self.cond.wait()
+            if self.stopped:
+                return None, []
+            deadline = self.pending[0].enqueue_time + self.batch_window
+            while not self.stopped:
+                key = self.pending[0].key
+                n_same = sum(1 for r in self.pending if r.key == key)
+                remaining = deadline - time.perf_counter()
+                if n_same >= self.max_batch_size or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            key = self.pending[0].key
+            garment_id = self.pending[0].garment_id
+            batch = [r for r in self.pending if r.key == key][:self.max_batch_size]
+            batch_ids = set(id(r) for r in batch)
+            self.pending = [r for r in self.pending if id(r) not in batch_ids]
+        return garment_id, batch
+
+    def run(self):
+        while True:
+            garment_id, batch = self.next_batch()
+            if not batch:
+                break
+            start = time.perf_counter()
+            try:
+                output = self.run_batch(garment_id, torch.cat([r.input_tensor for r in batch], 0))
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            self.batch_sizes[len(batch)] += 1
+            self.requests += len(batch)
+            self.forward_time += end - start
+            for i, r in enumerate(batch):
+                self.queue_wait_time += start - r.enqueue_time
+                self.latencies.append(end - r.enqueue_time)
+                r.future.set_result(None if output is None else output[i:i + 1])
+
+    def get_stats(self):
+        n_batches = sum(self.batch_sizes.values())
+        latencies = np.array(self.latencies) * 1000.0 if self.latencies else np.zeros(1)
+        return {
+            'requests': self.requests,
+            'batches': n_batches,
+            'avg_batch_size': self.requests / n_batches if n_batches else 0.0,
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            'avg_queue_wait_ms': self.queue_wait_time * 1000.0 / self.requests if self.requests else 0.0,
+            'avg_forward_ms': self.forward_time * 1000.0 / n_batches if n_batches else 0.0,
+            'p50_latency_ms': float(np.percentile(latencies, 50)),
+            'p95_latency_ms': float(np.percentile(latencies, 95)),
+        }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"batch avg {stats['avg_batch_size']:.2f} {stats['batch_size_histogram']} | "
+                f"wait {stats['avg_queue_wait_ms']:.1f}ms | forward {stats['avg_forward_ms']:.1f}ms | "
+                f"p50 {stats['p50_latency_ms']:.1f}ms p95 {stats['p95_latency_ms']:.1f}ms")
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            for r in self.pending:
+                r.future.cancel()
+            self.pending = []
+            self.cond.notify_all()
+        self.thread.join(timeout=5)
@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+INTERACTIVE = 'interactive'
+STILL = 'still'
+BATCH = 'batch'
+# served in this order whenever the class has a free slot (see starvation_ms)
+PRIORITY_CLASSES = (INTERACTIVE, STILL, BATCH)
+
+
+class Ticket:
+    def __init__(self, session_id, priority_class, cost):
+        self.session_id = session_id
+        self.priority_class = priority_class
+        self.cost = cost
+        self.event = threading.Event()
+        self.enqueue_time = time.perf_counter()
+        self.wait_time = 0.0
+
+
+class ClassQueue:
+    """Deficit round robin over the sessions of one priority class"""
+
+    def __init__(self, limit, quantum):
+        self.limit = limit
+        self.quantum = quantum
+        self.sessions = OrderedDict()  # session id -> deque of tickets, in round-robin order
+        self.deficit = Counter()
+        self.running = 0
+        self.waits = deque(maxlen=1000)
+        self.granted = 0
+
+    def oldest_enqueue_time(self):
+        return min(tickets[0].enqueue_time for tickets in self.sessions.values())
+
+    def queued(self):
+        return sum(len(q) for q in self.sessions.values())
+
+    def push(self, ticket):
+        if ticket.session_id not in self.sessions:
+            self.sessions[ticket.session_id] = deque()
+        self.sessions[ticket.session_id].append(ticket)
+
+    def pop(self):
+        """Next ticket by DRR: a session is served while its deficit covers its head ticket"""
+        while self.sessions:
+            session_id, tickets = next(iter(self.sessions.items()))
+            ticket = tickets[0]
+            if self.deficit[session_id] < ticket.cost:
+                # out of credit: top up and move to the back of the round
+                self.deficit[session_id] += self.quantum
+                self.sessions.move_to_end(session_id)
+                continue
+            self.deficit[session_id] -= ticket.cost
+            tickets.popleft()
+            if not tickets:
+                # idle sessions keep no credit, as in DRR
+                del self.sessions[session_id]
+                del self.deficit[session_id]
+            return ticket
+        return None
+
+    def remove(self, ticket):
+        tickets = self.sessions.get(ticket.session_id)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.sessions[ticket.session_id]
+                self.deficit.pop(ticket.session_id, None)
+
+
+class InferenceScheduler:
+    """Decides which waiting request may run the FrameProcessor next.
+
+    Callers wrap their inference in `with scheduler.slot(session_id, priority_class, cost)`.
+    At most max_inflight requests run at once and at most limits[class] of one class;
+    free slots go to the highest priority class with work, unless a lower class has waited
+    longer than starvation_ms. Within a class sessions share by deficit round robin weighted
+    by cost (e.g. garments in a still-photo request), so a client sending many requests
+    cannot starve the others.
+    """
+
+    def __init__(self, max_inflight=2, limits=None, quantum=1.0, starvation_ms=2000.0):
+        self.max_inflight = max_inflight
+        self.starvation = starvation_ms / 1000.0
+        limits = dict({INTERACTIVE: max_inflight, STILL: 1, BATCH: 1}, **(limits or {}))
+        self.classes = OrderedDict((c, ClassQueue(limits[c], quantum)) for c in PRIORITY_CLASSES)
+        self.lock = threading.Lock()
+        self.running = 0
+
+    def pick_class(self):
+        # called with self.lock held
+        eligible = [q for q in self.classes.values() if q.sessions and q.running < q.limit]
+        if not eligible:
+            return None
+        now = time.perf_counter()
+        for queue in eligible:
+            if now - queue.oldest_enqueue_time() > self.starvation:
+                # aged: a batch job still progresses under constant interactive load
+                return queue
+        return eligible[0]
+
+    def dispatch(self):
+        # called with self.lock held
+        while self.running < self.max_inflight:
+            queue = self.pick_class()
+            if queue is None:
+                break
+            ticket = queue.pop()
+            ticket.wait_time = time.perf_counter() - ticket.enqueue_time
+            queue.waits.append(ticket.wait_time)
+            queue.granted += 1
+            queue.running += 1
+            self.running += 1
+            ticket.event.set()
+
+    def acquire(self, session_id, priority_class=INTERACTIVE, cost=1.0, timeout=None):
+        """Wait for a slot; returns the ticket, or None if the timeout expired first"""
+        if priority_class not in self.classes:
+            raise ValueError(f"unknown priority class: {priority_class}")
+        ticket = Ticket(session_id, priority_class, cost)
+        with self.lock:
+            self.classes[priority_class].push(ticket)
+            self.dispatch()
+        if ticket.event.wait(timeout):
+            return ticket
+        with self.lock:
+            if ticket.event.is_set():
+                # granted just as the wait timed out
+                return ticket
+            self.classes[priority_class].remove(ticket)
+        return None
+
+    def release(self, ticket):
+        with self.lock:
+            self.classes[ticket.priority_class].running -= 1
+            self.running -= 1
+            self.dispatch()
+
+    @contextmanager
+    def slot(self, session_id, priority_class=INTERACTIVE, cost=1.0):
+        ticket = self.acquire(session_id, priority_class, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'max_inflight': self.max_inflight, 'running': self.running}
+            for name, queue in self.classes.items():
+                waits = np.array(queue.waits) * 1000.0 if queue.waits else np.zeros(1)
+                stats[name] = {
+                    'limit': queue.limit,
+                    'running': queue.running,
+                    'queued': queue.queued(),
+                    'sessions': len(queue.sessions),
+                    'granted': queue.granted,
+                    'p50_wait_ms': float(np.percentile(waits, 50)),
+                    'p95_wait_ms': float(np.percentile(waits, 95)),
+                    'max_wait_ms': float(waits.max()),
+                }
+        return stats
+
+    def format_stats(self):
+        stats = self.get_stats()
+        parts = [f"{name} run {stats[name]['running']}/{stats[name]['limit']} q {stats[name]['queued']} "
+                 f"wait p50 {stats[name]['p50_wait_ms']:.1f}ms p95 {stats[name]['p95_wait_ms']:.1f}ms"
+                 for name in PRIORITY_CLASSES]
+        return ' | '.join(parts)
@@ -0,0 +1,112 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """Lets near-static frames of a stream reuse the last generated garment layer.
+
+    Every frame is reduced to a small grey thumbnail of the person ROI (the frame is area
+    downscaled first, then warped with the ROI transform of the last fully processed frame)
+    and compared to the thumbnail of that keyframe by mean absolute difference, in grey
+    levels. A stream turns static after enter_frames consecutive frames below
+    still_threshold and moving again as soon as a frame exceeds move_threshold; the gap
+    between the two thresholds keeps sensor noise from flipping it every frame. While static,
+    pose, DensePose and the generator are skipped and the keyframe's garment layer is
+    composited onto the new frame, with a full refresh after at most max_skip skipped frames.
+
+    The thresholds and counters are shared by all streams; each stream's keyframe and
+    hysteresis live in its TemporalState.
+    """
+
+    def __init__(self, still_threshold=1.5, move_threshold=4.0, enter_frames=3, max_skip=10,
+                 thumb_size=64, downscale=8):
+        self.still_threshold = still_threshold
+        self.move_threshold = max(move_threshold, still_threshold)
+        self.enter_frames = enter_frames
+        self.max_skip = max_skip
+        self.thumb_size = thumb_size
+        self.downscale = downscale
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+        self.refreshes = 0
+        self.became_static = 0
+        self.became_moving = 0
+
+    def thumbnail(self, raw_image, trans2roi, roi_size):
+        small = cv2.resize(raw_image, (max(raw_image.shape[1] // self.downscale, 1),
+                                       max(raw_image.shape[0] // self.downscale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        # frame -> ROI transform expressed on the downscaled frame and the thumbnail
+        trans = np.array(trans2roi, dtype=np.float64) * (self.thumb_size / float(roi_size))
+        trans[:, :2] *= raw_image.shape[1] / float(small.shape[1])
+        thumb = cv2.warpAffine(small, trans, (self.thumb_size, self.thumb_size), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+        return cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+
+    def check(self, state, raw_image, layer_key):
+        """The keyframe's layer if this frame may reuse it, else None"""
+        layer = state.motion_layer
+        if layer is None or layer['key'] != layer_key:
+            return None
+        thumb = self.thumbnail(raw_image, layer['trans2roi'], layer['roi_size'])
+        diff = float(np.mean(cv2.absdiff(thumb, layer['thumb'])))
+        state.motion_diff = diff
+        with self.lock:
+            self.frames += 1
+            if state.motion_static:
+                if diff > self.move_threshold:
+                    state.motion_static = False
+                    state.motion_still_frames = 0
+                    self.became_moving += 1
+                    return None
+                if state.motion_skips >= self.max_skip:
+                    # stays static, but the layer is regenerated against the current frame
+                    self.refreshes += 1
+                    return None
+                state.motion_skips += 1
+                self.skipped += 1
+                return layer
+            if diff < self.still_threshold:
+                state.motion_still_frames += 1
+                if state.motion_still_frames >= self.enter_frames:
+                    state.motion_static = True
+                    self.became_static += 1
+            else:
+                state.motion_still_frames = 0
+            return None
+
+    def keyframe(self, state, raw_image, layer_key, trans2roi, roi_size, roi_target, roi_alpha, inv_trans2roi):
+        """Remember a fully processed frame as the reference for the frames that follow"""
+        state.motion_layer = {
+            'key': layer_key,
+            'trans2roi': trans2roi,
+            'roi_size': roi_size,
+            'thumb': self.thumbnail(raw_image, trans2roi, roi_size),
+            'roi_target': roi_target,
+            'roi_alpha': roi_alpha,
+            'inv_trans2roi': inv_trans2roi,
+        }
+        state.motion_skips = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'still_threshold': self.still_threshold,
+                'move_threshold': self.move_threshold,
+                'enter_frames': self.enter_frames,
+                'max_skip': self.max_skip,
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'skip_rate': round(self.skipped / self.frames, 3) if self.frames else 0.0,
+                'refreshes': self.refreshes,
+                'became_static': self.became_static,
+                'became_moving': self.became_moving,
+            }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"skipped {stats['skipped']}/{stats['frames']} frames ({stats['skip_rate'] * 100:.0f}%) | "
+                f"static {stats['became_static']}x, moving {stats['became_moving']}x, refreshes {stats['refreshes']}")
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from util.cv2_trans_util import get_inverse_trans
+
+# every VERTEX_STRIDE-th SMPL vertex is used for the error statistics
+VERTEX_STRIDE = 50
+
+
+class PosePredictor:
+    """Constant-velocity extrapolation of the regressed pose.
+
+    Every regressed pose updates a per-stream track (in the stream's TemporalState) of the
+    two quantities the overlay is built from: the posed SMPL vertices and the frame -> ROI
+    transform. Their velocities are finite differences over the frame interval, smoothed
+    exponentially with velocity_smoothing (an alpha-beta filter that trusts the measurement,
+    which the One Euro filters already smoothed). predict() moves a pose forward by a
+    horizon, at most max_horizon_ms; after a gap longer than max_gap_ms the velocity is reset.
+
+    Prediction error is measured on the stream's own later frames: a prediction is recorded
+    for one horizon ahead (the latency the web tier reports, else the frame interval) and
+    compared with the pose regressed at that time, next to the error of simply holding the
+    old pose. The statistics are the mean displacement of the ROI corners in frame pixels
+    and of a vertex subset in millimetres.
+    """
+
+    def __init__(self, velocity_smoothing=0.5, max_horizon_ms=250.0, max_gap_ms=500.0, window=300):
+        self.velocity_smoothing = velocity_smoothing
+        self.max_horizon_ms = max_horizon_ms
+        self.max_gap_ms = max_gap_ms
+        self.lock = threading.Lock()
+        self.predicted = 0
+        self.errors = dict(roi_px=deque(maxlen=window), hold_roi_px=deque(maxlen=window),
+                           verts_mm=deque(maxlen=window), hold_verts_mm=deque(maxlen=window))
+        self.horizons = deque(maxlen=window)
+
+    def update(self, state, pose, now=None):
+        """Add a regressed pose (vertices, trans2roi, inv_trans2roi) to the stream's track"""
+        now = time.perf_counter() if now is None else now
+        vertices = pose[0][0].numpy().astype(np.float32)
+        trans2roi = np.asarray(pose[1], dtype=np.float64)
+        track = state.pose_track
+        if track is None or (now - track['time']) * 1000.0 > self.max_gap_ms:
+            track = {'time': now, 'vertices': vertices, 'trans2roi': trans2roi,
+                     'vertex_velocity': np.zeros_like(vertices), 'trans_velocity': np.zeros_like(trans2roi),
+                     'interval': None, 'pending': deque()}
+            state.pose_track = track
+            self.expect(state, now)
+            return
+        self.score(track, now, vertices, pose[2])
+        dt = max(now - track['time'], 1e-3)
+        c = self.velocity_smoothing
+        track['vertex_velocity'] += c * ((vertices - track['vertices']) / dt - track['vertex_velocity'])
+        track['trans_velocity'] += c * ((trans2roi - track['trans2roi']) / dt - track['trans_velocity'])
+        track['interval'] = dt if track['interval'] is None else 0.8 * track['interval'] + 0.2 * dt
+        track['time'], track['vertices'], track['trans2roi'] = now, vertices, trans2roi
+        self.expect(state, now)
+
+    def predict(self, state, horizon_s, now=None):
+        """The last pose moved forward to horizon_s after it was regressed, or None without a track"""
+        track = state.pose_track
+        if track is None:
+            return None
+        now = time.perf_counter() if now is None else now
+        if (now - track['time']) * 1000.0 > self.max_gap_ms:
+            return None
+        vertices, trans2roi = self.extrapolate(track, horizon_s)
+        with self.lock:
+            self.predicted += 1
+        return torch.from_numpy(vertices).unsqueeze(0), trans2roi, get_inverse_trans(trans2roi)
+
+    def extrapolate(self, track, horizon_s):
+        h = min(max(horizon_s, 0.0), self.max_horizon_ms / 1000.0)
+        return (track['vertices'] + track['vertex_velocity'] * h,
+                track['trans2roi'] + track['trans_velocity'] * h)
+
+    def expect(self, state, now):
+        # record where the track says the pose will be one horizon from now, to score it then
+        track = state.pose_track
+        if state.latency_ms:
+            horizon = state.latency_ms / 1000.0
+        elif track['interval'] is not None:
+            horizon = track['interval']
+        else:
+            return
+        horizon = min(horizon, self.max_horizon_ms / 1000.0)
+        vertices, trans2roi = self.extrapolate(track, horizon)
+        track['pending'].append((now + horizon, horizon, vertices[::VERTEX_STRIDE], get_inverse_trans(trans2roi),
+                                 track['vertices'][::VERTEX_STRIDE], get_inverse_trans(track['trans2roi'])))
+        while len(track['pending']) > 32:
+            track['pending'].popleft()
+
+    def score(self, track, now, vertices, inv_trans2roi):
+        # the pending prediction whose target time is closest to this frame
+        pending = track['pending']
+        best = None
+        while pending and pending[0][0] <= now + 0.5 * (track['interval'] or 0.0):
+            best = pending.popleft()
+        if best is None:
+            return
+        _, horizon, predicted_verts, predicted_inv, held_verts, held_inv = best
+        actual_verts = vertices[::VERTEX_STRIDE]
+        corners = roi_corners(inv_trans2roi)
+        with self.lock:
+            self.horizons.append(horizon * 1000.0)
+            self.errors['roi_px'].append(float(np.linalg.norm(roi_corners(predicted_inv) - corners, axis=1).mean()))
+            self.errors['hold_roi_px'].append(float(np.linalg.norm(roi_corners(held_inv) - corners, axis=1).mean()))
+            self.errors['verts_mm'].append(float(np.linalg.norm(predicted_verts - actual_verts, axis=1).mean()) * 1000.0)
+            self.errors['hold_verts_mm'].append(float(np.linalg.norm(held_verts - actual_verts, axis=1).mean()) * 1000.0)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'predicted': self.predicted, 'scored': len(self.errors['roi_px']),
+                     'horizon_ms': round(float(np.mean(self.horizons)), 1) if self.horizons else 0.0}
+            for name, values in self.errors.items():
+                if values:
+                    stats[f'p50_{name}'] = round(float(np.percentile(values, 50)), 1)
+                    stats[f'p95_{name}'] = round(float(np.percentile(values, 95)), 1)
+            return stats
+
+    def format_stats(self):
+        stats = self.get_stats()
+        if not stats['scored']:
+            return f"predicted {stats['predicted']} poses, no error samples yet"
+        return (f"predicted {stats['predicted']} poses | {stats['horizon_ms']:.0f}ms ahead: "
+                f"ROI error p50 {stats['p50_roi_px']:.1f}px (hold {stats['p50_hold_roi_px']:.1f}px), "
+                f"p95 {stats['p95_roi_px']:.1f}px (hold {stats['p95_hold_roi_px']:.1f}px) | "
+                f"vertices p50 {stats['p50_verts_mm']:.0f}mm (hold {stats['p50_hold_verts_mm']:.0f}mm)")
+
+
+def roi_corners(inv_trans2roi, roi_size=512):
+    # ROI corners in frame pixels
+    corners = np.array([[0, 0, 1], [roi_size, 0, 1], [0, roi_size, 1], [roi_size, roi_size, 1]], np.float64)
+    return corners @ np.asarray(inv_trans2roi, np.float64).T
@@ -0,0 +1,138 @@
+import threading
+import time
+import traceback
+from threading import Thread
+
+PENDING = 'pending'
+LOADING = 'loading'
+WARMING = 'warming'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class StartupStatus:
+    """Thread-safe readiness and progress of the server's startup, polled by the web tier"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.components = dict()
+        self.required = []
+        self.ready_event = threading.Event()
+
+    def add_component(self, name, required=True):
+        with self.lock:
+            self.components[name] = {'state': PENDING, 'seconds': 0.0, 'warmup_ms': None, 'error': None,
+                                     'done': 0, 'total': 1, 'started': None}
+            if required:
+                self.required.append(name)
+
+    def set_state(self, name, state, error=None):
+        with self.lock:
+            component = self.components[name]
+            if component['started'] is None and state != PENDING:
+                component['started'] = time.time()
+            component['state'] = state
+            if component['started'] is not None:
+                component['seconds'] = round(time.time() - component['started'], 3)
+            if error is not None:
+                component['error'] = error
+            if state == READY:
+                component['done'] = component['total']
+            if all(self.components[n]['state'] == READY for n in self.required):
+                self.ready_event.set()
+
+    def set_progress(self, name, done, total):
+        with self.lock:
+            self.components[name]['done'] = done
+            self.components[name]['total'] = max(total, 1)
+
+    def set_warmup(self, name, seconds):
+        with self.lock:
+            self.components[name]['warmup_ms'] = round(seconds * 1000.0, 1)
+
+    @property
+    def ready(self):
+        return self.ready_event.is_set()
+
+    def wait(self, timeout=None):
+        return self.ready_event.wait(timeout)
+
+    def to_dict(self):
+        with self.lock:
+            components = {name: {k: v for k, v in c.items() if k != 'started'}
+                          for name, c in self.components.items()}
+            required = list(self.required)
+        failed = any(c['state'] == FAILED for c in components.values())
+        fractions = [1.0 if components[n]['state'] == READY else
+                     0.5 * components[n]['done'] / components[n]['total'] for n in required]
+        return {
+            'state': FAILED if failed else (READY if self.ready else 'starting'),
+            'ready': self.ready,
+            'progress': round(sum(fractions) / len(fractions), 3) if fractions else 0.0,
+            'uptime_s': round(time.time() - self.start_time, 1),
+            'components': components,
+        }
+
+    def format_status(self):
+        status = self.to_dict()
+        parts = [f"{name} {c['state']} {c['seconds']:.1f}s" for name, c in status['components'].items()]
+        return f"{status['state']} {status['progress'] * 100:.0f}% | " + ' | '.join(parts)
+
+
+class StartupOrchestrator:
+    """Runs independent startup steps concurrently, each on its own thread.
+
+    A step is load_fn() optionally followed by warmup_fn(); steps wait for the steps named
+    in depends_on. run() blocks until every step finished and raises if one failed.
+    """
+
+    def __init__(self, status=None):
+        self.status = status if status is not None else StartupStatus()
+        self.steps = []
+        self.done = dict()
+
+    def add(self, name, load_fn, warmup_fn=None, depends_on=(), required=True):
+        self.status.add_component(name, required=required)
+        self.steps.append((name, load_fn, warmup_fn, tuple(depends_on)))
+        self.done[name] = threading.Event()
+
+    def run_step(self, name, load_fn, warmup_fn, depends_on, errors):
+        try:
+            for dependency in depends_on:
+                self.done[dependency].wait()
+                if self.status.components[dependency]['state'] != READY:
+                    raise RuntimeError(f"depends on {dependency}, which failed")
+            self.status.set_state(name, LOADING)
+            load_fn()
+            if warmup_fn is not None:
+                self.status.set_state(name, WARMING)
+                start = time.perf_counter()
+                warmup_fn()
+                self.status.set_warmup(name, time.perf_counter() - start)
+            self.status.set_state(name, READY)
+            print(f"✓ {name} ready ({self.status.components[name]['seconds']:.1f}s)")
+        except Exception as e:
+            traceback.print_exc()
+            self.status.set_state(name, FAILED, error=str(e))
+            errors.append((name, e))
+            print(f"✗ {name} failed: {e}")
+        finally:
+            self.done[name].set()
+
+    def run(self):
+        errors = []
+        threads = []
+        start = time.time()
+        for name, load_fn, warmup_fn, depends_on in self.steps:
+            t = Thread(target=self.run_step, args=(name, load_fn, warmup_fn, depends_on, errors),
+                       name='startup-' + name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        print(f"Startup steps finished in {time.time() - start:.1f}s | {self.status.format_status()}")
+        if errors:
+            name, error = errors[0]
+            raise RuntimeError(f"startup step '{name}' failed: {error}") from error
@@ -0,0 +1,103 @@
+import io
+
+import torch
+
+from util.cv2_trans_util import TemporalSmoothing
+
+STATE_FORMAT = 1
+
+
+class TemporalState:
+    """Everything one stream carries from frame to frame, kept outside the shared models.
+
+    A processor lends these to its models for the duration of one frame, so a single loaded
+    model set can serve any number of streams without mixing their histories:
+      pose_filter    the pose regressor's One Euro filters (BEV/ROMP OE_filters entry)
+      last_pose      (vertices, trans2roi, inv_trans2roi) of the last regressed frame, and
+      pose_reuses    how often it has been reused since (degraded quality levels)
+      roi_smoothing  exponential smoothing of the frame -> ROI transform, if the processor smooths
+      rnn_state      garment id -> ConvLSTM (h, c) of recurrent generators
+      motion_*       the motion gate's keyframe (thumbnail and garment layer) and hysteresis
+      flow_*         the flow propagator's keyframe (ROI crop and garment RGBA)
+      pose_track     the pose predictor's last pose and velocities
+      latency_ms     round trip the client measures, the horizon the overlay lags by
+    """
+
+    def __init__(self, roi_smoothing=None):
+        self.pose_filter = None
+        self.last_pose = None
+        self.pose_reuses = 0
+        self.roi_smoothing = TemporalSmoothing(c=roi_smoothing) if roi_smoothing is not None else None
+        self.rnn_state = dict()
+        self.frames = 0
+        self.pose_track = None
+        self.latency_ms = None
+        self.reset_motion()
+
+    def reset_motion(self):
+        # not serialised: a stream picks up from a fresh keyframe after a hand-over
+        self.motion_layer = None
+        self.motion_static = False
+        self.motion_still_frames = 0
+        self.motion_skips = 0
+        self.motion_diff = None
+        self.flow_keyframe = None
+        self.flow_propagated = 0
+        self.flow_motion = None
+
+    def reset(self):
+        self.pose_filter = None
+        self.last_pose = None
+        self.pose_reuses = 0
+        self.pose_track = None
+        if self.roi_smoothing is not None:
+            self.roi_smoothing.past_trans = None
+        self.rnn_state.clear()
+        self.reset_motion()
+
+    def remember_pose(self, pose):
+        self.last_pose = pose
+        self.pose_reuses = 0
+
+    def reusable_pose(self, pose_every):
+        """The previous pose if this frame may reuse it, else None"""
+        if pose_every <= 1 or self.last_pose is None or self.pose_reuses + 1 >= pose_every:
+            return None
+        self.pose_reuses += 1
+        return self.last_pose
+
+    def smooth_roi(self, trans2roi):
+        """(trans2roi, inv_trans2roi), smoothed over frames when this state smooths the ROI"""
+        return self.roi_smoothing(trans2roi)
+
+    def to_bytes(self):
+        """Serialise, e.g. to hand a stream over to another server process"""
+        rnn_state = {garment_id: ([t.cpu() for t in h], [t.cpu() for t in c])
+                     for garment_id, (h, c) in self.rnn_state.items()}
+        buffer = io.BytesIO()
+        torch.save({
+            'format': STATE_FORMAT,
+            'pose_filter': self.pose_filter,
+            'last_pose': self.last_pose,
+            'pose_reuses': self.pose_reuses,
+            'roi_smoothing': self.roi_smoothing,
+            'rnn_state': rnn_state,
+            'frames': self.frames,
+        }, buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_bytes(data):
+        # full pickle: the pose filters are plain python objects. Only load states from trusted peers.
+        saved = torch.load(io.BytesIO(data), map_location='cpu', weights_only=False)
+        if saved.get('format') != STATE_FORMAT:
+            raise ValueError(f"unsupported temporal state format {saved.get('format')}")
+        state = TemporalState()
+        state.pose_filter = saved['pose_filter']
+        state.last_pose = saved['last_pose']
+        state.pose_reuses = saved['pose_reuses']
+        state.roi_smoothing = saved['roi_smoothing']
+        # recurrent states move back to the model's device when they are lent to it
+        state.rnn_state = saved['rnn_state']
+        state.frames = saved['frames']
+        return state
@@ -25,7 +25,7 @@ from tqdm import tqdm
 from composition.naive_overlay import naive_overlay, naive_overlay_alpha
 from util.densepose_util import IUV2UpperBodyImg, IUV2TorsoLeg, IUV2SDP, IUV2SSDP
 from threading import Thread
-from util.cv2_trans_util import TemporalSmoothing
+from VITON.temporal_state import TemporalState
 
 def make_pix2pix_model(name, input_nc=6, output_nc=4, model_name='pix2pixHD'):
     opt = TestOptions().parse(save=False, use_default=True, show_info=False)
@@ -52,25 +52,30 @@ class FullBodyFrameProcessor:
         self.densepose_extractor = DensePoseExtractor()
         self.full_body = FullBodySMPL()
         self.viton_model = make_pix2pix_model(target_name, input_nc=6)
-        self.temporal_smoothing = TemporalSmoothing(c=0.8)
+        # ROI smoothing and pose filters of the stream served when no state is passed
+        self.default_state = self.new_state()
         self.roi_height=576
         self.roi_width = int(self.roi_height * 0.75)
 
 
-    def vmssdp(self, input_frame):
+    def new_state(self):
+        return TemporalState(roi_smoothing=0.8)
+
+    def vmssdp(self, input_frame, state=None):
 
         raw_image = input_frame
+        state = state if state is not None else self.default_state
 
         height = raw_image.shape[0]
         width = raw_image.shape[1]
 
-        smpl_param = self.smpl_regressor.forward(raw_image, False)  # 1.38
+        smpl_param = self.smpl_regressor.forward(raw_image, False, temporal_state=state)  # 1.38
         # print(list(smpl_param.keys()))
         if smpl_param is None:
             return input_frame
         trans2roi, inv_trans = self.smpl_regressor.get_fullbody_trans2roi(smpl_param, s=1.4, new_h=self.roi_height,
                                                                      new_w=self.roi_width)
-        trans2roi, inv_trans = self.temporal_smoothing(trans2roi)
+        trans2roi, inv_trans = state.smooth_roi(trans2roi)
 
         vertices = self.smpl_regressor.get_raw_verts(smpl_param)
         vertices = torch.from_numpy(vertices).unsqueeze(0)
@@ -109,20 +114,21 @@ class FullBodyFrameProcessor:
         composed_img = naive_overlay_alpha(raw_image, raw_target_img, raw_alpha)
         return composed_img
 
-    def vmsdp(self, input_frame):
+    def vmsdp(self, input_frame, state=None):
 
         raw_image = input_frame
+        state = state if state is not None else self.default_state
 
         height = raw_image.shape[0]
         width = raw_image.shape[1]
 
-        smpl_param = self.smpl_regressor.forward(raw_image, False)  # 1.38
+        smpl_param = self.smpl_regressor.forward(raw_image, False, temporal_state=state)  # 1.38
         # print(list(smpl_param.keys()))
         if smpl_param is None:
             return input_frame
         trans2roi, inv_trans = self.smpl_regressor.get_fullbody_trans2roi(smpl_param, s=1.4, new_h=self.roi_height,
                                                                      new_w=self.roi_width)
-        trans2roi, inv_trans = self.temporal_smoothing(trans2roi)
+        trans2roi, inv_trans = state.smooth_roi(trans2roi)
 
         vertices = self.smpl_regressor.get_raw_verts(smpl_param)
         vertices = torch.from_numpy(vertices).unsqueeze(0)
@@ -25,7 +25,7 @@ from tqdm import tqdm
 from composition.naive_overlay import naive_overlay, naive_overlay_alpha
 from util.densepose_util import IUV2UpperBodyImg, IUV2TorsoLeg, IUV2SDP, IUV2SSDP
 from threading import Thread
-from util.cv2_trans_util import TemporalSmoothing
+from VITON.temporal_state import TemporalState
 
 def make_pix2pix_model(name, input_nc=6, output_nc=4, model_name='pix2pixHD_RNN_RGBA'):
     opt = TestOptions().parse(save=False, use_default=True, show_info=False)
@@ -50,33 +50,43 @@ class FullBodySeqFrameProcessor:
         self.viton_model = make_pix2pix_model(target_name)
         self.smpl_regressor = SMPL_Regressor(use_bev=True, fix_body=True)
         self.full_body = FullBodySMPL()
-        self.temporal_smoothing = TemporalSmoothing(c=0.9)
+        self.target_name = target_name
+        # ROI smoothing, pose filters and generator h/c of the stream served when no state is passed
+        self.default_state = self.new_state()
         self.roi_height = 576
         self.roi_width = int(self.roi_height * 0.75)
         self.densepose_extractor = DensePoseExtractor()
 
-    def __call__(self, roi_vm, roi_ssdp):
+    def new_state(self):
+        return TemporalState(roi_smoothing=0.9)
+
+    def __call__(self, roi_vm, roi_ssdp, state=None):
+        state = state if state is not None else self.default_state
         vm_tensor = util.im2tensor(roi_vm) * 2.0 - 1.0
         vm_tensor = vm_tensor[:, [2, 1, 0], :, :]
         dp_tensor = util.im2tensor(roi_ssdp) * 2.0 - 1.0
+        # the recurrent generator continues this stream's h/c and hands them back
+        self.viton_model.set_state(state.rnn_state.get(self.target_name))
         with torch.no_grad():
             target_tensor = self.viton_model.forward(torch.cat([vm_tensor, dp_tensor], 1).cuda())
+        state.rnn_state[self.target_name] = self.viton_model.get_state()
         roi_target = util.tensor2im(target_tensor[0, [0, 1, 2], :, :], normalize=True, rgb=False)
         roi_alpha = ((target_tensor[0, 3, :, :].clamp(min=-1.0, max=1.0) / 2.0 + 0.5).cpu().numpy() * 255).astype(
             np.uint8)
         return roi_target, roi_alpha
 
-    def forward(self, raw_image, isRGB=False):
+    def forward(self, raw_image, isRGB=False, state=None):
+        state = state if state is not None else self.default_state
         height = raw_image.shape[0]
         width = raw_image.shape[1]
 
-        smpl_param = self.smpl_regressor.forward(raw_image, False)  # 1.38
+        smpl_param = self.smpl_regressor.forward(raw_image, False, temporal_state=state)  # 1.38
         # print(list(smpl_param.keys()))
         if smpl_param is None:
             return raw_image
         trans2roi, inv_trans = self.smpl_regressor.get_fullbody_trans2roi(smpl_param, s=1.4, new_h=self.roi_height,
                                                                           new_w=self.roi_width)
-        trans2roi, inv_trans = self.temporal_smoothing(trans2roi)
+        trans2roi, inv_trans = state.smooth_roi(trans2roi)
 
         vertices = self.smpl_regressor.get_raw_verts(smpl_param)
         vertices = torch.from_numpy(vertices).unsqueeze(0)
@@ -97,7 +107,7 @@ class FullBodySeqFrameProcessor:
                                   borderMode=cv2.BORDER_CONSTANT,
                                   borderValue=(0, 0, 0))
 
-        roi_target, roi_alpha = self.__call__(roi_vm, roi_ssdp)
+        roi_target, roi_alpha = self.__call__(roi_vm, roi_ssdp, state)
         raw_target_img = cv2.warpAffine(roi_target, inv_trans, (raw_image.shape[1], raw_image.shape[0]),
                                         flags=cv2.INTER_LINEAR,
                                         borderMode=cv2.BORDER_CONSTANT,
@@ -1,5 +1,7 @@
+import hashlib
 import os
 import threading
+from collections import deque
 
 import numpy as np
 import cv2
@@ -25,9 +27,19 @@ from tqdm import tqdm
 from composition.naive_overlay import naive_overlay, naive_overlay_alpha
 from util.densepose_util import IUV2UpperBodyImg, IUV2TorsoLeg, IUV2SDP
 from threading import Thread
+from VITON.generator_batcher import GeneratorBatcher
+from VITON.garment_residency import GarmentResidencyManager, MB, TIER_GPU
+from model.pix2pixHD.checkpoint_store import CheckpointStore
+from VITON.startup import StartupOrchestrator, LOADING, READY, FAILED
+from VITON.temporal_state import TemporalState
+from VITON.motion_gate import MotionGate
+from VITON.flow_propagation import FlowPropagator
+from VITON.pose_prediction import PosePredictor
+from util.weight_cache import WeightCache, DENSEPOSE_WEIGHTS
+from util.frame_buffers import FrameBuffers
 
 
-def make_pix2pix_model(name, input_nc, output_nc=3, model_name='pix2pixHD',ckpt_dir=None):
+def make_pix2pix_model(name, input_nc, output_nc=3, model_name='pix2pixHD',ckpt_dir=None, checkpoint_store=None):
     opt = TestOptions().parse(save=False, use_default=True, show_info=False)
     opt.nThreads = 1  # test code only supports nThreads = 1
     opt.batchSize = 1  # test code only supports batchSize = 1
@@ -43,142 +55,545 @@ def make_pix2pix_model(name, input_nc, output_nc=3, model_name='pix2pixHD',ckpt_
     else:
         opt.checkpoints_dir=ckpt_dir
     opt.gpu_ids=[0]  # Load to GPU - use list of integers directly
+    if checkpoint_store is not None:
+        # weights come from the memory-mapped store; build on the CPU so they stay mapped
+        opt.checkpoint_store = checkpoint_store
+        opt.gpu_ids = []
     model = create_model(opt)
     # print(model)
     return model
 
 
 class FrameProcessor:
-    def __init__(self, garment_name_list,ckpt_dir=None):
-        self.smpl_regressor = SMPL_Regressor(use_bev=True)
+    resolution = 512
+
+    def __init__(self, garment_name_list,ckpt_dir=None, gpu_budget_mb=2048, host_budget_mb=8192,
+                 residency_policy='lru', checkpoint_store_dir=None, weight_cache_dir=None, frame_shape=(720, 1280),
+                 startup_status=None, warm_garment_id=0, preload_order=None, frame_buffers=None):
         self.viton_model = None
         self.ckpt_dir = ckpt_dir
-        self.densepose_extractor = DensePoseExtractor()
-        self.upper_body = UpperBodySMPL()
+        self.checkpoint_store = CheckpointStore.open(checkpoint_store_dir)
+        if self.checkpoint_store is not None:
+            print(f"Using memory-mapped checkpoint store {checkpoint_store_dir}")
+        self.weight_cache = WeightCache(weight_cache_dir)
         self.garment_name_list = garment_name_list#[2, 3, 17, 18, 22]
-        self.viton_model_list = [None for i in range(len(self.garment_name_list))]
         self.lock = threading.Lock()
+        # garment models live in a GPU / pinned host memory / disk hierarchy with byte budgets
+        self.residency = GarmentResidencyManager(self.load_garment_model, gpu_budget_bytes=gpu_budget_mb * MB,
+                                                 host_budget_bytes=host_budget_mb * MB, policy=residency_policy,
+                                                 pin_memory=self.checkpoint_store is None)
+        # stage locks let concurrent sessions overlap in different stages without sharing one stage
+        self.pose_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.densepose_lock = threading.Lock()
+        # optional cross-session batching of generator calls, see enable_batching
+        self.batcher = None
+        # optional reuse of the last garment layer on near-static frames, see enable_motion_gate
+        self.motion_gate = None
+        # optional generator on keyframes only, optical flow in between, see enable_flow_propagation
+        self.flow_propagator = None
+        # optional constant-velocity extrapolation of reused poses, see enable_pose_prediction
+        self.pose_predictor = None
+        # garment switches: the newest request wins, latencies for reporting
+        self.switch_generation = 0
+        self.switch_times = deque(maxlen=100)
+        # temporal state of the single stream served when __call__ gets no state of its own
+        self.default_state = self.new_state()
+        # ROI and composition warps write into reused arrays (util.frame_buffers)
+        self.buffers = frame_buffers if frame_buffers is not None else FrameBuffers()
+
+        # independent components load concurrently and each runs one warm-up inference on a
+        # frame of the serving size, so the first real frame pays no lazy initialisation
+        self.frame_shape = frame_shape
+        self.warm_garment_id = warm_garment_id
+        # garment ids to warm into host memory, most likely first (default: list order)
+        self.preload_order = preload_order
+        self.smpl_regressor = None
+        self.densepose_extractor = None
+        self.upper_body = None
+        self.startup = StartupOrchestrator(startup_status)
+        self.startup.add('pose', self.load_pose, self.warmup_pose)
+        self.startup.add('densepose', self.load_densepose, self.warmup_densepose)
+        self.startup.add('renderer', self.load_renderer, self.warmup_renderer)
+        if warm_garment_id is not None and 0 <= warm_garment_id < len(garment_name_list):
+            self.startup.add('garment', self.load_warm_garment, self.warmup_generator)
+        self.startup.status.add_component('garment_cache', required=False)
+        self.startup.run()
 
         self.load_all = Thread(target=self.load_all_models, args=())
         self.load_all.daemon = True
         self.load_all.start()
 
+    def warmup_frame(self):
+        return np.zeros((self.frame_shape[0], self.frame_shape[1], 3), np.uint8)
+
+    def load_pose(self):
+        weight_paths = self.weight_cache.resolve_bev()
+        if not weight_paths:
+            print("⚠ BEV weights not in the local weight cache, using the library defaults")
+        self.smpl_regressor = SMPL_Regressor(use_bev=True, weight_paths=weight_paths)
+
+    def warmup_pose(self):
+        self.regress_pose(self.warmup_frame(), self.new_state())
+
+    def load_densepose(self):
+        weights = self.weight_cache.resolve(DENSEPOSE_WEIGHTS)
+        if weights is None:
+            print("⚠ DensePose weights not in the local weight cache, they will be downloaded")
+        self.densepose_extractor = DensePoseExtractor(model_weights=weights)
+
+    def warmup_densepose(self):
+        try:
+            self.extract_iuv(self.warmup_frame())
+        except Exception:
+            # nobody in the blank frame; the network has still run once
+            pass
+
+    def load_renderer(self):
+        self.upper_body = UpperBodySMPL()
+
+    def warmup_renderer(self):
+        # creates the EGL context and buffers at the serving frame size; other sizes get their own on first use
+        vertices = np.zeros((1, self.upper_body.uv_map_matrix.shape[1], 3), np.float32)
+        self.render_body(self.warmup_frame(), vertices, np.eye(2, 3, dtype=np.float32))
+
+    def load_warm_garment(self):
+        self.get_garment_model(self.warm_garment_id)
+
+    def warmup_generator(self):
+        blank = np.zeros((self.resolution, self.resolution, 3), np.uint8)
+        self.generate(blank, blank, garment_id=self.warm_garment_id)
+
+    def load_garment_model(self, garment_id):
+        return make_pix2pix_model(self.garment_name_list[garment_id], 6, output_nc=4, ckpt_dir=self.ckpt_dir,
+                                  checkpoint_store=self.checkpoint_store)
+
+    def garment_version(self, garment_id):
+        """Identifies the weights of a garment's generator; changes whenever its checkpoint changes"""
+        name = self.garment_name_list[garment_id]
+        if self.checkpoint_store is not None:
+            digest = self.checkpoint_store.version(name)
+            if digest is not None:
+                return digest
+        path = os.path.join(self.ckpt_dir or './rtv_ckpts', name, 'latest_net_G.pth')
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return hashlib.sha256(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8')).hexdigest()
+
     def load_all_models(self):
-        for i, garment_name in enumerate(self.garment_name_list):
-            new_model = make_pix2pix_model(garment_name, 6, output_nc=4,ckpt_dir=self.ckpt_dir)
-            if self.viton_model_list[i] is None:
-                # Store models on CPU initially to save GPU memory
-                new_model = new_model.cpu()
-                self.viton_model_list[i]= new_model
-
-    def load_one_models(self, garment_name):
-        new_model = make_pix2pix_model(garment_name, 6, output_nc=4,ckpt_dir=self.ckpt_dir)
-        id = self.garment_name_list.index(garment_name)
-        if self.viton_model_list[id] is None:
-            # Store model on CPU initially
-            new_model = new_model.cpu()
-            self.viton_model_list[id]= new_model
-
-    def switch_to_target_garment(self,garment_id):
-        self.lock.acquire()
-        print("Loading target garment id: ", garment_id)
-        id = garment_id
-        if self.viton_model_list[id] is None and id >= 0:
-            print("Loading from disk target garment id: ", garment_id)
-            self.load_one_models(self.garment_name_list[id])
-        old_model = self.viton_model
-<<<<<<< HEAD
-        new_model=self.viton_model_list[id] if garment_id>=0 else None  # Model already on GPU
-        print("Finished")
-=======
-        # Move model to CUDA and set to eval mode
+        # warm host memory in preload order until the host budget is full; the rest stays on disk
+        status = self.startup.status
+        status.set_state('garment_cache', LOADING)
+        order = self.preload_order if self.preload_order is not None else range(len(self.garment_name_list))
+        total = len(order)
+        try:
+            for n, i in enumerate(order):
+                if not self.residency.prefetch(i):
+                    print(f"Host garment budget full: {self.garment_name_list[i]} and later garments load on demand")
+                    break
+                status.set_progress('garment_cache', n + 1, total)
+            status.set_state('garment_cache', READY)
+        except Exception as e:
+            print(f"✗ Failed to preload garments: {e}")
+            status.set_state('garment_cache', FAILED, error=str(e))
+
+    def stage_garment(self, garment_id):
+        """Bring a garment to the GPU and run it once, without taking the serving lock.
+
+        The garment is held (never evicted) until the caller unholds it. Returns the tier it
+        was in before staging.
+        """
+        source_tier = self.residency.tier_of(garment_id)
+        self.residency.hold(garment_id)
+        try:
+            model = self.residency.get(garment_id)
+            with torch.no_grad():
+                model.forward(torch.zeros(1, 6, self.resolution, self.resolution).cuda())
+            torch.cuda.synchronize()
+        except Exception:
+            self.residency.unhold(garment_id)
+            raise
+        return source_tier
+
+    def swap_garment(self, garment_id, flip, on_switched=None):
+        """Double-buffered garment switch.
+
+        The new garment is staged and warmed while the current one keeps serving, then
+        flip() runs under the lock to make it active in one step; flip returns False when a
+        newer switch superseded this one. Returns the switch report, or None if superseded.
+        """
+        start = time.perf_counter()
+        source_tier = None
         if garment_id >= 0:
-            new_model = self.viton_model_list[id]
-            new_model = new_model.cuda()
-            new_model.eval()
-        else:
-            new_model = None
-        print("Finished loading model to GPU")
->>>>>>> bc97192808a5efc461f382608ebba15b0ea1345d
-        if self.viton_model is not None:
-            del self.viton_model
-        self.viton_model = new_model
-        if old_model is not None:
-<<<<<<< HEAD
-            # No need to move to CPU since we're managing GPU memory
-=======
-            old_model = old_model.cpu()
->>>>>>> bc97192808a5efc461f382608ebba15b0ea1345d
-            del old_model
-            torch.cuda.empty_cache()
-        self.lock.release()
-
-
-    def set_target_garment(self, target_id):
+            source_tier = self.stage_garment(garment_id)
+        staged = time.perf_counter()
+        try:
+            self.lock.acquire()
+            try:
+                flipped = flip()
+            finally:
+                self.lock.release()
+        finally:
+            if garment_id >= 0:
+                self.residency.unhold(garment_id)
+        if not flipped:
+            print(f"Garment switch to {garment_id} superseded by a newer one")
+            return None
+        report = {
+            'id': garment_id,
+            'switch_ms': round((time.perf_counter() - start) * 1000.0, 1),
+            'stage_ms': round((staged - start) * 1000.0, 1),
+            'source_tier': source_tier,
+        }
+        self.switch_times.append(report['switch_ms'])
+        print(f"Switched to garment {garment_id} in {report['switch_ms']:.0f}ms (from {source_tier}) | "
+              f"{self.residency.format_stats()}")
+        if on_switched is not None:
+            on_switched(report)
+        return report
+
+    def switch_to_target_garment(self,garment_id, on_switched=None):
+        print("Loading target garment id: ", garment_id)
+        with self.lock:
+            self.switch_generation += 1
+            generation = self.switch_generation
+        new_model = [None]
+
+        def flip():
+            if generation != self.switch_generation:
+                return False
+            if garment_id >= 0:
+                new_model[0] = self.residency.get(garment_id)
+            self.viton_model = new_model[0]
+            self.residency.set_active([garment_id] if garment_id >= 0 else [])
+            return True
+
+        return self.swap_garment(garment_id, flip, on_switched)
+
+    def get_switch_stats(self):
+        times = np.array(self.switch_times) if self.switch_times else np.zeros(1)
+        return {
+            'switches': len(self.switch_times),
+            'p50_switch_ms': float(np.percentile(times, 50)),
+            'p95_switch_ms': float(np.percentile(times, 95)),
+        }
+
+    def get_garment_model(self, garment_id):
+        # read from disk outside the lock so other sessions keep running meanwhile
+        self.residency.ensure_host(garment_id)
+        self.lock.acquire()
+        try:
+            return self.residency.get(garment_id)
+        finally:
+            self.lock.release()
+
+    def retain_garment_models(self, garment_ids):
+        # garments worn by a session stay on the GPU; the others become eviction candidates
+        self.residency.set_active(garment_ids)
+
+    def enable_batching(self, max_batch_size=4, batch_window_ms=5.0):
+        self.batcher = GeneratorBatcher(self.forward_garment_batch, max_batch_size=max_batch_size,
+                                        batch_window_ms=batch_window_ms)
+        return self.batcher
+
+    def enable_motion_gate(self, **kwargs):
+        self.motion_gate = MotionGate(**kwargs)
+        return self.motion_gate
+
+    def enable_flow_propagation(self, **kwargs):
+        self.flow_propagator = FlowPropagator(**kwargs)
+        return self.flow_propagator
+
+    def enable_pose_prediction(self, **kwargs):
+        self.pose_predictor = PosePredictor(**kwargs)
+        return self.pose_predictor
+
+    def layer_key(self, garment_id):
+        # a garment layer is only reused for the garment (or global model) that generated it
+        return garment_id if garment_id is not None else ('global', id(self.viton_model))
+
+    def forward_garment_batch(self, garment_id, input_tensor):
+        self.residency.ensure_host(garment_id)
+        # held for the whole forward so a concurrent staging cannot evict it
+        self.residency.hold(garment_id)
+        self.lock.acquire()
+        try:
+            model = self.residency.get(garment_id)
+            with torch.no_grad():
+                return model.forward(input_tensor.cuda())
+        finally:
+            self.lock.release()
+            self.residency.unhold(garment_id)
+
+    def new_state(self):
+        """Temporal state for a new stream; pass it to every __call__ of that stream"""
+        return TemporalState()
+
+    def set_target_garment(self, target_id, on_switched=None):
         #new_model = make_pix2pix_model(ckpt_dict[target_id], 6, output_nc=4)
         #self.viton_model = self.viton_model_list[target_id]
-        t = Thread(target=self.switch_to_target_garment, args=(target_id,))
+        # the current garment keeps serving until the new one is staged, see swap_garment
+        t = Thread(target=self.switch_to_target_garment, args=(target_id, on_switched))
         t.daemon = True
         t.start()
 
-    def __call__(self, input_frame):
-        if self.viton_model is None:
-            return input_frame
-
-        resolution = 512
-        raw_image = input_frame
-
-        smpl_data = self.smpl_regressor.forward(raw_image, True, size=1.45,
-                                                roi_img_size=resolution)
+    def regress_pose(self, raw_image, state=None):
+        state = state if state is not None else self.default_state
+        with self.pose_lock:
+            smpl_data = self.smpl_regressor.forward(raw_image, True, size=1.45,
+                                                    roi_img_size=self.resolution, temporal_state=state)
         if len(smpl_data) < 3:
-            return input_frame
+            return None
         smpl_param, trans2roi, inv_trans2roi = smpl_data
 
         if smpl_param is None:
-            return input_frame
+            return None
         vertices = SMPL_Regressor.get_raw_verts(smpl_param)
         vertices = torch.from_numpy(vertices).unsqueeze(0)
+        return vertices, trans2roi, inv_trans2roi
 
+    def render_body(self, raw_image, vertices, trans2roi, roi_size=None, out=None):
+        # out: optional roi_size x roi_size x 3 uint8 array to warp into
+        roi_size = roi_size or self.resolution
         height = raw_image.shape[0]
         width = raw_image.shape[1]
+        with self.render_lock:
+            raw_vm = self.upper_body.render(vertices[0], height=height, width=width)
+        roi_vm = cv2.warpAffine(raw_vm, trans2roi, (roi_size, roi_size), dst=out, flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT,
+                                borderValue=(0, 0, 0))
+        return roi_vm
 
-        v = vertices
-
-        raw_vm = self.upper_body.render(v[0], height=height, width=width)
+    def extract_iuv(self, raw_image, scale=1.0):
+        if scale == 1.0:
+            with self.densepose_lock:
+                return self.densepose_extractor.get_IUV(raw_image, isRGB=False)
+        # cheaper: run on a downscaled frame, then bring the labels back to full size
+        small = cv2.resize(raw_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        with self.densepose_lock:
+            small_IUV = self.densepose_extractor.get_IUV(small, isRGB=False)
+        if small_IUV is None:
+            return None
+        return cv2.resize(small_IUV, (raw_image.shape[1], raw_image.shape[0]), interpolation=cv2.INTER_NEAREST)
 
-        raw_IUV = self.densepose_extractor.get_IUV(raw_image, isRGB=False)
-        if raw_IUV is None:
-            return input_frame
+    def iuv_to_roi_sdp(self, raw_IUV, trans2roi, roi_size=None, out=None):
+        roi_size = roi_size or self.resolution
         dpi_img = IUV2SDP(raw_IUV)
-        roi_dpi_img = cv2.warpAffine(dpi_img, trans2roi, (resolution, resolution), flags=cv2.INTER_LINEAR,
+        roi_dpi_img = cv2.warpAffine(dpi_img, trans2roi, (roi_size, roi_size), dst=out, flags=cv2.INTER_LINEAR,
                                      borderMode=cv2.BORDER_CONSTANT,
                                      borderValue=(0, 0, 0))
+        return roi_dpi_img
 
-        roi_vm = cv2.warpAffine(raw_vm, trans2roi, (resolution, resolution), flags=cv2.INTER_LINEAR,
-                                borderMode=cv2.BORDER_CONSTANT,
-                                borderValue=(0, 0, 0))
-
+    def generator_input(self, roi_vm, roi_dpi_img):
         vm_tensor = util.im2tensor(roi_vm) * 2.0 - 1.0
         vm_tensor = vm_tensor[:, [2, 1, 0], :, :]
         dp_tensor = util.im2tensor(roi_dpi_img) * 2.0 - 1.0
-        self.lock.acquire()
-        with torch.no_grad():
-            if self.viton_model is not None:
-                target_tensor = self.viton_model.forward(torch.cat([vm_tensor, dp_tensor], 1).cuda())
-                self.lock.release()
-            else:
-                self.lock.release()
-                return input_frame
+        return torch.cat([vm_tensor, dp_tensor], 1)
+
+    def generator_output(self, target_tensor):
         roi_target = util.tensor2im(target_tensor[0, [0, 1, 2], :, :], normalize=True, rgb=False)
         roi_alpha = (target_tensor[0, 3, :, :].clamp(min=0.0, max=1.0).cpu().numpy() * 255).astype(np.uint8)
+        return roi_target, roi_alpha
+
+    def generate(self, roi_vm, roi_dpi_img, garment_id=None):
+        input_tensor = self.generator_input(roi_vm, roi_dpi_img)
+        if garment_id is not None:
+            if self.batcher is not None:
+                target_tensor = self.batcher.forward(garment_id, input_tensor)
+            else:
+                target_tensor = self.forward_garment_batch(garment_id, input_tensor)
+            if target_tensor is None:
+                return None
+        else:
+            self.lock.acquire()
+            with torch.no_grad():
+                if self.viton_model is not None:
+                    target_tensor = self.viton_model.forward(input_tensor.cuda())
+                    self.lock.release()
+                else:
+                    self.lock.release()
+                    return None
+        return self.generator_output(target_tensor)
+
+    def generate_garments(self, input_tensor, garment_ids):
+        """Run one generator input through several garments; garment id -> output tensor or None.
+
+        Garments already on the GPU run first, before loading the others can evict them. With
+        batching enabled every garment is submitted at once and shares its batch with live
+        sessions wearing the same garment. A garment that fails (e.g. its checkpoint does not
+        load) maps to None without failing the others.
+        """
+        order = sorted(garment_ids, key=lambda g: self.residency.tier_of(g) != TIER_GPU)
+        outputs = dict()
+        if self.batcher is not None:
+            futures = [(g, self.batcher.submit(g, input_tensor)) for g in order]
+            for g, future in futures:
+                outputs[g] = self.garment_output(g, future.result)
+            return outputs
+        for g in order:
+            outputs[g] = self.garment_output(g, self.forward_garment_batch, g, input_tensor)
+        return outputs
+
+    def garment_output(self, garment_id, fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"✗ Garment {self.garment_name_list[garment_id]} failed: {e}")
+            return None
+
+    def try_on_still(self, raw_image, garment_ids, timings=None):
+        """Dress one photo in several garments: perception runs once, the generator once per garment.
 
-        raw_target_img = cv2.warpAffine(roi_target, inv_trans2roi, (raw_image.shape[1], raw_image.shape[0]),
+        Returns garment id -> composed image (None where that garment failed), or None if no
+        person was found. timings, if given, receives the time of each stage in ms.
+        """
+        clock = [time.perf_counter()]
+
+        def lap(stage):
+            if timings is not None:
+                now = time.perf_counter()
+                timings[stage] = (now - clock[0]) * 1000.0
+                clock[0] = now
+
+        # a photo has no past: fresh filters, nothing carried over to live streams
+        pose = self.regress_pose(raw_image, self.new_state())
+        if pose is None:
+            return None
+        vertices, trans2roi, inv_trans2roi = pose
+        lap('pose')
+
+        roi_vm = self.render_body(raw_image, vertices, trans2roi)
+        lap('render')
+
+        raw_IUV = self.extract_iuv(raw_image)
+        if raw_IUV is None:
+            return None
+        roi_dpi_img = self.iuv_to_roi_sdp(raw_IUV, trans2roi)
+        lap('densepose')
+
+        outputs = self.generate_garments(self.generator_input(roi_vm, roi_dpi_img), garment_ids)
+        lap('generator')
+
+        results = dict()
+        for garment_id in garment_ids:
+            target_tensor = outputs.get(garment_id)
+            if target_tensor is None:
+                results[garment_id] = None
+                continue
+            roi_target, roi_alpha = self.generator_output(target_tensor)
+            results[garment_id] = self.compose(raw_image, roi_target, roi_alpha, inv_trans2roi)
+        lap('compose')
+        return results
+
+    def compose(self, raw_image, roi_target, roi_alpha, inv_trans2roi):
+        # the warped layer only lives until naive_overlay_alpha has blended it: this thread's scratch arrays
+        height, width = raw_image.shape[:2]
+        raw_target_img = cv2.warpAffine(roi_target, inv_trans2roi, (width, height),
+                                        dst=self.buffers.scratch('compose_target', (height, width, 3)),
                                         flags=cv2.INTER_LINEAR,
                                         borderMode=cv2.BORDER_CONSTANT,
                                         borderValue=(0, 0, 0))
-        raw_alpha = cv2.warpAffine(roi_alpha, inv_trans2roi, (raw_image.shape[1], raw_image.shape[0]),
+        raw_alpha = cv2.warpAffine(roi_alpha, inv_trans2roi, (width, height),
+                                   dst=self.buffers.scratch('compose_alpha', (height, width)),
                                    flags=cv2.INTER_LINEAR,
                                    borderMode=cv2.BORDER_CONSTANT,
                                    borderValue=(0,))
         composed_img = naive_overlay_alpha(raw_image, raw_target_img, raw_alpha)
         return composed_img
+
+    def __call__(self, input_frame, garment_id=None, state=None, quality=None, timings=None, layer_only=False):
+        # garment_id=None serves the globally selected garment (set_target_garment);
+        # a per-session garment id and temporal state (new_state) let one processor serve
+        # several streams. quality (a degradation.QualityLevel) trades accuracy for speed
+        # under load; timings, if given, receives the time of each stage in ms.
+        # layer_only returns the garment layer (see garment_layer) for the client to composite
+        layer = self.garment_layer(input_frame, garment_id, state, quality, timings)
+        if layer_only:
+            return layer
+        if layer is None:
+            return input_frame
+        start = time.perf_counter()
+        composed = self.compose(input_frame, *layer)
+        if timings is not None:
+            timings['compose'] = (time.perf_counter() - start) * 1000.0
+        return composed
+
+    def garment_layer(self, input_frame, garment_id=None, state=None, quality=None, timings=None):
+        """(roi_target, roi_alpha, inv_trans2roi) dressing this frame, or None when it gets no garment"""
+        if garment_id is None and self.viton_model is None:
+            return None
+        if garment_id is not None and garment_id < 0:
+            return None
+
+        raw_image = input_frame
+        clock = [time.perf_counter()]
+
+        def lap(stage):
+            if timings is not None:
+                now = time.perf_counter()
+                timings[stage] = (now - clock[0]) * 1000.0
+                clock[0] = now
+
+        state = state if state is not None else self.default_state
+        state.frames += 1
+        if self.motion_gate is not None:
+            layer = self.motion_gate.check(state, raw_image, self.layer_key(garment_id))
+            if layer is not None:
+                # near-static frame: the keyframe's garment over the new camera image
+                return layer['roi_target'], layer['roi_alpha'], layer['inv_trans2roi']
+        if self.flow_propagator is not None:
+            propagated = self.flow_propagator.propagate(state, raw_image, self.layer_key(garment_id))
+            if propagated is not None:
+                lap('flow')
+                return propagated
+
+        pose = state.reusable_pose(quality.pose_every) if quality is not None else None
+        if pose is not None and self.pose_predictor is not None and state.pose_track is not None:
+            # the reused pose is a frame or more old: move it on to this frame
+            predicted = self.pose_predictor.predict(state, clock[0] - state.pose_track['time'], clock[0])
+            pose = predicted if predicted is not None else pose
+        if pose is None:
+            pose = self.regress_pose(raw_image, state)
+            if pose is None:
+                return None
+            state.remember_pose(pose)
+            if self.pose_predictor is not None:
+                self.pose_predictor.update(state, pose, clock[0])
+        vertices, trans2roi, inv_trans2roi = pose
+        lap('pose')
+
+        roi_size = self.resolution
+        if quality is not None and quality.roi_size != self.resolution:
+            # same crop, fewer pixels: scale the ROI transforms
+            roi_size = quality.roi_size
+            scale = roi_size / float(self.resolution)
+            trans2roi = trans2roi * scale
+            inv_trans2roi = inv_trans2roi.copy()
+            inv_trans2roi[:, :2] /= scale
+
+        # consumed by generate() below, so this thread's scratch arrays can hold them
+        roi_vm = self.render_body(raw_image, vertices, trans2roi, roi_size,
+                                  out=self.buffers.scratch('roi_vm', (roi_size, roi_size, 3)))
+        lap('render')
+
+        raw_IUV = self.extract_iuv(raw_image, quality.densepose_scale if quality is not None else 1.0)
+        if raw_IUV is None:
+            return None
+        roi_dpi_img = self.iuv_to_roi_sdp(raw_IUV, trans2roi, roi_size,
+                                          out=self.buffers.scratch('roi_sdp', (roi_size, roi_size, 3)))
+        lap('densepose')
+
+        generated = self.generate(roi_vm, roi_dpi_img, garment_id)
+        if generated is None:
+            return None
+        roi_target, roi_alpha = generated
+        lap('generator')
+
+        if self.motion_gate is not None:
+            self.motion_gate.keyframe(state, raw_image, self.layer_key(garment_id), pose[1], self.resolution,
+                                      roi_target, roi_alpha, inv_trans2roi)
+        if self.flow_propagator is not None:
+            self.flow_propagator.keyframe(state, raw_image, self.layer_key(garment_id), pose[1], self.resolution,
+                                          roi_target, roi_alpha, inv_trans2roi)
+        return roi_target, roi_alpha, inv_trans2roi
@@ -625,7 +625,7 @@ def get_virtual_closet(user_id, favorited_only=False):
         with get_db_connection() as conn:
             cursor = conn.cursor(dictionary=True)
             query = """
-                SELECT vc.*, p.product_name, p.brand, p.image_path, p.price, p.category
+                SELECT vc.*, p.garment_id, p.product_name, p.brand, p.image_path, p.price, p.category
                 FROM virtual_closet vc
                 JOIN products p ON vc.product_id = p.product_id
                 WHERE vc.user_id = %s
@@ -757,6 +757,25 @@ def update_tryon_session(session_id, duration=None, saved_to_closet=False, added
     except Error as e:
         return {'success': False, 'error': str(e)}
 
+def get_tryon_history(since_days=90):
+    """Get recent try-on sessions with their garment, oldest first per user (for prefetch planning)"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor(dictionary=True)
+            query = """
+                SELECT ts.user_id, p.garment_id, ts.created_at, ts.saved_to_closet, ts.added_to_cart
+                FROM tryon_sessions ts
+                JOIN products p ON ts.product_id = p.product_id
+                WHERE ts.created_at >= DATE_SUB(NOW(), INTERVAL %s DAY)
+                ORDER BY ts.user_id, ts.created_at
+            """
+            cursor.execute(query, (since_days,))
+            sessions = cursor.fetchall()
+            cursor.close()
+            return {'success': True, 'sessions': sessions}
+    except Error as e:
+        return {'success': False, 'error': str(e)}
+
 # Initialize connection pool when module is imported
 if __name__ != '__main__':
     init_db_pool()
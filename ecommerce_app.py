@@ -4,20 +4,30 @@ Main Flask application with authentication, shopping cart, and virtual try-on
 """
 import asyncio
 import websockets
-import socket
 import struct
 import cv2
 import numpy as np
 import json
-import pickle
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, send_from_directory, request, redirect, url_for, session, flash, jsonify, abort
 import threading
 import base64
 import os
 import glob
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 from functools import wraps
 from datetime import timedelta
 import database as db
+import prefetch_planner
+from tryon_cache import TryOnCache, photo_digest
+from jpeg_codec import JPEGCodecPool
+from stream_quality import StreamQualityController, STREAM_ADAPTIVE
+from gpu_router import GPURouter, GPUWorker, parse_workers
+from gpu_protocol import (AsyncProtocolStream, MSG_RESULT, MSG_REPLY, MSG_LAYER, PROTOCOL_LEGACY, PROTOCOL_V2, FLAG_SHM,
+                          OUTPUT_LAYER, now_us)
+from shm_transport import FrameRing, KIND_JPEG, slot_of
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -30,6 +40,29 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=int(os.getenv('SESSION
 # GPU server connection - Load from environment variables
 GPU_SERVER_IP = os.getenv('GPU_SERVER_IP', '172.28.80.80')
 GPU_SERVER_PORT = int(os.getenv('GPU_SERVER_PORT', 9999))
+# Wire protocol: 2 = versioned binary protocol, 1 = legacy length-prefixed framing (older GPU servers)
+GPU_SERVER_PROTOCOL = int(os.getenv('GPU_SERVER_PROTOCOL', 2))
+# HTTP readiness endpoint of the GPU server (network_rtv_server.py --status_port)
+GPU_STATUS_PORT = int(os.getenv('GPU_STATUS_PORT', GPU_SERVER_PORT + 1))
+# Same-host GPU server: connect over its unix socket (network_rtv_server.py --unix_socket) and pass
+# frames through a shared-memory ring of GPU_SHM_SLOTS slots (0 = over the socket)
+GPU_UNIX_SOCKET = os.getenv('GPU_UNIX_SOCKET', '')
+GPU_SHM_SLOTS = int(os.getenv('GPU_SHM_SLOTS', 4))
+GPU_SHM_SLOT_MB = int(os.getenv('GPU_SHM_SLOT_MB', 4))
+# Pool of GPU workers as host:port[:status_port],... (default: the single server above)
+GPU_WORKERS = os.getenv('GPU_WORKERS', '')
+gpu_router = GPURouter(parse_workers(GPU_WORKERS) if GPU_WORKERS.strip()
+                       else [GPUWorker(GPU_SERVER_IP, GPU_SERVER_PORT, GPU_STATUS_PORT, unix_path=GPU_UNIX_SOCKET)])
+
+# Garments with trained models, in the GPU server's garment index order
+GARMENT_IDS = ['jin_17', 'jin_18', 'jin_22', 'lab_03', 'lab_04', 'lab_07']
+# Seconds a still-photo try-on may take on the GPU server (queueing included)
+GPU_STILL_TIMEOUT = float(os.getenv('GPU_STILL_TIMEOUT', 60.0))
+# Still try-on results on disk, per shopper and model version (see tryon_cache.py)
+tryon_cache = TryOnCache()
+# Threads decoding the base64 data URLs of browsers without binary frames, off the event loop
+JPEG_CODEC_THREADS = int(os.getenv('JPEG_CODEC_THREADS', 2))
+codec_pool = JPEGCodecPool(JPEG_CODEC_THREADS)
 
 # Store active websocket clients
 clients = set()
@@ -164,7 +197,8 @@ def product_detail(product_id):
         return render_template('product_detail.html', 
                              product=product, 
                              estimated_size=estimated_size,
-                             cart_count=cart_count)
+                             cart_count=cart_count,
+                             tryon_images=cached_tryon_results(session.get('tryon_photo'), [product['garment_id']]))
     else:
         flash('Product not found', 'danger')
         return redirect(url_for('shop'))
@@ -319,10 +353,11 @@ def virtual_closet():
     result = db.get_virtual_closet(session['user_id'])
     
     if result['success']:
-        return render_template('virtual_closet.html', items=result['items'])
+        tryon_images = cached_tryon_results(session.get('tryon_photo'), [item['garment_id'] for item in result['items']])
+        return render_template('virtual_closet.html', items=result['items'], tryon_images=tryon_images)
     else:
         flash('Error loading virtual closet', 'danger')
-        return render_template('virtual_closet.html', items=[])
+        return render_template('virtual_closet.html', items=[], tryon_images={})
 
 @app.route('/add-to-closet', methods=['POST'])
 @login_required
@@ -439,6 +474,145 @@ def serve_garment_image(filename):
     garment_dir = os.path.join(base_dir, 'assets', 'garment_images')
     return send_from_directory(garment_dir, filename)
 
+@app.route('/api/tryon/still', methods=['POST'])
+@login_required
+def still_tryon():
+    """Try one uploaded photo on several garments at once (virtual closet, product page)"""
+    photo = request.files.get('photo')
+    garment_ids = [g for g in request.form.getlist('garment_ids') if g in GARMENT_IDS]
+    if photo is None or not garment_ids:
+        return jsonify({'success': False, 'error': 'A photo and at least one try-on garment are required'}), 400
+    garment_ids = list(dict.fromkeys(garment_ids))
+
+    photo_data = photo.read()
+    photo_hash = photo_digest(photo_data)
+    # later visits to the closet and product pages show this photo's cached results
+    session['tryon_photo'] = photo_hash
+    results = cached_tryon_results(photo_hash, garment_ids)
+    missing = [g for g in garment_ids if g not in results]
+    answer = {}
+    if missing:
+        answer, error_response = request_still_tryon(photo_data, missing)
+        if answer is None:
+            return error_response
+        for garment_id in missing:
+            index = str(GARMENT_IDS.index(garment_id))
+            image = answer['results'].get(index)
+            if not image:
+                results[garment_id] = None
+                continue
+            relpath = tryon_cache.put(session['user_id'], photo_hash, garment_id,
+                                      answer.get('versions', {}).get(index), base64.b64decode(image))
+            results[garment_id] = (url_for('serve_tryon_result', filename=relpath.replace(os.sep, '/'))
+                                   if relpath else f'data:image/jpeg;base64,{image}')
+    return jsonify({'success': True, 'results': results,
+                    'failed': [g for g, image in results.items() if image is None],
+                    'cached': len(garment_ids) - len(missing),
+                    'total_ms': answer.get('total_ms', 0.0)})
+
+def cached_tryon_results(photo_hash, garment_ids):
+    """URLs of the shopper's cached still try-ons of a photo, for the garments that have one"""
+    results = {}
+    if not photo_hash:
+        return results
+    versions = gpu_router.model_versions()
+    for garment_id in garment_ids:
+        if garment_id not in GARMENT_IDS:
+            continue
+        index = GARMENT_IDS.index(garment_id)
+        version = versions[index] if index < len(versions) else None
+        tryon_cache.observe_version(garment_id, version)
+        relpath = tryon_cache.get(session['user_id'], photo_hash, garment_id, version)
+        if relpath is not None:
+            results[garment_id] = url_for('serve_tryon_result', filename=relpath.replace(os.sep, '/'))
+    return results
+
+def request_still_tryon(photo_data, garment_ids):
+    """POST a photo to a GPU worker's /still; returns (answer, None) or (None, error response)"""
+    query = urllib.parse.urlencode({'garments': ','.join(str(GARMENT_IDS.index(g)) for g in garment_ids),
+                                    'client': session['user_id']})
+    error = 'No GPU worker available'
+    for worker in gpu_router.route(f"still:{session['user_id']}", None):
+        post = urllib.request.Request(f'http://{worker.host}:{worker.status_port}/still?{query}', data=photo_data,
+                                      headers={'Content-Type': 'image/jpeg'})
+        try:
+            with urllib.request.urlopen(post, timeout=GPU_STILL_TIMEOUT) as response:
+                return json.loads(response.read().decode('utf-8')), None
+        except urllib.error.HTTPError as e:
+            # the worker understood the request and turned it down
+            try:
+                error = json.loads(e.read().decode('utf-8')).get('error', str(e))
+            except ValueError:
+                error = str(e)
+            if e.code != 503:
+                return None, (jsonify({'success': False, 'error': error}), e.code)
+        except TimeoutError:
+            return None, (jsonify({'success': False, 'error': 'The try-on took too long, please try fewer garments'}), 504)
+        except Exception as e:
+            gpu_router.mark_failed(worker, e)
+            error = str(e)
+    return None, (jsonify({'success': False, 'error': error}), 503)
+
+@app.route('/tryon-results/<path:filename>')
+@login_required
+def serve_tryon_result(filename):
+    """Serve a cached still try-on image; shoppers only see their own"""
+    if filename.split('/', 1)[0] != str(session['user_id']):
+        abort(404)
+    response = send_from_directory(tryon_cache.root, filename, max_age=86400)
+    # content addressed, so it never changes, but it is the shopper's own photo
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.route('/api/tryon-cache')
+def tryon_cache_stats():
+    """Size and hit rate of the still try-on result cache"""
+    return jsonify(tryon_cache.get_stats())
+
+@app.route('/api/codec')
+def codec_stats():
+    """Timing of the base64 work done for browsers that send data URLs"""
+    return jsonify(codec_pool.get_stats())
+
+@app.route('/api/gpu-status')
+def gpu_status():
+    """Startup readiness and progress of the GPU worker a try-on session would be routed to.
+
+    Takes the websocket's ?session=..&garment=.. to look up the same worker; the answer also
+    counts the pool's ready workers from the router's health checks.
+    """
+    session_key = request.args.get('session') or 'gpu-status'
+    garment_id = request.args.get('garment', type=int)
+    workers = gpu_router.route(session_key, garment_id, record=False)
+    pool = gpu_router.get_stats()['workers']
+    summary = {'workers': len(pool), 'ready_workers': sum(1 for w in pool if w['healthy'] and w['ready'])}
+    if not workers:
+        return jsonify(dict(summary, state='unreachable', ready=False, progress=0.0,
+                            error='no GPU workers configured')), 503
+    worker = workers[0]
+    try:
+        url = f'http://{worker.host}:{worker.status_port}/status'
+        with urllib.request.urlopen(url, timeout=1.0) as response:
+            status = json.loads(response.read().decode('utf-8'))
+        return jsonify(dict(status, worker=worker.name, **summary))
+    except Exception as e:
+        return jsonify(dict(summary, state='unreachable', ready=False, progress=0.0, worker=worker.name,
+                            error=str(e))), 503
+
+@app.route('/api/gpu-workers')
+def gpu_workers():
+    """Health and session counts of the GPU worker pool, plus routing counters"""
+    return jsonify(gpu_router.get_stats())
+
+@app.route('/api/prefetch-plan')
+def prefetch_plan():
+    """Ranked garment preload plan from try-on history, fetched by the GPU server"""
+    plan = prefetch_planner.get_plan()
+    if plan is None:
+        return jsonify({'error': 'Prefetch plan unavailable'}), 503
+    return jsonify(plan)
+
 @app.route('/test-websocket')
 def test_websocket():
     """Test page for WebSocket connection"""
@@ -446,90 +620,461 @@ def test_websocket():
 
 # ==================== WEBSOCKET HANDLER ====================
 
+# Timeouts for the GPU server round trip (seconds)
+GPU_CONNECT_TIMEOUT = float(os.getenv('GPU_CONNECT_TIMEOUT', 5.0))
+GPU_FRAME_TIMEOUT = float(os.getenv('GPU_FRAME_TIMEOUT', 2.0))
+# results between reports of the measured round trip to the GPU server (its pose prediction horizon)
+LATENCY_REPORT_FRAMES = 30
+
+class LayerResult:
+    """A garment layer answer (gpu_protocol.LAYER_HEADER + JPEG), passed on to the browser as is"""
+    def __init__(self, data):
+        self.data = data
+
 class GPUServerConnection:
-    def __init__(self):
-        self.socket = None
+    """asyncio client for one GPU server connection.
+
+    A reader task owns the receive side and hands each result to the request waiting for
+    its frame id, so a slow or timed-out frame never blocks the event loop or other sessions.
+    """
+    def __init__(self, host=GPU_SERVER_IP, port=GPU_SERVER_PORT, unix_path=None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        # shared-memory ring for same-host servers, and the slot of each frame in flight
+        self.ring = None
+        self.ring_slots = {}
+        self.stream = None
+        self.reader_task = None
+        self.pending = {}  # frame_id -> Future of the processed JPEG bytes
+        self.next_frame_id = 0
         self.connected = False
+        self.last_error = None
+        # coroutine called with each JSON reply/event from the GPU server (protocol v2 only)
+        self.on_reply = None
+        # JPEG quality last asked for with set_result_quality
+        self.result_quality = None
+        # smoothed round trip of a frame, from the send timestamp the server echoes (v2 only)
+        self.rtt_ms = None
+        self.results = 0
     
-    def connect(self):
+    async def connect(self):
         """Connect to GPU server"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((GPU_SERVER_IP, GPU_SERVER_PORT))
+            if self.unix_path:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_unix_connection(self.unix_path), GPU_CONNECT_TIMEOUT)
+            else:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), GPU_CONNECT_TIMEOUT)
+            self.stream = AsyncProtocolStream(reader, writer, protocol=GPU_SERVER_PROTOCOL)
+            if self.unix_path and GPU_SHM_SLOTS > 0 and GPU_SERVER_PROTOCOL == PROTOCOL_V2:
+                await self.attach_ring()
             self.connected = True
-            print(f"✓ Connected to GPU server at {GPU_SERVER_IP}:{GPU_SERVER_PORT}")
+            self.reader_task = asyncio.ensure_future(self.read_results())
+            print(f"✓ Connected to GPU server at {self.unix_path or f'{self.host}:{self.port}'} "
+                  f"(protocol v{GPU_SERVER_PROTOCOL}{', shared memory' if self.ring else ''})")
             return True
         except Exception as e:
-            print(f"✗ Failed to connect to GPU server: {e}")
+            self.last_error = e
+            print(f"✗ Failed to connect to GPU server at {self.unix_path or f'{self.host}:{self.port}'}: {e}")
             return False
     
-    def send_frame(self, frame_data):
-        """Send JPEG frame to GPU server"""
+    async def attach_ring(self):
+        """Create the shared-memory ring and have the server map it; falls back to the socket"""
+        ring = FrameRing.create(GPU_SHM_SLOTS, GPU_SHM_SLOT_MB * 1024 * 1024)
+        await self.stream.send_command(ring.describe())
+        reply = await asyncio.wait_for(self.stream.receive(), GPU_CONNECT_TIMEOUT)
+        if reply is not None and reply.msg_type == MSG_REPLY and reply.json().get('type') == 'shm_attached':
+            self.ring = ring
+        else:
+            print("⚠ GPU server could not attach shared memory, sending frames over the socket")
+            ring.close()
+
+    def take_ring_result(self, message):
+        """Copy a result out of its slot and free the slot"""
+        slot = slot_of(message.payload)
+        _, data = self.ring.read(self.ring.output_region(slot), message.payload)
+        result = bytes(data)
+        if self.ring_slots.get(message.frame_id) == slot:
+            del self.ring_slots[message.frame_id]
+            self.ring.release(slot)
+        return result
+
+    async def read_results(self):
+        """Dispatch results from the GPU server to the waiting process_frame calls"""
         try:
-            size = len(frame_data)
-            self.socket.sendall(struct.pack("Q", size))
-            self.socket.sendall(frame_data)
-            return True
+            while True:
+                message = await self.stream.receive()
+                if message is None:
+                    print("✗ GPU server closed the connection")
+                    self.last_error = 'GPU server closed the connection'
+                    break
+                if message.legacy:
+                    # legacy results carry no frame id: they answer the oldest outstanding frame
+                    if self.pending:
+                        future = self.pending.pop(next(iter(self.pending)))
+                        if not future.done():
+                            future.set_result(message.payload)
+                elif message.msg_type == MSG_RESULT:
+                    payload = message.payload
+                    if message.flags & FLAG_SHM:
+                        payload = self.take_ring_result(message)
+                    future = self.pending.pop(message.frame_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(payload)
+                    await self.record_rtt(message.timestamp_us)
+                elif message.msg_type == MSG_LAYER:
+                    future = self.pending.pop(message.frame_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(LayerResult(bytes(message.payload)))
+                    await self.record_rtt(message.timestamp_us)
+                elif message.msg_type == MSG_REPLY:
+                    reply = message.json()
+                    if reply.get('type') == 'error':
+                        print(f"⚠ GPU server error: {reply.get('message')}")
+                    elif self.on_reply is not None:
+                        await self.on_reply(reply)
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            print(f"Error sending frame: {e}")
-            return False
+            print(f"Error receiving frame: {e}")
+            self.last_error = e
+        finally:
+            self.connected = False
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+            self.pending.clear()
     
-    def receive_frame(self):
-        """Receive processed frame from GPU server"""
+    async def record_rtt(self, timestamp_us):
+        # the timestamp is this process's send time, so no clock skew is involved
+        rtt_ms = (now_us() - timestamp_us) / 1000.0
+        if not 0 < rtt_ms < GPU_FRAME_TIMEOUT * 1000.0:
+            return
+        self.rtt_ms = rtt_ms if self.rtt_ms is None else 0.9 * self.rtt_ms + 0.1 * rtt_ms
+        self.results += 1
+        if self.results % LATENCY_REPORT_FRAMES == 0:
+            try:
+                await self.stream.send_command({'type': 'latency', 'rtt_ms': round(self.rtt_ms, 1)})
+            except Exception as e:
+                print(f"Error sending latency report: {e}")
+
+    async def process_frame(self, frame_data):
+        """Send one JPEG frame and wait for the processed one (None on failure or timeout)"""
+        if not self.connected:
+            return None
+        frame_id = self.next_frame_id
+        self.next_frame_id = (self.next_frame_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.pending[frame_id] = future
         try:
-            size_data = self.socket.recv(8)
-            if not size_data or len(size_data) < 8:
-                return None
-            
-            size = struct.unpack("Q", size_data)[0]
-            
-            if size & (1 << 63):
-                return self.receive_frame()
-            
-            data = b''
-            while len(data) < size:
-                packet = self.socket.recv(min(4096, size - len(data)))
-                if not packet:
-                    return None
-                data += packet
-            
-            return data
+            slot = self.ring.acquire() if self.ring is not None else None
+            ref = None
+            if slot is not None:
+                ref = self.ring.write(self.ring.input_region(slot), frame_data, KIND_JPEG, slot)
+                if ref is None:
+                    self.ring.release(slot)
+            if ref is not None:
+                # only the slot reference crosses the socket
+                self.ring_slots[frame_id] = slot
+                await self.stream.send_frame(ref, frame_id, flags=FLAG_SHM)
+            else:
+                await self.stream.send_frame(frame_data, frame_id)
+            return await asyncio.wait_for(future, GPU_FRAME_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠ GPU server did not answer frame {frame_id} within {GPU_FRAME_TIMEOUT}s")
+            if GPU_SERVER_PROTOCOL == PROTOCOL_LEGACY:
+                # a late legacy result would answer the next frame, and every frame after it
+                # would get its predecessor's result: start over on a fresh connection
+                print("⚠ Dropping the legacy GPU connection to resynchronise results")
+                await self.close()
+            return None
         except Exception as e:
-            print(f"Error receiving frame: {e}")
+            print(f"Error sending frame: {e}")
             return None
+        finally:
+            self.pending.pop(frame_id, None)
+            slot = self.ring_slots.pop(frame_id, None)
+            if slot is not None:
+                self.ring.release(slot)
     
-    def send_garment_change(self, garment_id):
+    async def set_output_mode(self, mode):
+        """Ask for garment layers instead of composited frames (protocol v2 servers only)"""
+        if not self.connected or GPU_SERVER_PROTOCOL != PROTOCOL_V2:
+            return False
+        try:
+            await self.stream.send_command({'type': 'set_output', 'mode': mode})
+            return True
+        except Exception as e:
+            print(f"Error sending output mode: {e}")
+            return False
+
+    async def set_result_quality(self, jpeg_quality):
+        """JPEG quality of this connection's results, at most the server's own (protocol v2 servers only)"""
+        if not self.connected or GPU_SERVER_PROTOCOL != PROTOCOL_V2:
+            return False
+        if jpeg_quality == self.result_quality:
+            return True
+        try:
+            await self.stream.send_command({'type': 'set_result_quality', 'jpeg_quality': jpeg_quality})
+            self.result_quality = jpeg_quality
+            return True
+        except Exception as e:
+            print(f"Error sending result quality: {e}")
+            return False
+
+    async def send_garment_change(self, garment_id):
         """Send garment change command"""
+        if not self.connected:
+            return False
         try:
-            command = {'type': 'change_garment', 'id': garment_id}
-            data = pickle.dumps(command)
-            size = len(data)
-            self.socket.sendall(struct.pack("Q", size | (1 << 63)))
-            self.socket.sendall(data)
+            await asyncio.wait_for(self.stream.send_command({'type': 'change_garment', 'id': garment_id}),
+                                   GPU_FRAME_TIMEOUT)
             print(f"✓ Sent garment change command: {garment_id}")
             return True
         except Exception as e:
             print(f"Error sending command: {e}")
             return False
     
-    def close(self):
+    async def close(self):
         """Close connection"""
-        if self.socket:
-            self.socket.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+        if self.stream is not None:
+            await self.stream.close()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
         self.connected = False
 
+# Binary websocket messages: type u8 | flags u8 | reserved u16 | frame_id u32, then the JPEG bytes.
+# Browsers without canvas.toBlob keep using JSON messages with base64 data URLs.
+WS_HEADER = struct.Struct('!BBHI')
+WS_FRAME = 1   # browser -> server: camera frame
+WS_RESULT = 2  # server -> browser: processed frame, echoes the frame id
+WS_LAYER = 3   # server -> browser: garment layer (gpu_protocol.LAYER_HEADER + JPEG) for the frame id
+
+class FrameRequest:
+    """A frame received from the browser, in either wire format"""
+    def __init__(self, data, binary, frame_id=0):
+        # binary: JPEG bytes (memoryview); otherwise the base64 data URL string
+        self.data = data
+        self.binary = binary
+        self.frame_id = frame_id
+        self.received = time.perf_counter()
+    
+    def jpeg_bytes(self):
+        if self.binary:
+            return self.data
+        return base64.b64decode(self.data.split(',')[1])
+
+def parse_binary_frame(message):
+    """Return a FrameRequest for a binary websocket message, or None if it is not a frame"""
+    if len(message) <= WS_HEADER.size:
+        return None
+    msg_type, flags, _, frame_id = WS_HEADER.unpack_from(message)
+    if msg_type != WS_FRAME:
+        return None
+    return FrameRequest(memoryview(message)[WS_HEADER.size:], True, frame_id)
+
+class LatestFrameSlot:
+    """Admission stage holding only the newest unprocessed frame of a session.
+
+    A frame that arrives while another one is still waiting replaces it, so a slow GPU
+    makes the relay drop stale frames instead of building up lag.
+    """
+    def __init__(self):
+        self.frame = None
+        self.event = asyncio.Event()
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+    
+    def put(self, frame):
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = frame
+        self.received += 1
+        self.event.set()
+    
+    async def get(self):
+        """Wait for the newest frame; returns None once the slot is closed"""
+        while self.frame is None:
+            if self.closed:
+                return None
+            self.event.clear()
+            await self.event.wait()
+        frame, self.frame = self.frame, None
+        return frame
+    
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+STATS_INTERVAL = 1.0  # seconds between processing-rate reports to the browser
+
+async def send_stream_params(websocket, client_gpu, params):
+    """Capture parameters to the browser; the result JPEG quality goes to the GPU server"""
+    await websocket.send(json.dumps(dict(params, type='stream_params')))
+    await client_gpu.set_result_quality(params['result_quality'])
+
+async def process_latest_frames(websocket, client_gpu, slot, stream_quality=None, reconnect=None):
+    """Forward the newest admitted frame to the GPU server, one at a time.
+
+    With a StreamQualityController every frame's server and GPU time is recorded, and the
+    capture parameters it recommends are sent to the browser with the stats. When the GPU
+    connection is lost, reconnect() returns a new one (None: no worker is left).
+    """
+    frame_count = 0
+    window_start = time.time()
+    window_processed = 0
+    window_received = slot.received
+    window_dropped = slot.dropped
+    
+    try:
+        while True:
+            frame = await slot.get()
+            if frame is None:
+                break
+            
+            # Base64 frames are only decoded once they are actually processed, on the codec pool
+            try:
+                if frame.binary:
+                    frame_data = frame.jpeg_bytes()
+                else:
+                    frame_data = await asyncio.wrap_future(codec_pool.submit('b64decode', frame.jpeg_bytes))
+            except Exception as e:
+                print(f"✗ Error decoding frame: {e}")
+                continue
+            
+            gpu_start = time.perf_counter()
+            processed_data = await client_gpu.process_frame(frame_data)
+            gpu_ms = (time.perf_counter() - gpu_start) * 1000.0
+            
+            if isinstance(processed_data, LayerResult):
+                # the browser composites the garment over the frame it sent
+                await websocket.send(WS_HEADER.pack(WS_LAYER, 0, 0, frame.frame_id) + processed_data.data)
+                if stream_quality is not None:
+                    stream_quality.frame_answered(frame.frame_id, gpu_ms, time.perf_counter())
+            elif processed_data:
+                # Answer in the format the browser used
+                if frame.binary:
+                    await websocket.send(WS_HEADER.pack(WS_RESULT, 0, 0, frame.frame_id) + processed_data)
+                else:
+                    processed_b64 = await asyncio.wrap_future(
+                        codec_pool.submit('b64encode', lambda: base64.b64encode(processed_data).decode('utf-8')))
+                    await websocket.send(json.dumps({
+                        'type': 'frame',
+                        'frame_id': frame.frame_id,
+                        'data': f'data:image/jpeg;base64,{processed_b64}'
+                    }))
+                if stream_quality is not None:
+                    stream_quality.frame_answered(frame.frame_id, gpu_ms, time.perf_counter())
+            else:
+                print("⚠ No processed frame received from GPU server")
+                if not client_gpu.connected:
+                    client_gpu = await reconnect() if reconnect is not None else None
+                    if client_gpu is None:
+                        await websocket.send(json.dumps({
+                            'type': 'error',
+                            'message': 'Lost the connection to the GPU server'
+                        }))
+                        await websocket.close()
+                        break
+            
+            frame_count += 1
+            window_processed += 1
+            if frame_count % 100 == 0:
+                print(f"📹 Processed {frame_count} frames, dropped {slot.dropped} stale frames...")
+            
+            now = time.time()
+            if now - window_start >= STATS_INTERVAL:
+                elapsed = now - window_start
+                await websocket.send(json.dumps({
+                    'type': 'stats',
+                    'processed_fps': round(window_processed / elapsed, 2),
+                    'received_fps': round((slot.received - window_received) / elapsed, 2),
+                    'dropped': slot.dropped - window_dropped,
+                    'total_dropped': slot.dropped,
+                    'stream': stream_quality.get_stats() if stream_quality is not None else None
+                }))
+                params = stream_quality.evaluate() if stream_quality is not None else None
+                if params is not None:
+                    await send_stream_params(websocket, client_gpu, params)
+                window_start = now
+                window_processed = 0
+                window_received = slot.received
+                window_dropped = slot.dropped
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    except Exception as e:
+        # the session cannot go on without its processor: tell the browser instead of going quiet
+        print(f"✗ Frame processor error: {e}")
+        import traceback
+        traceback.print_exc()
+        try:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': 'Frame processing stopped'
+            }))
+            await websocket.close()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+def routing_params(websocket):
+    """Session key, garment index and output mode from the websocket URL (?session=..&garment=..&output=..)"""
+    request = getattr(websocket, 'request', None)
+    path = request.path if request is not None else getattr(websocket, 'path', '')
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    session_key = query.get('session', [None])[0] or f'ws-{id(websocket)}'
+    try:
+        garment_id = int(query['garment'][0])
+    except (KeyError, ValueError):
+        garment_id = None
+    output_mode = query.get('output', [None])[0]
+    return session_key, garment_id, output_mode
+
+async def connect_gpu_worker(session_key, garment_id):
+    """Connect to the session's GPU worker, failing over along the hash ring"""
+    for worker in gpu_router.route(session_key, garment_id):
+        client_gpu = GPUServerConnection(worker.host, worker.port, worker.unix_path)
+        if await client_gpu.connect():
+            gpu_router.assign(session_key, garment_id, worker)
+            return client_gpu, worker
+        gpu_router.mark_failed(worker, client_gpu.last_error)
+    return None, None
+
+async def restore_gpu_session(client_gpu, garment_id, output_mode, result_quality):
+    """Bring a new GPU connection to the state the session's previous one was in"""
+    if output_mode == OUTPUT_LAYER:
+        await client_gpu.set_output_mode(OUTPUT_LAYER)
+    if garment_id is not None and 0 <= garment_id < 6:
+        await client_gpu.send_garment_change(garment_id)
+    if result_quality is not None:
+        await client_gpu.set_result_quality(result_quality)
+
 async def handle_websocket(websocket):
     """Handle WebSocket connection from browser"""
     clients.add(websocket)
     print(f"✓ New client connected. Total clients: {len(clients)}")
     
-    # Create dedicated GPU connection for this client
-    client_gpu = GPUServerConnection()
+    # Dedicated GPU connection for this client, on the worker its garment hashes to
+    session_key, garment_id, output_mode = routing_params(websocket)
+    client_gpu = None
+    worker = None
+    slot = LatestFrameSlot()
+    processor = None
     
     try:
         # Connect to GPU server
         print("Attempting to connect to GPU server...")
-        if not client_gpu.connect():
+        client_gpu, worker = await connect_gpu_worker(session_key, garment_id)
+        if client_gpu is None:
             print("✗ Failed to connect to GPU server")
             await websocket.send(json.dumps({
                 'type': 'error',
@@ -537,53 +1082,100 @@ async def handle_websocket(websocket):
             }))
             return
         
-        print("✓ Client connected to GPU server, ready to process frames")
+        print(f"✓ Client connected to GPU worker {worker.name} (garment {garment_id}), ready to process frames")
+        
+        async def forward_reply(reply):
+            if reply.get('type') == 'garment_changed':
+                # sent by the GPU server once the new garment is live
+                print(f"🎨 Garment {reply.get('id')} live after {reply.get('switch_ms')}ms ({reply.get('source_tier')})")
+                try:
+                    await websocket.send(json.dumps({
+                        'type': 'garment_changed',
+                        'garment_id': reply.get('id'),
+                        'switch_ms': reply.get('switch_ms'),
+                        'source_tier': reply.get('source_tier')
+                    }))
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+            elif reply.get('type') == 'busy':
+                # admission control on the GPU server turned this session away
+                print(f"⚠ GPU worker {worker.name} is busy ({reply.get('reason')})")
+                try:
+                    await websocket.send(json.dumps({
+                        'type': 'busy',
+                        'reason': reply.get('reason'),
+                        'retry_after_s': reply.get('retry_after_s', 5)
+                    }))
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+        client_gpu.on_reply = forward_reply
+        
+        async def reconnect():
+            # the GPU connection is gone: fail over like a new session would, in the same state
+            nonlocal client_gpu, worker
+            lost, lost_worker = client_gpu, worker
+            await lost.close()
+            gpu_router.release(session_key, lost_worker)
+            client_gpu = worker = None
+            if lost.last_error is not None:
+                # dropped by the worker, not closed here to resynchronise
+                gpu_router.mark_failed(lost_worker, lost.last_error)
+            client_gpu, worker = await connect_gpu_worker(session_key, garment_id)
+            if client_gpu is None:
+                print("✗ No GPU worker left for this session")
+                return None
+            print(f"✓ Session reconnected to GPU worker {worker.name}")
+            client_gpu.on_reply = forward_reply
+            await restore_gpu_session(client_gpu, garment_id, output_mode, lost.result_quality)
+            return client_gpu
+        
+        if output_mode == OUTPUT_LAYER:
+            # answers turn into garment layers once the GPU server confirms; a server that
+            # cannot keeps sending frames, which the browser shows as before
+            await client_gpu.set_output_mode(OUTPUT_LAYER)
+        # capture size, JPEG quality and send interval follow the measured round trips
+        stream_quality = StreamQualityController() if STREAM_ADAPTIVE else None
+        if stream_quality is not None:
+            await send_stream_params(websocket, client_gpu, stream_quality.params)
+        processor = asyncio.ensure_future(
+            process_latest_frames(websocket, client_gpu, slot, stream_quality, reconnect))
         
-        frame_count = 0
         async for message in websocket:
             try:
+                if isinstance(message, bytes):
+                    # Binary frame: small header + raw JPEG; only the newest one is kept
+                    frame = parse_binary_frame(message)
+                    if frame is not None:
+                        if stream_quality is not None:
+                            stream_quality.frame_received(frame.frame_id, len(frame.data), frame.received)
+                        slot.put(frame)
+                    continue
+                
                 data = json.loads(message)
                 msg_type = data.get('type')
                 
                 if msg_type == 'frame':
-                    frame_count += 1
-                    if frame_count % 100 == 0:
-                        print(f"📹 Processed {frame_count} frames...")
-                    
-                    # Receive base64 encoded frame from browser
+                    # Receive base64 encoded frame from browser; only the newest one is kept
                     frame_b64 = data.get('data')
                     if not frame_b64:
                         continue
-                    
-                    # Decode base64 to JPEG bytes
-                    try:
-                        frame_data = base64.b64decode(frame_b64.split(',')[1])
-                    except Exception as e:
-                        print(f"✗ Error decoding frame: {e}")
-                        continue
-                    
-                    # Send to GPU server
-                    if client_gpu.send_frame(frame_data):
-                        # Receive processed frame
-                        processed_data = client_gpu.receive_frame()
-                        
-                        if processed_data:
-                            # Send back to browser as base64
-                            processed_b64 = base64.b64encode(processed_data).decode('utf-8')
-                            await websocket.send(json.dumps({
-                                'type': 'frame',
-                                'data': f'data:image/jpeg;base64,{processed_b64}'
-                            }))
-                        else:
-                            print("⚠ No processed frame received from GPU server")
-                    else:
-                        print("⚠ Failed to send frame to GPU server")
+                    frame = FrameRequest(frame_b64, False, int(data.get('frame_id', 0)))
+                    if stream_quality is not None:
+                        stream_quality.frame_received(frame.frame_id, len(frame_b64), frame.received)
+                    slot.put(frame)
+                
+                elif msg_type == 'rtt':
+                    # round trips the browser measured for answered frames, by frame id
+                    if stream_quality is not None:
+                        stream_quality.client_rtts(data.get('samples', []))
                 
                 elif msg_type == 'garment_change':
                     garment_id = data.get('garment_id')
                     print(f"🎨 Changing garment to: {garment_id}")
                     if 0 <= garment_id < 6:  # Only 6 garments available
-                        if client_gpu.send_garment_change(garment_id):
+                        sent = await client_gpu.send_garment_change(garment_id)
+                        # v2 servers confirm with the switch latency once the garment is live
+                        if sent and GPU_SERVER_PROTOCOL == PROTOCOL_LEGACY:
                             await websocket.send(json.dumps({
                                 'type': 'garment_changed',
                                 'garment_id': garment_id
@@ -610,9 +1202,17 @@ async def handle_websocket(websocket):
         import traceback
         traceback.print_exc()
     finally:
-        client_gpu.close()
+        slot.close()
+        if processor is not None:
+            try:
+                await processor
+            except Exception as e:
+                print(f"✗ Frame processor error: {e}")
+        if client_gpu is not None:
+            await client_gpu.close()
+            gpu_router.release(session_key, worker)
         clients.remove(websocket)
-        print(f"✓ Client cleanup complete. Total clients: {len(clients)}")
+        print(f"✓ Client cleanup complete. Total clients: {len(clients)} (dropped {slot.dropped} stale frames)")
 
 async def start_websocket_server():
     """Start WebSocket server"""
@@ -631,6 +1231,7 @@ async def start_websocket_server():
 
 def run_websocket_server():
     """Run WebSocket server in event loop"""
+    gpu_router.start_health_checks()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     
@@ -655,6 +1256,9 @@ if __name__ == '__main__':
     # Start WebSocket server in separate thread
     ws_thread = threading.Thread(target=run_websocket_server, daemon=True)
     ws_thread.start()
+
+    # Keep the garment prefetch plan for the GPU server up to date
+    prefetch_planner.start_refresh_thread()
     
     # Run Flask app in main thread
     run_flask_app()
@@ -0,0 +1,297 @@
+"""
+Wire protocol between the web tier and the GPU server (network_rtv_server.py)
+
+Protocol v2 frames every message with a fixed 24-byte header:
+    magic 'RTV2' | version u8 | type u8 | flags u16 | frame_id u32 | timestamp_us u64 | payload_len u32
+(network byte order). Commands and replies are JSON, frames are JPEG bytes.
+
+A client that composites itself sends the command {'type': 'set_output', 'mode': 'layer'};
+its results then come as MSG_LAYER: LAYER_HEADER, then one JPEG holding the garment's
+colours (left half) next to its alpha (right half, grey). LAYER_HEADER is
+    layer -> view affine 6 x f32 | frame -> view affine 6 x f32 | view w, h u16 | layer w, h u16
+where the frame is the one the client sent and the view is the mirrored, cropped image the
+server works on. A layer width of 0 means the frame gets no garment (no JPEG follows).
+
+The legacy framing (8-byte native length, high bit marking a pickled command) is still
+understood; a server detects which one a client speaks from its first message.
+
+ProtocolSocket is the blocking endpoint used by the GPU server and simple clients,
+AsyncProtocolStream the asyncio one used by the web tier.
+"""
+import asyncio
+import json
+import pickle
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b'RTV2'
+VERSION = 2
+HEADER = struct.Struct('!4sBBHIQI')
+
+LEGACY_HEADER = struct.Struct('Q')
+LEGACY_COMMAND_BIT = 1 << 63
+
+PROTOCOL_LEGACY = 1
+PROTOCOL_V2 = 2
+
+# Message types
+MSG_FRAME = 1    # client -> server: JPEG frame
+MSG_RESULT = 2   # server -> client: processed JPEG frame, echoes frame_id and timestamp
+MSG_COMMAND = 3  # client -> server: JSON command
+MSG_REPLY = 4    # server -> client: JSON reply or event
+MSG_LAYER = 5    # server -> client: garment layer to composite over the sent frame, see LAYER_HEADER
+
+# Flags
+FLAG_SHM = 1     # payload is a shm_transport.SLOT_REF into the connection's shared-memory ring
+
+LAYER_HEADER = struct.Struct('!6f6fHHHH')
+
+OUTPUT_FRAME = 'frame'
+OUTPUT_LAYER = 'layer'
+
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+def now_us():
+    return int(time.time() * 1000000)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Message:
+    def __init__(self, msg_type, payload, frame_id=0, timestamp_us=0, flags=0, legacy=False):
+        self.msg_type = msg_type
+        # memoryview into the receiver's buffer: only valid until the next receive()
+        self.payload = payload
+        self.frame_id = frame_id
+        self.timestamp_us = timestamp_us
+        self.flags = flags
+        self.legacy = legacy
+
+    def json(self):
+        """Decode a command or reply payload"""
+        if self.legacy:
+            # legacy clients pickle their commands; only ever accepted in legacy mode
+            return pickle.loads(self.payload)
+        return json.loads(bytes(self.payload).decode('utf-8'))
+
+
+class ProtocolSocket:
+    """One protocol endpoint on a connected socket.
+
+    Payloads are received with recv_into into a buffer that is reused (and grown when
+    needed) across messages, so receiving a frame costs no per-packet copies.
+    protocol=None means "detect from the first message" (server side).
+    """
+
+    def __init__(self, sock, protocol=None, initial_buffer_size=1 << 20):
+        self.sock = sock
+        self.protocol = protocol
+        self.buffer = bytearray(initial_buffer_size)
+        self.header_buffer = bytearray(HEADER.size)
+        # frame id / timestamp of the last received frame, echoed back with its result
+        self.frame_id = 0
+        self.timestamp_us = 0
+        self.next_frame_id = 0
+        # header and payload of one message must not interleave with another thread's message
+        self.send_lock = threading.Lock()
+        # same-host clients: shared-memory ring (see shm_transport.py) and the slot
+        # reference of each frame received through it, by frame id
+        self.ring = None
+        self.ring_refs = dict()
+        # server side: what results this client wants (OUTPUT_FRAME or OUTPUT_LAYER)
+        self.output_mode = OUTPUT_FRAME
+        # server side: JPEG quality cap of this client's results (None: the server's own)
+        self.result_quality = None
+
+    def recv_exact_into(self, view):
+        got = 0
+        n = len(view)
+        while got < n:
+            k = self.sock.recv_into(view[got:], n - got)
+            if k == 0:
+                return False
+            got += k
+        return True
+
+    def receive_payload(self, size):
+        if size > MAX_PAYLOAD:
+            raise ProtocolError(f"payload of {size} bytes exceeds limit")
+        if len(self.buffer) < size:
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        view = memoryview(self.buffer)[:size]
+        if not self.recv_exact_into(view):
+            return None
+        return view
+
+    def receive(self):
+        """Receive the next message, or None when the peer closed the connection"""
+        header = memoryview(self.header_buffer)
+        if not self.recv_exact_into(header[:LEGACY_HEADER.size]):
+            return None
+        if self.protocol is None:
+            self.protocol = PROTOCOL_V2 if bytes(header[:4]) == MAGIC else PROTOCOL_LEGACY
+
+        if self.protocol == PROTOCOL_LEGACY:
+            size = LEGACY_HEADER.unpack(header[:LEGACY_HEADER.size])[0]
+            is_command = (size & LEGACY_COMMAND_BIT) != 0
+            size = size & ~LEGACY_COMMAND_BIT
+            payload = self.receive_payload(size)
+            if payload is None:
+                return None
+            msg_type = MSG_COMMAND if is_command else MSG_FRAME
+            return Message(msg_type, payload, legacy=True)
+
+        if not self.recv_exact_into(header[LEGACY_HEADER.size:]):
+            return None
+        magic, version, msg_type, flags, frame_id, timestamp_us, size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ProtocolError(f"unexpected header {magic!r} v{version}")
+        payload = self.receive_payload(size)
+        if payload is None:
+            return None
+        if msg_type == MSG_FRAME:
+            self.frame_id = frame_id
+            self.timestamp_us = timestamp_us
+        return Message(msg_type, payload, frame_id, timestamp_us, flags)
+
+    def send(self, msg_type, payload=b'', frame_id=0, timestamp_us=None, flags=0):
+        if timestamp_us is None:
+            timestamp_us = now_us()
+        payload = memoryview(payload).cast('B')
+        with self.send_lock:
+            self.sock.sendall(HEADER.pack(MAGIC, VERSION, msg_type, flags, frame_id, timestamp_us, len(payload)))
+            self.sock.sendall(payload)
+
+    def send_legacy(self, payload, size_field):
+        payload = memoryview(payload).cast('B')
+        with self.send_lock:
+            self.sock.sendall(LEGACY_HEADER.pack(size_field))
+            self.sock.sendall(payload)
+
+    def send_frame(self, jpeg_data):
+        """Client side: send a JPEG frame, returns its frame id"""
+        frame_id = self.next_frame_id
+        self.next_frame_id = (self.next_frame_id + 1) & 0xFFFFFFFF
+        if self.protocol == PROTOCOL_LEGACY:
+            self.send_legacy(jpeg_data, len(memoryview(jpeg_data).cast('B')))
+        else:
+            self.send(MSG_FRAME, jpeg_data, frame_id=frame_id)
+        return frame_id
+
+    def send_result(self, jpeg_data, frame_id=None, timestamp_us=None, flags=0):
+        """Server side: send a processed frame back in the client's protocol"""
+        if self.protocol == PROTOCOL_LEGACY:
+            self.send_legacy(jpeg_data, len(memoryview(jpeg_data).cast('B')))
+        else:
+            self.send(MSG_RESULT, jpeg_data,
+                      frame_id=self.frame_id if frame_id is None else frame_id,
+                      timestamp_us=self.timestamp_us if timestamp_us is None else timestamp_us, flags=flags)
+
+    def send_layer(self, payload, frame_id=None, timestamp_us=None):
+        """Server side: send a garment layer (LAYER_HEADER + JPEG) to a v2 client"""
+        self.send(MSG_LAYER, payload,
+                  frame_id=self.frame_id if frame_id is None else frame_id,
+                  timestamp_us=self.timestamp_us if timestamp_us is None else timestamp_us)
+
+    def send_command(self, command):
+        if self.protocol == PROTOCOL_LEGACY:
+            data = pickle.dumps(command)
+            self.send_legacy(data, len(data) | LEGACY_COMMAND_BIT)
+        else:
+            self.send(MSG_COMMAND, json.dumps(command).encode('utf-8'))
+
+    def send_reply(self, reply, frame_id=0):
+        # legacy clients have no reply channel
+        if self.protocol == PROTOCOL_V2:
+            self.send(MSG_REPLY, json.dumps(reply).encode('utf-8'), frame_id=frame_id)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncProtocolStream:
+    """asyncio counterpart of ProtocolSocket for the client side (the web tier).
+
+    Wraps an (asyncio.StreamReader, asyncio.StreamWriter) pair; the protocol is fixed by
+    the caller since only the server auto-detects it.
+    """
+
+    def __init__(self, reader, writer, protocol=PROTOCOL_V2):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.next_frame_id = 0
+
+    async def receive(self):
+        """Receive the next message, or None when the peer closed the connection.
+
+        Payloads are returned as bytes owned by the caller.
+        """
+        try:
+            if self.protocol == PROTOCOL_LEGACY:
+                size = LEGACY_HEADER.unpack(await self.reader.readexactly(LEGACY_HEADER.size))[0]
+                is_command = (size & LEGACY_COMMAND_BIT) != 0
+                size = size & ~LEGACY_COMMAND_BIT
+                if size > MAX_PAYLOAD:
+                    raise ProtocolError(f"payload of {size} bytes exceeds limit")
+                payload = await self.reader.readexactly(size)
+                return Message(MSG_COMMAND if is_command else MSG_RESULT, payload, legacy=True)
+
+            header = await self.reader.readexactly(HEADER.size)
+            magic, version, msg_type, flags, frame_id, timestamp_us, size = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError(f"unexpected header {magic!r} v{version}")
+            if size > MAX_PAYLOAD:
+                raise ProtocolError(f"payload of {size} bytes exceeds limit")
+            payload = await self.reader.readexactly(size)
+            return Message(msg_type, payload, frame_id, timestamp_us, flags)
+        except asyncio.IncompleteReadError:
+            return None
+
+    def write(self, msg_type, payload=b'', frame_id=0, timestamp_us=None, flags=0):
+        # header and payload are written without yielding, so messages never interleave
+        if timestamp_us is None:
+            timestamp_us = now_us()
+        payload = memoryview(payload).cast('B')
+        self.writer.write(HEADER.pack(MAGIC, VERSION, msg_type, flags, frame_id, timestamp_us, len(payload)))
+        self.writer.write(payload)
+
+    def write_legacy(self, payload, size_field):
+        self.writer.write(LEGACY_HEADER.pack(size_field))
+        self.writer.write(payload)
+
+    async def send_frame(self, jpeg_data, frame_id=None, flags=0):
+        """Send a JPEG frame (or with FLAG_SHM a slot reference), returns its frame id"""
+        if frame_id is None:
+            frame_id = self.next_frame_id
+            self.next_frame_id = (self.next_frame_id + 1) & 0xFFFFFFFF
+        if self.protocol == PROTOCOL_LEGACY:
+            self.write_legacy(jpeg_data, len(memoryview(jpeg_data).cast('B')))
+        else:
+            self.write(MSG_FRAME, jpeg_data, frame_id=frame_id, flags=flags)
+        await self.writer.drain()
+        return frame_id
+
+    async def send_command(self, command):
+        if self.protocol == PROTOCOL_LEGACY:
+            data = pickle.dumps(command)
+            self.write_legacy(data, len(data) | LEGACY_COMMAND_BIT)
+        else:
+            self.write(MSG_COMMAND, json.dumps(command).encode('utf-8'))
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
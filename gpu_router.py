@@ -0,0 +1,278 @@
+"""
+Consistent-hash routing of try-on sessions over a pool of GPU workers (network_rtv_server.py)
+
+Workers are listed in GPU_WORKERS as host:port[:status_port], comma separated. Every worker
+owns GPU_ROUTER_REPLICAS points on a hash ring. A session is routed by its garment, so all
+shoppers wearing one garment land on the same worker and find its model resident; with
+GPU_GARMENT_SPREAD > 1 the session key picks one of the garment's first N workers, spreading
+a very popular garment. Workers that fail their health check (GET /status) or refuse a
+connection are skipped, which moves only their sessions to the next worker on the ring;
+a reconnecting session returns to its previous worker while that one stays healthy.
+
+Try it locally with CPU stub workers:
+    python gpu_stub_worker.py --port 9101 & python gpu_stub_worker.py --port 9201
+    GPU_WORKERS=127.0.0.1:9101,127.0.0.1:9201 python ecommerce_app.py
+"""
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import Counter, OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROUTER_REPLICAS = int(os.getenv('GPU_ROUTER_REPLICAS', 100))
+GARMENT_SPREAD = int(os.getenv('GPU_GARMENT_SPREAD', 1))
+HEALTH_INTERVAL = float(os.getenv('GPU_HEALTH_INTERVAL', 5.0))
+# how long a disconnected session keeps its worker for a reconnect
+STICKY_TTL = float(os.getenv('GPU_STICKY_TTL', 600))
+MAX_STICKY_SESSIONS = 10000
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+def parse_workers(spec, default_status_offset=1):
+    """'host:port[:status_port],...' -> list of GPUWorker"""
+    workers = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(':')
+        port = int(parts[1])
+        status_port = int(parts[2]) if len(parts) > 2 else port + default_status_offset
+        workers.append(GPUWorker(parts[0], port, status_port))
+    return workers
+
+
+class GPUWorker:
+    def __init__(self, host, port, status_port=None, unix_path=None):
+        self.host = host
+        self.port = port
+        # same-host worker: connect through its unix socket instead of TCP
+        self.unix_path = unix_path or None
+        self.status_port = status_port if status_port is not None else port + 1
+        self.name = f'{host}:{port}'
+        # optimistic until the first health check
+        self.healthy = True
+        self.ready = True
+        self.sessions = 0
+        self.max_clients = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_check = None
+        # sessions this web process currently has on the worker
+        self.routed = 0
+        # garment model versions by garment index, from the last health check
+        self.model_versions = []
+
+    def has_capacity(self):
+        return self.max_clients <= 0 or max(self.sessions, self.routed) < self.max_clients
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'healthy': self.healthy,
+            'ready': self.ready,
+            'sessions': self.sessions,
+            'max_clients': self.max_clients,
+            'routed': self.routed,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_check': self.last_check,
+        }
+
+
+class HashRing:
+    """Consistent hash ring; adding or removing a worker only moves the keys it owns"""
+
+    def __init__(self, replicas=ROUTER_REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = dict()
+
+    def add(self, name):
+        for i in range(self.replicas):
+            point = hash_key(f'{name}#{i}')
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+                self.owners[point] = name
+
+    def remove(self, name):
+        self.points = [p for p in self.points if self.owners[p] != name]
+        self.owners = {p: n for p, n in self.owners.items() if n != name}
+
+    def walk(self, key):
+        """Distinct worker names clockwise from the key's position"""
+        if not self.points:
+            return []
+        start = bisect.bisect(self.points, hash_key(key))
+        names = []
+        for i in range(len(self.points)):
+            name = self.owners[self.points[(start + i) % len(self.points)]]
+            if name not in names:
+                names.append(name)
+        return names
+
+
+class GPURouter:
+    def __init__(self, workers, replicas=ROUTER_REPLICAS, garment_spread=GARMENT_SPREAD,
+                 health_interval=HEALTH_INTERVAL, sticky_ttl=STICKY_TTL):
+        self.lock = threading.Lock()
+        self.ring = HashRing(replicas)
+        self.workers = dict()
+        self.garment_spread = max(garment_spread, 1)
+        self.health_interval = health_interval
+        self.sticky_ttl = sticky_ttl
+        # session key -> (garment, worker name, last seen)
+        self.assignments = OrderedDict()
+        self.counters = Counter()
+        self.health_thread = None
+        for worker in workers:
+            self.add_worker(worker)
+
+    def add_worker(self, worker):
+        with self.lock:
+            self.workers[worker.name] = worker
+            self.ring.add(worker.name)
+        print(f"✓ GPU worker {worker.name} added to the ring")
+
+    def remove_worker(self, name):
+        with self.lock:
+            self.workers.pop(name, None)
+            self.ring.remove(name)
+        print(f"GPU worker {name} removed from the ring")
+
+    def route(self, session_key, garment_id, record=True):
+        """Workers to try for a session, best first.
+
+        The sticky worker comes first when it is healthy, then the garment's workers in
+        ring order: healthy ones with free slots, then full ones, then unhealthy ones as a
+        last resort (a health check may simply not have caught up yet). record=False only
+        looks the route up, without counting it.
+        """
+        garment_key = f'garment:{garment_id}' if garment_id is not None else f'session:{session_key}'
+        with self.lock:
+            names = self.ring.walk(garment_key)
+            healthy = [n for n in names if self.workers[n].healthy and self.workers[n].ready]
+            if len(healthy) > 1 and self.garment_spread > 1:
+                spread = min(self.garment_spread, len(healthy))
+                first = healthy[hash_key(str(session_key)) % spread]
+                healthy.remove(first)
+                healthy.insert(0, first)
+            ordered = [n for n in healthy if self.workers[n].has_capacity()]
+            ordered += [n for n in healthy if n not in ordered]
+            ordered += [n for n in names if n not in ordered]
+
+            if record and healthy and ordered[0] != healthy[0]:
+                self.counters['spilled'] += 1
+
+            sticky = self.assignments.get(session_key)
+            if sticky is not None and sticky[0] == garment_id and time.time() - sticky[2] <= self.sticky_ttl:
+                if sticky[1] in healthy:
+                    ordered.remove(sticky[1])
+                    ordered.insert(0, sticky[1])
+                    if record:
+                        self.counters['sticky'] += 1
+                elif record:
+                    # its worker left or failed: only sessions like this one move
+                    self.counters['remapped'] += 1
+            if record:
+                self.counters['routed'] += 1
+            return [self.workers[n] for n in ordered]
+
+    def assign(self, session_key, garment_id, worker):
+        with self.lock:
+            self.assignments[session_key] = (garment_id, worker.name, time.time())
+            self.assignments.move_to_end(session_key)
+            while len(self.assignments) > MAX_STICKY_SESSIONS:
+                self.assignments.popitem(last=False)
+            worker.routed += 1
+
+    def release(self, session_key, worker):
+        """Session disconnected; it keeps its worker for a reconnect within the sticky TTL"""
+        with self.lock:
+            worker.routed = max(worker.routed - 1, 0)
+            assignment = self.assignments.get(session_key)
+            if assignment is not None and assignment[1] == worker.name:
+                self.assignments[session_key] = (assignment[0], worker.name, time.time())
+
+    def mark_failed(self, worker, error):
+        with self.lock:
+            worker.healthy = False
+            worker.failures += 1
+            worker.last_error = str(error)
+            self.counters['failovers'] += 1
+        print(f"✗ GPU worker {worker.name} marked unhealthy: {error}")
+
+    def check_health(self, worker, timeout=1.0):
+        url = f'http://{worker.host}:{worker.status_port}/status'
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                status = json.loads(response.read().decode('utf-8'))
+            error = None
+        except Exception as e:
+            status, error = None, e
+        with self.lock:
+            was_healthy = worker.healthy
+            worker.last_check = round(time.time(), 1)
+            if status is None:
+                worker.healthy = False
+                worker.failures += 1
+                worker.last_error = str(error)
+            else:
+                worker.healthy = status.get('state') != 'failed'
+                worker.ready = bool(status.get('ready', True))
+                worker.sessions = status.get('sessions', 0)
+                worker.max_clients = status.get('max_clients', 0)
+                worker.model_versions = status.get('model_versions', [])
+                worker.last_error = None
+        if was_healthy != worker.healthy:
+            print(f"{'✓' if worker.healthy else '✗'} GPU worker {worker.name} is "
+                  f"{'healthy' if worker.healthy else 'unhealthy'}" + (f": {error}" if error else ""))
+        return worker.healthy
+
+    def run_health_checks(self):
+        while True:
+            with self.lock:
+                workers = list(self.workers.values())
+            for worker in workers:
+                self.check_health(worker)
+            time.sleep(self.health_interval)
+
+    def start_health_checks(self):
+        if self.health_thread is None:
+            self.health_thread = threading.Thread(target=self.run_health_checks, daemon=True)
+            self.health_thread.start()
+        return self.health_thread
+
+    def model_versions(self):
+        """Garment model versions by index that all healthy workers agree on (None where they differ)"""
+        with self.lock:
+            reported = [w.model_versions for w in self.workers.values() if w.healthy and w.model_versions]
+        if not reported:
+            return []
+        versions = []
+        for i in range(max(len(v) for v in reported)):
+            seen = set(v[i] if i < len(v) else None for v in reported)
+            versions.append(seen.pop() if len(seen) == 1 else None)
+        return versions
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'workers': [w.to_dict() for w in self.workers.values()],
+                'garment_spread': self.garment_spread,
+                'sticky_sessions': len(self.assignments),
+                'routed': self.counters['routed'],
+                'sticky': self.counters['sticky'],
+                'remapped': self.counters['remapped'],
+                'spilled': self.counters['spilled'],
+                'failovers': self.counters['failovers'],
+            }
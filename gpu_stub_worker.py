@@ -0,0 +1,203 @@
+"""
+CPU stand-in for a GPU worker (network_rtv_server.py), for testing routing on one machine
+
+Speaks the same wire protocol and serves the same GET /status and POST /still endpoints, but
+instead of the try-on pipeline it stamps the worker name and garment onto each frame or
+photo (in layer output mode: a labelled box in the middle of the frame). Run a few of them and list them in GPU_WORKERS (see gpu_router.py):
+    python gpu_stub_worker.py --port 9101 --max_clients 4
+    python gpu_stub_worker.py --port 9201 --max_clients 4
+"""
+import argparse
+import base64
+import json
+import socket
+import urllib.parse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from gpu_protocol import ProtocolSocket, MSG_COMMAND, MSG_FRAME, LAYER_HEADER, OUTPUT_FRAME, OUTPUT_LAYER
+
+
+class StubStatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/status'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.worker.get_status()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip('/') != '/still':
+            self.send_error(404)
+            return
+        garments = urllib.parse.parse_qs(url.query).get('garments', [''])[0]
+        photo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        code, payload = self.server.worker.still(photo, [int(g) for g in garments.split(',') if g])
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubWorker:
+    def __init__(self, port, status_port, max_clients=4, delay_ms=20.0, switch_ms=50.0, model_version='stub1'):
+        self.name = f'stub:{port}'
+        # reported for every garment; change it to see the web tier drop its cached results
+        self.model_version = model_version
+        self.port = port
+        self.max_clients = max_clients
+        self.delay_ms = delay_ms
+        self.switch_ms = switch_ms
+        self.sessions = 0
+        self.garments = set()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.status_server = ThreadingHTTPServer(('0.0.0.0', status_port), StubStatusHandler)
+        self.status_server.daemon_threads = True
+        self.status_server.worker = self
+        t = threading.Thread(target=self.status_server.serve_forever, daemon=True)
+        t.start()
+        print(f"✓ Stub worker status on http://0.0.0.0:{status_port}/status")
+
+    def get_status(self):
+        with self.lock:
+            return {
+                'state': 'ready',
+                'ready': True,
+                'progress': 1.0,
+                'uptime_s': round(time.time() - self.start_time, 1),
+                'sessions': self.sessions,
+                'max_clients': self.max_clients,
+                'worker': self.name,
+                'garments': {'gpu_garments': sorted(self.garments)},
+                'model_versions': [self.model_version] * 6,
+            }
+
+    def still(self, jpeg_data, garment_ids):
+        """POST /still: the photo stamped once per garment"""
+        photo = cv2.imdecode(np.frombuffer(jpeg_data, np.uint8), cv2.IMREAD_COLOR)
+        if photo is None:
+            return 400, {'error': 'photo is not a decodable image'}
+        start = time.perf_counter()
+        time.sleep(self.delay_ms / 1000.0)
+        results = dict()
+        for garment_id in garment_ids:
+            image = photo.copy()
+            cv2.putText(image, f'{self.name} garment {garment_id}', (20, 40), cv2.FONT_HERSHEY_SIMPLEX,
+                        1.0, (0, 255, 0), 2)
+            _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+            results[str(garment_id)] = base64.b64encode(buffer).decode('ascii')
+        versions = {str(g): self.model_version for g in garment_ids}
+        return 200, {'results': results, 'versions': versions, 'total_ms': round((time.perf_counter() - start) * 1000.0, 1)}
+
+    def stub_layer(self, frame_shape, garment_id, size=256):
+        # half-transparent box with the label, centred; the view is the frame itself
+        colours = np.full((size, size, 3), (40, 160, 40), np.uint8)
+        cv2.putText(colours, f'{self.name}', (10, size // 2 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+        cv2.putText(colours, f'garment {garment_id}', (10, size // 2 + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6,
+                    (255, 255, 255), 2)
+        alpha = np.full((size, size, 3), 160, np.uint8)
+        _, buffer = cv2.imencode('.jpg', np.hstack([colours, alpha]), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        h, w = frame_shape[:2]
+        layer_transform = (1.0, 0.0, (w - size) / 2.0, 0.0, 1.0, (h - size) / 2.0)
+        view_transform = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+        return LAYER_HEADER.pack(*layer_transform, *view_transform, w, h, size, size) + buffer.tobytes()
+
+    def serve(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('0.0.0.0', self.port))
+        server.listen(self.max_clients)
+        print(f"🚀 Stub worker {self.name} listening on port {self.port}")
+        while True:
+            client_socket, addr = server.accept()
+            with self.lock:
+                full = self.sessions >= self.max_clients
+                if not full:
+                    self.sessions += 1
+            if full:
+                print(f"✗ Rejecting {addr}: {self.max_clients} sessions already active")
+                client_socket.close()
+                continue
+            t = threading.Thread(target=self.handle_client, args=(client_socket, addr), daemon=True)
+            t.start()
+
+    def handle_client(self, client_socket, addr):
+        conn = ProtocolSocket(client_socket)
+        garment_id = 0
+        print(f"✓ {self.name}: client {addr} connected")
+        try:
+            while True:
+                message = conn.receive()
+                if message is None:
+                    break
+                if message.msg_type == MSG_COMMAND:
+                    command = message.json()
+                    if command.get('type') == 'change_garment':
+                        garment_id = command['id']
+                        time.sleep(self.switch_ms / 1000.0)
+                        with self.lock:
+                            self.garments.add(garment_id)
+                        conn.send_reply({'type': 'garment_changed', 'id': garment_id, 'switch_ms': self.switch_ms,
+                                         'stage_ms': self.switch_ms, 'source_tier': 'stub'})
+                    elif command.get('type') == 'set_output' and command.get('mode') in (OUTPUT_FRAME, OUTPUT_LAYER):
+                        conn.output_mode = command['mode']
+                        conn.send_reply({'type': 'output_set', 'mode': conn.output_mode})
+                    elif command.get('type') == 'set_result_quality':
+                        conn.result_quality = min(max(int(command['jpeg_quality']), 30), 95)
+                        conn.send_reply({'type': 'result_quality_set', 'jpeg_quality': conn.result_quality})
+                elif message.msg_type == MSG_FRAME:
+                    frame = cv2.imdecode(np.frombuffer(message.payload, np.uint8), cv2.IMREAD_COLOR)
+                    if frame is None:
+                        continue
+                    time.sleep(self.delay_ms / 1000.0)
+                    if conn.output_mode == OUTPUT_LAYER:
+                        conn.send_layer(self.stub_layer(frame.shape, garment_id))
+                        continue
+                    cv2.putText(frame, f'{self.name} garment {garment_id}', (20, 40), cv2.FONT_HERSHEY_SIMPLEX,
+                                1.0, (0, 255, 0), 2)
+                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, conn.result_quality or 90])
+                    conn.send_result(buffer)
+        except Exception as e:
+            print(f"Client error: {e}")
+        finally:
+            client_socket.close()
+            with self.lock:
+                self.sessions -= 1
+            print(f"✗ {self.name}: client {addr} disconnected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU stub GPU worker for routing tests')
+    parser.add_argument('--port', type=int, default=9999, help='TCP port to listen on')
+    parser.add_argument('--status_port', type=int, default=None, help='HTTP status port (default: --port + 1)')
+    parser.add_argument('--max_clients', type=int, default=4, help='sessions served concurrently')
+    parser.add_argument('--delay_ms', type=float, default=20.0, help='simulated processing time per frame')
+    parser.add_argument('--switch_ms', type=float, default=50.0, help='simulated garment switch time')
+    parser.add_argument('--model_version', type=str, default='stub1', help='garment model version to report')
+    args = parser.parse_args()
+    status_port = args.status_port if args.status_port is not None else args.port + 1
+    worker = StubWorker(args.port, status_port, max_clients=args.max_clients, delay_ms=args.delay_ms,
+                        switch_ms=args.switch_ms, model_version=args.model_version)
+    try:
+        worker.serve()
+    except KeyboardInterrupt:
+        print("Stub worker stopped")
+
+
+if __name__ == '__main__':
+    main()
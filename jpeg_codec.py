@@ -0,0 +1,168 @@
+"""
+Shared JPEG codec pool for the serving path
+
+JPEG decode and encode (cv2.imdecode / cv2.imencode) release the GIL, so a few worker
+threads can run them in parallel with the threads that drive the GPU. Serving threads
+submit their codec work to one pool instead of each running its own, so under
+multi-session load the JPEG work uses a fixed number of cores and leaves the remaining
+cores to the pipeline's CPU stages. The web tier uses a pool of its own for the base64
+work of browsers that send data URLs.
+
+When the caller will scale an image down anyway, decode() may let libjpeg decode it at
+1/2, 1/4 or 1/8 size (IMREAD_REDUCED_COLOR_*), which skips most of the IDCT work. The
+JPEG header is read first to find the size.
+
+Every job records its queue wait and run time per operation (decode, encode, ...);
+get_stats() reports the count, mean and p95 of each.
+"""
+import os
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+CODEC_THREADS = min(4, os.cpu_count() or 1)
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# start-of-frame markers of the baseline, extended, progressive and lossless processes
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data):
+    """(height, width) from a JPEG's frame header, or None if it is not a readable JPEG"""
+    data = memoryview(data)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = struct.unpack_from('!H', data, i + 2)[0]
+        if marker in SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height, width = struct.unpack_from('!HH', data, i + 5)
+            return (height, width) if height and width else None
+        if marker == 0xDA:
+            # image data before any frame header
+            return None
+        i += 2 + length
+    return None
+
+
+def reduction_for(side, target):
+    """Largest decode reduction (1, 2, 4 or 8) that keeps side at least target pixels"""
+    for factor in (8, 4, 2):
+        if side // factor >= target:
+            return factor
+    return 1
+
+
+class JPEGCodecPool:
+    def __init__(self, threads=CODEC_THREADS, window=500):
+        self.threads = max(int(threads), 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='jpeg-codec')
+        self.window = window
+        self.lock = threading.Lock()
+        # operation -> counters and recent wait / run times in ms
+        self.ops = dict()
+        self.reduced = {2: 0, 4: 0, 8: 0}
+
+    def submit(self, op, fn, *args):
+        """Run fn(*args) on the pool; returns its concurrent.futures.Future"""
+        return self.executor.submit(self.timed, op, time.perf_counter(), fn, *args)
+
+    def run(self, op, fn, *args):
+        """Run fn(*args) on the pool and wait for it"""
+        return self.submit(op, fn, *args).result()
+
+    def timed(self, op, submitted, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            end = time.perf_counter()
+            self.record(op, (start - submitted) * 1000.0, (end - start) * 1000.0)
+
+    def record(self, op, wait_ms, run_ms):
+        with self.lock:
+            stats = self.ops.get(op)
+            if stats is None:
+                stats = self.ops[op] = {'count': 0, 'wait_ms': deque(maxlen=self.window),
+                                        'run_ms': deque(maxlen=self.window)}
+            stats['count'] += 1
+            stats['wait_ms'].append(wait_ms)
+            stats['run_ms'].append(run_ms)
+
+    def decode(self, data, reduction=None):
+        """BGR image of an encoded frame, or None if it does not decode.
+
+        reduction(height, width) -> 1, 2, 4 or 8 tells how much smaller the caller can use
+        the image, e.g. because it scales it down right after; the JPEG is then decoded at
+        that fraction of its size.
+        """
+        return self.run('decode', self.decode_now, data, reduction)
+
+    def decode_now(self, data, reduction=None):
+        factor = 1
+        if reduction is not None:
+            size = jpeg_size(data)
+            if size is not None:
+                factor = reduction(*size)
+        if factor != 1:
+            with self.lock:
+                self.reduced[factor] += 1
+        return cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_FLAGS[factor])
+
+    def encode(self, image, quality=90):
+        """JPEG of a BGR image, as the encoder's uint8 buffer"""
+        return self.run('encode', encode_jpeg, image, quality)
+
+    def encode_many(self, images, quality=90):
+        """Encode several images in parallel, in order"""
+        futures = [self.submit('encode', encode_jpeg, image, quality) for image in images]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'threads': self.threads,
+                     'reduced_decodes': {f'1/{factor}': count for factor, count in self.reduced.items()}}
+            for op, op_stats in self.ops.items():
+                run_ms, wait_ms = op_stats['run_ms'], op_stats['wait_ms']
+                stats[op] = {
+                    'count': op_stats['count'],
+                    'avg_ms': round(float(np.mean(run_ms)), 2),
+                    'p95_ms': round(float(np.percentile(run_ms, 95)), 2),
+                    'avg_wait_ms': round(float(np.mean(wait_ms)), 2),
+                    'p95_wait_ms': round(float(np.percentile(wait_ms, 95)), 2),
+                }
+            return stats
+
+    def format_stats(self):
+        stats = self.get_stats()
+        ops = [f"{op} {s['avg_ms']:.1f}ms (p95 {s['p95_ms']:.1f}ms, wait {s['avg_wait_ms']:.1f}ms)"
+               for op, s in stats.items() if isinstance(s, dict) and 'count' in s]
+        reduced = sum(stats['reduced_decodes'].values())
+        return f"{stats['threads']} threads | {' | '.join(ops) or 'idle'} | {reduced} reduced decodes"
+
+
+def encode_jpeg(image, quality=90):
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError(f"could not encode a {image.shape} image as JPEG")
+    return buffer
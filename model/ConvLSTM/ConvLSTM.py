@@ -80,6 +80,19 @@ class ConvLSTM(nn.Module):
         self.c = None
         self.h = None
 
+    def get_state(self):
+        # (h, c) lists of the current stream, or None before its first frame
+        return None if self.c is None else (list(self.h), list(self.c))
+
+    def set_state(self, state):
+        # continue a stream from get_state(); None starts a new one
+        if state is None:
+            self.reset()
+            return
+        device = next(self.parameters()).device
+        self.h = [t.to(device) for t in state[0]]
+        self.c = [t.to(device) for t in state[1]]
+
     def init_hidden(self, batch_size, height, width):
         h = [torch.zeros(batch_size, self.hidden_channels, height, width).to(next(self.parameters()).device)
              for _ in range(self.num_layers)]
@@ -71,7 +71,7 @@ def get_palette(num_cls):
     return palette
 
 class DensePoseExtractor(DumpAction):
-    def __init__(self):
+    def __init__(self, model_weights=None):
         self.parser = argparse.ArgumentParser()
 
         self.dp_model = DumpAction()
@@ -79,7 +79,8 @@ class DensePoseExtractor(DumpAction):
         self.args = self.parser.parse_args([])
         opts = []
         self.cfg = './model/DensePose/configs/densepose_rcnn_R_50_FPN_s1x.yaml'
-        self.model = 'https://dl.fbaipublicfiles.com/densepose/densepose_rcnn_R_50_FPN_s1x/165712039/model_final_162be9.pkl'
+        # local weights (e.g. from util/weight_cache.py) avoid downloading at startup
+        self.model = model_weights or 'https://dl.fbaipublicfiles.com/densepose/densepose_rcnn_R_50_FPN_s1x/165712039/model_final_162be9.pkl'
         cfg = self.dp_model.setup_config(self.cfg, self.model, self.args, opts)
         self.predictor = DefaultPredictor(cfg)
         self.palette = np.array(get_palette(25), np.uint8).reshape(-1,3)
@@ -51,6 +51,14 @@ class BaseModel(torch.nn.Module):
         self.netG.load_state_dict(torch.load(path,weights_only=True))
     # helper loading function that can be used by subclasses
     def load_network(self, network, network_label, epoch_label, save_dir=''):        
+        store = getattr(self.opt, 'checkpoint_store', None)
+        if store is not None and not save_dir:
+            state_dict = store.state_dict(self.opt.name, network_label, epoch_label)
+            if state_dict is not None:
+                # CPU networks take the mapped tensors as they are, so their weights stay shared
+                on_cpu = all(not p.is_cuda for p in network.parameters())
+                network.load_state_dict(state_dict, assign=on_cpu)
+                return
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
         if not save_dir:
             save_dir = self.save_dir
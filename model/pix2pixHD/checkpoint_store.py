@@ -0,0 +1,144 @@
+"""
+Memory-mapped checkpoint store for garment generators
+
+All weights live in one contiguous blob (<store>/weights.bin) described by an index
+(<store>/index.json). Tensors are mapped straight from the page cache, so several server
+processes on one host share a single copy of every garment and loading only reads the
+pages that are actually touched.
+
+Convert existing checkpoints with
+    python -m model.pix2pixHD.checkpoint_store --ckpt_dir ./rtv_ckpts
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+INDEX_NAME = 'index.json'
+BLOB_NAME = 'weights.bin'
+STORE_VERSION = 1
+ALIGNMENT = 64
+
+
+def entry_key(name, network_label='G', epoch_label='latest'):
+    return '%s/%s_net_%s' % (name, epoch_label, network_label)
+
+
+class CheckpointStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        if index.get('version') != STORE_VERSION:
+            raise ValueError(f"unsupported checkpoint store version {index.get('version')}")
+        self.entries = index['entries']
+        blob_path = os.path.join(store_dir, BLOB_NAME)
+        # copy-on-write mapping: pages stay shared with the page cache unless someone writes to them
+        self.blob = np.memmap(blob_path, dtype=np.uint8, mode='c') if os.path.getsize(blob_path) else None
+
+    @staticmethod
+    def open(store_dir):
+        """Return the store in store_dir, or None if there is none"""
+        if store_dir and os.path.isfile(os.path.join(store_dir, INDEX_NAME)):
+            return CheckpointStore(store_dir)
+        return None
+
+    def lookup(self, name, network_label='G', epoch_label='latest'):
+        """Index entry of a checkpoint, or None if missing or older than its .pth source"""
+        entry = self.entries.get(entry_key(name, network_label, epoch_label))
+        if entry is None:
+            return None
+        source = entry.get('source')
+        if source and os.path.isfile(source):
+            stat = os.stat(source)
+            if stat.st_size != entry['source_size'] or int(stat.st_mtime) != entry['source_mtime']:
+                print(f"Checkpoint store entry {entry_key(name, network_label, epoch_label)} is stale, "
+                      f"using {source}")
+                return None
+        return entry
+
+    def version(self, name, network_label='G', epoch_label='latest'):
+        """Content digest of a checkpoint; changes whenever the weights change"""
+        entry = self.lookup(name, network_label, epoch_label)
+        return entry['digest'] if entry is not None else None
+
+    def state_dict(self, name, network_label='G', epoch_label='latest'):
+        """State dict whose tensors are views into the mapped blob, or None if not in the store"""
+        entry = self.lookup(name, network_label, epoch_label)
+        if entry is None:
+            return None
+        state_dict = dict()
+        for key, t in entry['tensors'].items():
+            dtype = getattr(torch, t['dtype'])
+            count = int(np.prod(t['shape'], dtype=np.int64))
+            if count == 0:
+                state_dict[key] = torch.empty(t['shape'], dtype=dtype)
+                continue
+            state_dict[key] = torch.frombuffer(self.blob, dtype=dtype, count=count,
+                                               offset=t['offset']).view(t['shape'])
+        return state_dict
+
+
+def find_checkpoints(ckpt_dir, network_label='G'):
+    return sorted(glob.glob(os.path.join(ckpt_dir, '*', '*_net_%s.pth' % network_label)))
+
+
+def convert_checkpoints(ckpt_dir, store_dir=None, network_label='G'):
+    """Pack every <ckpt_dir>/<name>/<epoch>_net_<label>.pth into a store (default <ckpt_dir>/store)"""
+    if store_dir is None:
+        store_dir = os.path.join(ckpt_dir, 'store')
+    os.makedirs(store_dir, exist_ok=True)
+    blob_path = os.path.join(store_dir, BLOB_NAME)
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    entries = dict()
+    offset = 0
+    # write next to the old files and swap them in at the end; processes that still map
+    # the old blob keep a valid mapping
+    with open(blob_path + '.tmp', 'wb') as blob:
+        for path in find_checkpoints(ckpt_dir, network_label):
+            name = os.path.basename(os.path.dirname(path))
+            epoch_label = os.path.basename(path)[:-len('_net_%s.pth' % network_label)]
+            state_dict = torch.load(path, map_location='cpu', weights_only=True)
+            digest = hashlib.sha1()
+            tensors = dict()
+            for key, tensor in state_dict.items():
+                data = tensor.detach().contiguous().cpu().view(-1).view(torch.uint8).numpy()
+                padding = -offset % ALIGNMENT
+                blob.write(b'\0' * padding)
+                offset += padding
+                blob.write(data.tobytes())
+                digest.update(key.encode('utf-8'))
+                digest.update(data)
+                tensors[key] = {
+                    'offset': offset,
+                    'dtype': str(tensor.dtype).replace('torch.', ''),
+                    'shape': list(tensor.shape),
+                }
+                offset += data.nbytes
+            stat = os.stat(path)
+            entries[entry_key(name, network_label, epoch_label)] = {
+                'tensors': tensors,
+                'source': os.path.abspath(path),
+                'source_size': stat.st_size,
+                'source_mtime': int(stat.st_mtime),
+                'digest': digest.hexdigest(),
+            }
+            print(f"✓ {name}/{epoch_label}: {len(tensors)} tensors")
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'version': STORE_VERSION, 'entries': entries}, f, indent=1)
+    os.replace(blob_path + '.tmp', blob_path)
+    os.replace(index_path + '.tmp', index_path)
+    print(f"✓ Wrote {len(entries)} checkpoints ({offset / (1024 * 1024):.1f} MB) to {store_dir}")
+    return store_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert garment .pth checkpoints into a memory-mapped store')
+    parser.add_argument('--ckpt_dir', type=str, default='./rtv_ckpts', help='directory with one folder per garment')
+    parser.add_argument('--store', type=str, default=None, help='output directory (default <ckpt_dir>/store)')
+    args = parser.parse_args()
+    convert_checkpoints(args.ckpt_dir, args.store)
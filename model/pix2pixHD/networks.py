@@ -324,6 +324,12 @@ class RNNGenerator(nn.Module):
     def reset(self):
         self.rnn_model.reset()
 
+    def get_state(self):
+        return self.rnn_model.get_state()
+
+    def set_state(self, state):
+        self.rnn_model.set_state(state)
+
 
 
 
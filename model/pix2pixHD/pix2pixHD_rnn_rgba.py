@@ -16,6 +16,13 @@ class Pix2PixHD_RNN_RGBA(Pix2PixHDModel):
     def reset(self):
         self.netG.reset()
 
+    def get_state(self):
+        # recurrent state of the current stream (see VITON.temporal_state.TemporalState)
+        return self.netG.get_state()
+
+    def set_state(self, state):
+        self.netG.set_state(state)
+
     def initialize(self, opt):
         BaseModel.initialize(self, opt)
         if opt.resize_or_crop != 'none' or not opt.isTrain:  # when training at full res this causes OOM
@@ -2,21 +2,138 @@ import sys
 import os
 import cv2
 import socket
-import pickle
-import struct
 import threading
 import time
+import queue
+import argparse
+import itertools
+import json
+import base64
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import numpy as np
 
 # Import RTV modules
-from util.image_warp import crop2_169, resize_img
+from util.frame_buffers import FrameBuffers, FramePreprocessor
+from util.image_warp import crop2_169
+from composition.naive_overlay import erode
 from VITON.viton_upperbody import FrameProcessor
+from VITON.frame_pipeline import PipelinedFrameProcessor
+from VITON.startup import StartupStatus
+from VITON.garment_prefetcher import GarmentPrefetcher
+from VITON.inference_scheduler import InferenceScheduler, INTERACTIVE, STILL, PRIORITY_CLASSES
+from VITON.degradation import DegradationController
+from gpu_protocol import (ProtocolSocket, MSG_COMMAND, MSG_FRAME, FLAG_SHM, LAYER_HEADER, OUTPUT_FRAME,
+                          OUTPUT_LAYER, PROTOCOL_V2)
+from shm_transport import FrameRing, KIND_RAW, KIND_JPEG, slot_of
+from jpeg_codec import JPEGCodecPool, CODEC_THREADS, reduction_for
+
+# largest still photo accepted by POST /still, and the (height, width) it is cropped to 9:16
+# and scaled to: the portrait stream's view, so stills share a renderer size with it
+MAX_STILL_BYTES = 16 * 1024 * 1024
+STILL_SHAPE = (1024, 576)
+# rows of the 1280x720 stream's view; smaller landscape frames are scaled up to it
+SERVING_HEIGHT = 720
+
+
+class ClientSession:
+    """Per-connection state for the concurrent server mode"""
+    _ids = itertools.count(1)
+
+    def __init__(self, addr, garment_id=0, temporal_state=None):
+        self.session_id = next(ClientSession._ids)
+        self.addr = addr
+        self.garment_id = garment_id
+        self.frame_count = 0
+        self.start_time = time.time()
+        # newest garment switch request; older ones in flight are dropped
+        self.switch_generation = 0
+        # scheduling class; catalog render jobs announce themselves with a set_priority command
+        self.priority_class = INTERACTIVE
+        # pose filters and other frame-to-frame history (VITON.temporal_state.TemporalState)
+        self.temporal_state = temporal_state
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """GET /status: startup readiness and progress as JSON (served from the start of startup).
+
+    POST /still?garments=0,3,5&client=<id>: the body is one JPEG photo, the answer has the photo
+    wearing each garment as base64 JPEG and each garment's model version (see handle_still).
+    """
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/status'):
+            self.send_error(404)
+            return
+        self.send_json(200, self.server.rtv_server.get_status())
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip('/') != '/still':
+            self.send_error(404)
+            return
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            garment_ids = [int(g) for g in query.get('garments', [''])[0].split(',') if g.strip()]
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_json(400, {'error': 'garments must be comma separated garment indices'})
+            return
+        if length <= 0 or length > MAX_STILL_BYTES:
+            self.send_json(413 if length > 0 else 400, {'error': f'photo must be 1 to {MAX_STILL_BYTES} bytes'})
+            return
+        client = query.get('client', [self.client_address[0]])[0]
+        code, payload = self.server.rtv_server.handle_still(self.rfile.read(length), garment_ids, client)
+        self.send_json(code, payload)
+
+    def log_message(self, format, *args):
+        pass
+
 
 class NetworkRTVServer:
-    def __init__(self, garment_id_list, port=9999):
+    def __init__(self, garment_id_list, port=9999, pipelined=False, pipeline_queue_size=2, max_clients=1,
+                 batch_generator=False, max_batch_size=4, batch_window_ms=5.0, gpu_budget_mb=2048,
+                 host_budget_mb=8192, residency_policy='lru', checkpoint_store=None, weight_cache_dir=None,
+                 status_port=None, prefetch_plan=None, prefetch_refresh_s=300.0, max_inflight=2,
+                 class_limits=None, frame_slo_ms=0, unix_socket=None, still_max_garments=32, motion_gate=None,
+                 flow_propagation=None, pose_prediction=None, codec_threads=CODEC_THREADS):
         self.port = port
+        self.garment_count = len(garment_id_list)
+        self.still_max_garments = still_max_garments
+        # optional unix domain socket for a web tier on the same host (with shared-memory frames)
+        self.unix_socket_path = unix_socket
+        self.unix_socket = None
+        # single-client modes serve one connection at a time across both listeners
+        self.serial_lock = threading.Lock()
+        self.max_clients = max_clients
+        self.sessions = dict()
+        # admitted sessions, counted from accept() until their handler exits, so connections
+        # accepted back to back cannot all pass the max_clients check before registering
+        self.session_slots = 0
+        self.sessions_lock = threading.Lock()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.frame_processor = None
+        # JPEG decode and encode of all connections run on one pool of GIL-free worker threads
+        self.codec = JPEGCodecPool(codec_threads)
+        # frame-sized arrays of preprocessing and the ROI warps are reused from frame to frame;
+        # frames of a reduced capture size (stream_quality.py) are scaled back to the 720-row view
+        self.frame_buffers = FrameBuffers()
+        self.preprocessor = FramePreprocessor(self.frame_buffers, min_height=SERVING_HEIGHT)
+
+        # readiness can be polled while the models are still loading
+        self.startup_status = StartupStatus()
+        self.status_server = None
+        if status_port:
+            self.start_status_server(status_port)
         
         # Initialize RTV FrameProcessor (same as in rtl_demo.py)
         print("Initializing RTV FrameProcessor...")
@@ -37,14 +154,30 @@ class NetworkRTVServer:
                     break
         
         print(f"Using checkpoint directory: {ckpt_dir}")
+        # memory-mapped store written by model/pix2pixHD/checkpoint_store.py, used when present
+        if checkpoint_store is None:
+            checkpoint_store = os.path.join(ckpt_dir, "store")
         if not os.path.exists(ckpt_dir):
             print(f"WARNING: Checkpoint directory does not exist: {ckpt_dir}")
             print("You may need to:")
             print("1. Download pre-trained checkpoints")
             print("2. Train new models using the training_instructions.md")
+
+        # optional popularity plan from the web tier: preload likely garments first
+        self.prefetcher = None
+        preload_order = None
+        if prefetch_plan:
+            self.prefetcher = GarmentPrefetcher(garment_id_list, prefetch_plan, refresh_s=prefetch_refresh_s)
+            self.prefetcher.refresh()
+            preload_order = self.prefetcher.ranked_ids()
             
         try:
-            self.frame_processor = FrameProcessor(garment_id_list, ckpt_dir=ckpt_dir)
+            self.frame_processor = FrameProcessor(garment_id_list, ckpt_dir=ckpt_dir, gpu_budget_mb=gpu_budget_mb,
+                                                  host_budget_mb=host_budget_mb, residency_policy=residency_policy,
+                                                  checkpoint_store_dir=checkpoint_store, weight_cache_dir=weight_cache_dir,
+                                                  frame_shape=self.serving_frame_shape(),
+                                                  startup_status=self.startup_status,
+                                                  preload_order=preload_order, frame_buffers=self.frame_buffers)
         except Exception as e:
             print(f"ERROR: Failed to initialize FrameProcessor: {e}")
             print("\nTroubleshooting steps:")
@@ -54,59 +187,248 @@ class NetworkRTVServer:
             print("4. Follow training_instructions.md to train new models")
             raise
         print("✓ RTV FrameProcessor initialized")
+        if self.prefetcher is not None:
+            self.prefetcher.start(self.frame_processor.residency)
+
+        # Optional pipelined mode: stages run on their own workers so CPU and GPU work overlap
+        self.pipeline = None
+        if pipelined:
+            self.pipeline = PipelinedFrameProcessor(self.frame_processor, queue_size=pipeline_queue_size)
+            print(f"✓ Pipelined mode enabled (queue size {pipeline_queue_size})")
+
+        # Optional dynamic batching of generator calls across concurrent sessions
+        if batch_generator:
+            self.frame_processor.enable_batching(max_batch_size=max_batch_size, batch_window_ms=batch_window_ms)
+            print(f"✓ Generator batching enabled (max batch {max_batch_size}, window {batch_window_ms}ms)")
+
+        # Optional motion gating: near-static frames reuse the last garment layer
+        if motion_gate is not None:
+            gate = self.frame_processor.enable_motion_gate(**motion_gate)
+            print(f"✓ Motion gating enabled (still < {gate.still_threshold}, moving > {gate.move_threshold} "
+                  f"grey levels, refresh every {gate.max_skip} skipped frames)")
+
+        # Optional flow propagation: the generator runs on keyframes, optical flow carries its output between them
+        if flow_propagation is not None:
+            propagator = self.frame_processor.enable_flow_propagation(**flow_propagation)
+            print(f"✓ Flow propagation enabled (keyframe at least every {propagator.max_interval + 1} frames, "
+                  f"drift > {propagator.max_error} grey levels, motion > {propagator.max_motion}px)")
+
+        # Optional pose extrapolation: reused poses are moved on to the frame they dress
+        if pose_prediction is not None:
+            predictor = self.frame_processor.enable_pose_prediction(**pose_prediction)
+            print(f"✓ Pose prediction enabled (at most {predictor.max_horizon_ms:.0f}ms ahead)")
+        
+        # Fair-share scheduling of concurrent sessions in front of the FrameProcessor
+        self.scheduler = None
+        if self.is_concurrent():
+            self.scheduler = InferenceScheduler(max_inflight=max_inflight, limits=class_limits)
+            limits = {c: q.limit for c, q in self.scheduler.classes.items()}
+            print(f"✓ Inference scheduler: {max_inflight} in flight, class limits {limits}")
         
-        # Load the first garment to GPU
-        print("Loading first garment to GPU...")
+        # Optional SLO-driven degradation: cheaper quality levels and admission control under load
+        self.degradation = None
+        if frame_slo_ms > 0:
+            self.degradation = DegradationController(frame_slo_ms)
+            print(f"✓ Frame-time SLO {frame_slo_ms}ms, degradation ladder: "
+                  f"{[level.name for level in self.degradation.ladder]}")
+        
+        # The first garment was loaded and warmed up during startup
         self.current_garment_id = 0
-        self.frame_processor.set_target_garment(self.current_garment_id)
+        if not self.is_concurrent():
+            self.frame_processor.switch_to_target_garment(self.current_garment_id)
         print(f"✓ Garment {self.current_garment_id} loaded")
+        print(f"Ready for connections! Startup: {self.startup_status.format_status()}")
         
-        # Wait a moment for the model to fully load
-        time.sleep(3)
-        print("Ready for connections!")
-        
-    def set_garment_id(self, garment_id):
-        """Change the current garment"""
+    def start_status_server(self, status_port):
+        self.status_server = ThreadingHTTPServer(('0.0.0.0', status_port), StatusRequestHandler)
+        self.status_server.daemon_threads = True
+        self.status_server.rtv_server = self
+        t = threading.Thread(target=self.status_server.serve_forever, args=())
+        t.daemon = True
+        t.start()
+        print(f"✓ Status endpoint on http://0.0.0.0:{status_port}/status")
+
+    def get_status(self):
+        status = self.startup_status.to_dict()
+        with self.sessions_lock:
+            status['sessions'] = len(self.sessions)
+        status['max_clients'] = self.max_clients
+        if self.frame_processor is not None:
+            status['garments'] = self.frame_processor.residency.get_stats()
+            # by garment index; the web tier keys its try-on result cache on these
+            status['model_versions'] = [self.frame_processor.garment_version(i) for i in range(self.garment_count)]
+            if self.frame_processor.motion_gate is not None:
+                status['motion'] = self.frame_processor.motion_gate.get_stats()
+            if self.frame_processor.flow_propagator is not None:
+                status['flow'] = self.frame_processor.flow_propagator.get_stats()
+            if self.frame_processor.pose_predictor is not None:
+                status['prediction'] = self.frame_processor.pose_predictor.get_stats()
+        if self.prefetcher is not None:
+            status['prefetch'] = self.prefetcher.get_stats()
+        if self.scheduler is not None:
+            status['scheduler'] = self.scheduler.get_stats()
+        if self.degradation is not None:
+            status['degradation'] = self.degradation.get_stats()
+        status['codec'] = self.codec.get_stats()
+        status['buffers'] = self.frame_buffers.get_stats()
+        return status
+
+    def serving_frame_shape(self):
+        # frame size after preprocess_frame for the 1280x720 stream the web tier sends
+        return self.preprocessor.out_shape((SERVING_HEIGHT, 1280))[:2]
+
+    def is_concurrent(self):
+        return self.max_clients > 1
+
+    def set_garment_id(self, garment_id, on_switched=None):
+        """Change the current garment; frames keep using the old one until the new one is staged"""
         self.current_garment_id = garment_id
-        self.frame_processor.set_target_garment(garment_id)
-        print(f"Switched to garment ID: {garment_id}")
+        self.frame_processor.set_target_garment(garment_id, on_switched)
+
+    def set_session_garment(self, session, garment_id, on_switched=None):
+        """Change the garment of one session in the background, keeping other sessions' models resident"""
+        session.switch_generation += 1
+        generation = session.switch_generation
+
+        def flip():
+            if generation != session.switch_generation:
+                return False
+            session.garment_id = garment_id
+            self.release_unused_garments()
+            return True
+
+        def switch():
+            try:
+                self.frame_processor.swap_garment(garment_id, flip, on_switched)
+            except Exception as e:
+                print(f"✗ Session {session.session_id} failed to switch to garment {garment_id}: {e}")
+
+        t = threading.Thread(target=switch, args=())
+        t.daemon = True
+        t.start()
+
+    def release_unused_garments(self):
+        with self.sessions_lock:
+            garment_ids = set(s.garment_id for s in self.sessions.values())
+        garment_ids.add(self.current_garment_id)
+        self.frame_processor.retain_garment_models(garment_ids)
+
+    def get_garment_name(self, garment_id):
+        garment_names = [
+            'Jacket 17', 'Jacket 18', 'Jacket 22',
+            'Lab Coat 03', 'Lab Coat 04', 'Lab Coat 07'
+        ]
+        return garment_names[garment_id] if 0 <= garment_id < len(garment_names) else f"Garment {garment_id}"
     
-    def process_frame_realtime(self, frame):
-        """Process frame with RTV (exactly like rtl_demo.py)"""
+    def preprocess_frame(self, frame, out=None):
+        """Apply same preprocessing as rtl_demo.py (mirror, portrait frames to 1024 rows, 9:16 crop).
+
+        Landscape frames with fewer than SERVING_HEIGHT rows are scaled up to it first.
+
+        The result is written to out, or else to the calling thread's reused buffer, which
+        stays valid until the thread preprocesses its next frame.
+        """
+        return self.preprocessor(frame, out)
+
+    def frame_reduction(self, height, width):
+        # preprocess_frame scales portrait frames down to 1024 rows; a larger JPEG can be decoded smaller
+        return reduction_for(height, 1024) if height > width else 1
+
+    def preprocess_transform(self, shape):
+        """preprocess_frame as an affine map: (2x3 received frame -> view, view width, view height)"""
+        return self.preprocessor.transform(shape)
+
+    def process_frame_realtime(self, frame, session=None, timings=None, state=None, layer_only=False):
+        """Process frame with RTV (exactly like rtl_demo.py).
+
+        With layer_only the garment layer is returned instead of the composited frame (None
+        when the frame gets no garment), for clients that composite themselves.
+        """
         try:
-            # Apply same preprocessing as rtl_demo.py
-            frame = cv2.flip(frame, 1)  # Mirror the image
-            frame = resize_img(frame, max_height=1024)
-            frame = crop2_169(frame)
+            frame = self.preprocess_frame(frame)
+            quality = self.degradation.quality if self.degradation is not None else None
             
             # Process with RTV
-            processed_frame = self.frame_processor(frame)
+            if session is None:
+                processed_frame = self.frame_processor(frame, state=state, quality=quality, timings=timings,
+                                                       layer_only=layer_only)
+            else:
+                # waits for the scheduler to give this session a turn
+                with self.scheduler.slot(session.session_id, session.priority_class):
+                    processed_frame = self.frame_processor(frame, garment_id=session.garment_id,
+                                                           state=session.temporal_state, quality=quality,
+                                                           timings=timings, layer_only=layer_only)
             
             return processed_frame
             
         except Exception as e:
             print(f"Error processing frame: {e}")
-            return frame
+            return None if layer_only else frame
     
     def start_server(self):
         """Start the real-time RTV server"""
         self.socket.bind(('0.0.0.0', self.port))
-        self.socket.listen(1)
+        self.socket.listen(self.max_clients)
         
         print(f"🚀 Real-Time RTV Server started on port {self.port}")
+        if self.is_concurrent():
+            print(f"Serving up to {self.max_clients} concurrent clients")
+        if self.unix_socket_path:
+            self.start_unix_listener()
         print("Waiting for webcam connection...")
-        
+        self.accept_loop(self.socket)
+
+    def start_unix_listener(self):
+        if os.path.exists(self.unix_socket_path):
+            os.remove(self.unix_socket_path)
+        self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.unix_socket.bind(self.unix_socket_path)
+        self.unix_socket.listen(self.max_clients)
+        t = threading.Thread(target=self.accept_loop, args=(self.unix_socket,))
+        t.daemon = True
+        t.start()
+        print(f"🚀 Same-host clients: unix socket {self.unix_socket_path} (shared-memory frames)")
+
+    def accept_loop(self, listener):
         while True:
             try:
-                client_socket, addr = self.socket.accept()
+                client_socket, addr = listener.accept()
+                addr = addr or 'unix socket'
                 print(f"✓ Webcam connected from {addr}")
                 
                 # Handle client in real-time
-                self.handle_realtime_client(client_socket, addr)
+                if self.is_concurrent():
+                    with self.sessions_lock:
+                        n_sessions = self.session_slots
+                        if n_sessions < self.max_clients:
+                            self.session_slots += 1
+                    if n_sessions >= self.max_clients:
+                        print(f"✗ Rejecting {addr}: {n_sessions} sessions already active")
+                        self.reject_busy(client_socket, 'full')
+                        continue
+                    if self.degradation is not None and not self.degradation.admit():
+                        print(f"✗ Rejecting {addr}: overloaded ({self.degradation.format_stats()})")
+                        self.release_session_slot()
+                        self.reject_busy(client_socket, 'overloaded')
+                        continue
+                    t = threading.Thread(target=self.handle_session_client, args=(client_socket, addr))
+                    t.daemon = True
+                    t.start()
+                else:
+                    with self.serial_lock:
+                        if self.pipeline is not None:
+                            self.handle_pipelined_client(client_socket, addr)
+                        else:
+                            self.handle_realtime_client(client_socket, addr)
                 
             except KeyboardInterrupt:
                 print("Server shutting down...")
                 break
+            except OSError as e:
+                if listener.fileno() == -1:
+                    # listener closed by cleanup()
+                    break
+                print(f"Server error: {e}")
             except Exception as e:
                 print(f"Server error: {e}")
                 
@@ -114,11 +436,14 @@ class NetworkRTVServer:
         """Handle real-time client connection"""
         frame_count = 0
         start_time = time.time()
+        conn = ProtocolSocket(client_socket)
+        # a new connection is a new stream: no filter history from the previous one
+        state = self.frame_processor.new_state()
         
         try:
             while True:
                 # Receive frame
-                frame = self.receive_frame(client_socket)
+                frame = self.receive_frame(conn, state=state)
                 if frame is None:
                     print("Lost connection to webcam")
                     break
@@ -128,10 +453,18 @@ class NetworkRTVServer:
                     continue
                 
                 # Process with RTV in real-time
-                processed_frame = self.process_frame_realtime(frame)
+                frame_start = time.perf_counter()
+                timings = dict()
+                layer_only = conn.output_mode == OUTPUT_LAYER
+                processed_frame = self.process_frame_realtime(frame, timings=timings, state=state,
+                                                              layer_only=layer_only)
                 
                 # Send processed frame back
-                self.send_frame(client_socket, processed_frame)
+                if layer_only:
+                    self.send_layer(conn, processed_frame, frame.shape)
+                else:
+                    self.send_frame(conn, processed_frame)
+                self.record_frame_time(frame_start, timings)
                 
                 # Performance monitoring
                 frame_count += 1
@@ -139,74 +472,497 @@ class NetworkRTVServer:
                     elapsed = time.time() - start_time
                     fps = frame_count / elapsed
                     # Get garment name dynamically
-                    garment_names = [
-                        'Jacket 17', 'Jacket 18', 'Jacket 22',
-                        'Lab Coat 03', 'Lab Coat 04', 'Lab Coat 07'
-                    ]
-                    garment_name = garment_names[self.current_garment_id] if self.current_garment_id < len(garment_names) else f"Garment {self.current_garment_id}"
+                    garment_name = self.get_garment_name(self.current_garment_id)
                     print(f"Server FPS: {fps:.2f} | Garment: {garment_name}")
+                    if self.frame_processor.motion_gate is not None:
+                        print(f"Motion gating: {self.frame_processor.motion_gate.format_stats()}")
+                    if self.frame_processor.flow_propagator is not None:
+                        print(f"Flow propagation: {self.frame_processor.flow_propagator.format_stats()}")
+                    if self.frame_processor.pose_predictor is not None:
+                        print(f"Pose prediction: {self.frame_processor.pose_predictor.format_stats()}")
+                    print(f"JPEG codec: {self.codec.format_stats()}")
                     
         except Exception as e:
             print(f"Client error: {e}")
         finally:
+            self.release_ring(conn)
             client_socket.close()
             print(f"✗ Disconnected from {addr}")
     
-    def receive_frame(self, client_socket):
-        """Receive frame or command from client"""
+    def release_session_slot(self):
+        with self.sessions_lock:
+            self.session_slots -= 1
+
+    def handle_session_client(self, client_socket, addr):
+        """Handle one client of the concurrent server on its own thread with its own session state.
+
+        The accept thread has reserved a session slot for it; the slot is released on exit.
+        """
+        try:
+            session = ClientSession(addr, garment_id=self.current_garment_id,
+                                    temporal_state=self.frame_processor.new_state())
+        except Exception as e:
+            print(f"✗ Could not start a session for {addr}: {e}")
+            client_socket.close()
+            self.release_session_slot()
+            return
+        conn = ProtocolSocket(client_socket)
+        with self.sessions_lock:
+            self.sessions[session.session_id] = session
+        print(f"Session {session.session_id} started. Active sessions: {len(self.sessions)}")
+
         try:
-            # Receive frame size (8 bytes for Q format)
-            size_data = client_socket.recv(8)
-            if not size_data or len(size_data) < 8:
+            while True:
+                frame = self.receive_frame(conn, session)
+                if frame is None:
+                    print(f"Session {session.session_id} lost connection")
+                    break
+
+                if isinstance(frame, str) and frame == 'COMMAND':
+                    continue
+
+                frame_start = time.perf_counter()
+                timings = dict()
+                layer_only = conn.output_mode == OUTPUT_LAYER
+                processed_frame = self.process_frame_realtime(frame, session, timings, layer_only=layer_only)
+                if layer_only:
+                    self.send_layer(conn, processed_frame, frame.shape)
+                else:
+                    self.send_frame(conn, processed_frame)
+                self.record_frame_time(frame_start, timings)
+
+                session.frame_count += 1
+                if session.frame_count % 30 == 0:
+                    elapsed = time.time() - session.start_time
+                    fps = session.frame_count / elapsed
+                    garment_name = self.get_garment_name(session.garment_id)
+                    print(f"Session {session.session_id} FPS: {fps:.2f} | Garment: {garment_name}")
+                    if self.frame_processor.batcher is not None:
+                        print(f"Generator batching: {self.frame_processor.batcher.format_stats()}")
+                    print(f"Scheduler: {self.scheduler.format_stats()}")
+                    if self.frame_processor.motion_gate is not None:
+                        print(f"Motion gating: {self.frame_processor.motion_gate.format_stats()}")
+                    if self.frame_processor.flow_propagator is not None:
+                        print(f"Flow propagation: {self.frame_processor.flow_propagator.format_stats()}")
+                    if self.frame_processor.pose_predictor is not None:
+                        print(f"Pose prediction: {self.frame_processor.pose_predictor.format_stats()}")
+                    print(f"JPEG codec: {self.codec.format_stats()}")
+                    if self.degradation is not None:
+                        print(f"Degradation: {self.degradation.format_stats()}")
+
+        except Exception as e:
+            print(f"Client error: {e}")
+        finally:
+            self.release_ring(conn)
+            client_socket.close()
+            with self.sessions_lock:
+                self.sessions.pop(session.session_id, None)
+                self.session_slots -= 1
+                n_sessions = len(self.sessions)
+            self.release_unused_garments()
+            print(f"✗ Disconnected from {addr} (session {session.session_id}). Active sessions: {n_sessions}")
+
+    def handle_pipelined_client(self, client_socket, addr):
+        """Handle client with a reader thread feeding the pipeline and this thread sending results"""
+        frame_count = 0
+        start_time = time.time()
+        submitted = [0]
+        reader_done = threading.Event()
+        conn = ProtocolSocket(client_socket)
+        self.pipeline.new_stream()
+
+        def reader():
+            try:
+                while True:
+                    frame = self.receive_frame(conn)
+                    if frame is None:
+                        print("Lost connection to webcam")
+                        break
+                    if isinstance(frame, str) and frame == 'COMMAND':
+                        continue
+                    # frames in flight hold pooled buffers, returned once their result is sent
+                    view = None
+                    try:
+                        view = self.frame_buffers.acquire(self.preprocessor.out_shape(frame.shape))
+                        frame = self.preprocess_frame(frame, view)
+                    except Exception as e:
+                        print(f"Error processing frame: {e}")
+                    # carry the client's frame id and timestamp through the pipeline
+                    self.pipeline.submit(frame, tag=(conn.frame_id, conn.timestamp_us, view))
+                    submitted[0] += 1
+            finally:
+                reader_done.set()
+
+        reader_thread = threading.Thread(target=reader, args=())
+        reader_thread.daemon = True
+        reader_thread.start()
+
+        try:
+            while not (reader_done.is_set() and frame_count >= submitted[0]):
+                try:
+                    result = self.pipeline.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if result is None:
+                    break
+                _, processed_frame, (frame_id, timestamp_us, view) = result
+                self.send_frame(conn, processed_frame, frame_id, timestamp_us)
+                self.frame_buffers.release(view)
+
+                frame_count += 1
+                if frame_count % 30 == 0:
+                    elapsed = time.time() - start_time
+                    fps = frame_count / elapsed
+                    print(f"Server FPS: {fps:.2f} | Stages: {self.pipeline.format_stats()}")
+                    print(f"JPEG codec: {self.codec.format_stats()}")
+        except Exception as e:
+            print(f"Client error: {e}")
+        finally:
+            client_socket.close()
+            reader_thread.join(timeout=5)
+            self.release_ring(conn)
+            print(f"✗ Disconnected from {addr}")
+
+    def receive_frame(self, conn, session=None, state=None):
+        """Receive frame or command from client (protocol v2 or legacy framing)"""
+        try:
+            message = conn.receive()
+            if message is None:
                 return None
-            size = struct.unpack("Q", size_data)[0]
             
-            # Check if this is a command (high bit set)
-            is_command = (size & (1 << 63)) != 0
-            size = size & ~(1 << 63)  # Clear high bit
-            
-            # Receive data
-            data = b''
-            while len(data) < size:
-                packet = client_socket.recv(min(4096, size - len(data)))
-                if not packet:
-                    return None
-                data += packet
-            
-            if is_command:
-                # Handle command
-                command = pickle.loads(data)
-                if command['type'] == 'change_garment':
-                    garment_id = command['id']
-                    print(f"Switching to garment {garment_id}...")
-                    self.set_garment_id(garment_id)
+            if message.msg_type == MSG_COMMAND:
+                self.handle_command(conn, message.json(), session, state)
                 return 'COMMAND'  # Special marker
+            elif message.msg_type == MSG_FRAME:
+                if message.flags & FLAG_SHM:
+                    return self.read_ring_frame(conn, message)
+                # Decode JPEG image straight from the receive buffer
+                return self.codec.decode(message.payload, self.decode_reduction(conn))
             else:
-                # Decode JPEG image
-                nparr = np.frombuffer(data, np.uint8)
-                frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                return frame
+                print(f"Ignoring unexpected message type {message.msg_type}")
+                return 'COMMAND'
         except Exception as e:
             print(f"Error receiving frame: {e}")
             return None
     
-    def send_frame(self, client_socket, frame):
+    def read_ring_frame(self, conn, message):
+        """Frame passed by slot in the client's shared-memory ring"""
+        if conn.ring is None:
+            raise ValueError("shared-memory frame before attach_shm")
+        slot = slot_of(message.payload)
+        kind, data = conn.ring.read(conn.ring.input_region(slot), message.payload)
+        conn.ring_refs[message.frame_id] = (slot, kind)
+        if kind == KIND_RAW:
+            # a view into shared memory; preprocessing makes the copy the pipeline works on
+            return data
+        return self.codec.decode(data, self.decode_reduction(conn))
+
+    def decode_reduction(self, conn):
+        # a garment layer is placed on the frame the client sent, so layer clients get full-size decodes
+        return None if conn.output_mode == OUTPUT_LAYER else self.frame_reduction
+
+    def release_ring(self, conn):
+        if conn.ring is not None:
+            conn.ring_refs.clear()
+            conn.ring.close()
+            conn.ring = None
+
+    def handle_command(self, conn, command, session=None, state=None):
+        """Apply a client command; v2 clients get a JSON reply"""
+        if session is not None:
+            state = session.temporal_state
+        if command.get('type') == 'attach_shm':
+            try:
+                self.release_ring(conn)
+                conn.ring = FrameRing.attach(command['name'], command['slots'], command['slot_bytes'])
+                print(f"✓ Attached shared-memory ring {command['name']} ({command['slots']} slots)")
+                conn.send_reply({'type': 'shm_attached', 'slots': command['slots']})
+            except Exception as e:
+                print(f"✗ Could not attach shared memory {command.get('name')}: {e}")
+                conn.send_reply({'type': 'error', 'message': f"cannot attach shared memory: {e}"})
+        elif command.get('type') == 'change_garment':
+            garment_id = command['id']
+            print(f"Switching to garment {garment_id}...")
+
+            def on_switched(report):
+                # sent once the new garment is live, with the measured switch latency
+                try:
+                    conn.send_reply(dict(report, type='garment_changed'))
+                except OSError:
+                    pass
+                if self.prefetcher is not None:
+                    # warm what shoppers usually try after this garment
+                    self.prefetcher.on_garment_selected(garment_id)
+
+            if session is not None:
+                self.set_session_garment(session, garment_id, on_switched)
+            else:
+                self.set_garment_id(garment_id, on_switched)
+        elif command.get('type') == 'set_output':
+            mode = command.get('mode')
+            if mode not in (OUTPUT_FRAME, OUTPUT_LAYER) or (mode == OUTPUT_LAYER and conn.protocol != PROTOCOL_V2):
+                conn.send_reply({'type': 'error', 'message': f"unsupported output mode {mode}"})
+                return
+            if mode == OUTPUT_LAYER and self.pipeline is not None:
+                conn.send_reply({'type': 'error', 'message': 'layer output is not available in pipelined mode'})
+                return
+            conn.output_mode = mode
+            print(f"Client output mode: {mode}")
+            conn.send_reply({'type': 'output_set', 'mode': mode})
+        elif command.get('type') == 'set_result_quality':
+            # the web tier lowers this when the client's link is the bottleneck (stream_quality.py)
+            try:
+                quality = min(max(int(command['jpeg_quality']), 30), 95)
+            except (KeyError, TypeError, ValueError):
+                conn.send_reply({'type': 'error', 'message': f"invalid jpeg_quality {command.get('jpeg_quality')}"})
+                return
+            conn.result_quality = quality
+            conn.send_reply({'type': 'result_quality_set', 'jpeg_quality': quality})
+        elif command.get('type') == 'latency':
+            # the client's measured round trip; no reply, it is sent every few frames
+            if state is not None:
+                state.latency_ms = max(float(command.get('rtt_ms', 0)), 0.0) or None
+        elif command.get('type') == 'set_priority' and session is not None:
+            priority_class = command.get('priority')
+            if priority_class not in PRIORITY_CLASSES:
+                conn.send_reply({'type': 'error', 'message': f"unknown priority class {priority_class}"})
+                return
+            session.priority_class = priority_class
+            print(f"Session {session.session_id} scheduled as {priority_class}")
+            conn.send_reply({'type': 'priority_set', 'priority': priority_class})
+        else:
+            print(f"Unknown command: {command.get('type')}")
+            conn.send_reply({'type': 'error', 'message': f"unknown command {command.get('type')}"})
+    
+    def handle_still(self, jpeg_data, garment_ids, client='still'):
+        """Try one photo on several garments; returns (HTTP status, JSON payload).
+
+        Perception runs once for the photo and the generator once per garment, as one request
+        of the scheduler's still class whose cost is the number of garments. The photo is
+        centre-cropped to 9:16 and scaled to STILL_SHAPE first, so the results have that size.
+        """
+        if self.frame_processor is None or not self.startup_status.ready:
+            return 503, {'error': 'GPU server is still starting'}
+        if not garment_ids or len(garment_ids) > self.still_max_garments:
+            return 400, {'error': f'give 1 to {self.still_max_garments} garments'}
+        unknown = [g for g in garment_ids if not 0 <= g < self.garment_count]
+        if unknown:
+            return 400, {'error': f'unknown garments {unknown}'}
+        garment_ids = list(dict.fromkeys(garment_ids))
+
+        # the 9:16 crop keeps min(h, w * 16 / 9) rows, which end up as STILL_SHAPE[0]
+        photo = self.codec.decode(jpeg_data, lambda h, w: reduction_for(int(min(h, w * 16 / 9)), STILL_SHAPE[0]))
+        if photo is None:
+            return 400, {'error': 'photo is not a decodable image'}
+        photo = crop2_169(photo)
+        interpolation = cv2.INTER_AREA if photo.shape[0] > STILL_SHAPE[0] else cv2.INTER_LINEAR
+        photo = cv2.resize(photo, (STILL_SHAPE[1], STILL_SHAPE[0]), interpolation=interpolation)
+
+        start = time.perf_counter()
+        timings = dict()
+        try:
+            if self.scheduler is not None:
+                with self.scheduler.slot(f'still:{client}', STILL, cost=len(garment_ids)):
+                    results = self.frame_processor.try_on_still(photo, garment_ids, timings)
+            else:
+                results = self.frame_processor.try_on_still(photo, garment_ids, timings)
+        except Exception as e:
+            print(f"✗ Still try-on of {len(garment_ids)} garments failed: {e}")
+            return 500, {'error': str(e)}
+        total_ms = (time.perf_counter() - start) * 1000.0
+        if results is None:
+            return 422, {'error': 'no person found in the photo'}
+
+        images = {str(garment_id): None for garment_id in results}
+        encoded = [garment_id for garment_id, image in results.items() if image is not None]
+        buffers = self.codec.encode_many([results[garment_id] for garment_id in encoded], 90)
+        for garment_id, buffer in zip(encoded, buffers):
+            images[str(garment_id)] = base64.b64encode(buffer).decode('ascii')
+        print(f"✓ Still try-on: {len(garment_ids)} garments in {total_ms:.0f}ms "
+              f"({' '.join(f'{stage} {ms:.0f}ms' for stage, ms in timings.items())})")
+        versions = {str(g): self.frame_processor.garment_version(g) for g in garment_ids}
+        return 200, {'results': images, 'versions': versions, 'total_ms': round(total_ms, 1),
+                     'stage_ms': {stage: round(ms, 1) for stage, ms in timings.items()}}
+
+    def record_frame_time(self, frame_start, timings):
+        if self.degradation is not None:
+            self.degradation.record((time.perf_counter() - frame_start) * 1000.0, timings)
+
+    def reject_busy(self, client_socket, reason, retry_after_s=5):
+        """Turn a client away with a 'busy' reply instead of a bare disconnect"""
+        def reply():
+            conn = ProtocolSocket(client_socket)
+            try:
+                # the client's first message tells which protocol it speaks
+                client_socket.settimeout(2.0)
+                if conn.receive() is not None:
+                    conn.send_reply({'type': 'busy', 'reason': reason, 'retry_after_s': retry_after_s})
+            except Exception:
+                pass
+            finally:
+                conn.close()
+
+        t = threading.Thread(target=reply, args=())
+        t.daemon = True
+        t.start()
+
+    def result_quality(self, conn):
+        # the lower of the degradation level's quality and the one the client asked for
+        jpeg_quality = self.degradation.quality.jpeg_quality if self.degradation is not None else 90
+        return jpeg_quality if conn.result_quality is None else min(jpeg_quality, conn.result_quality)
+
+    def send_frame(self, conn, frame, frame_id=None, timestamp_us=None):
         """Send processed frame to client"""
         try:
-            # Encode frame as JPEG
-            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
-            data = buffer.tobytes()
-            size = len(data)
-            client_socket.sendall(struct.pack("Q", size))
-            client_socket.sendall(data)
+            jpeg_quality = self.result_quality(conn)
+            ref = conn.ring_refs.pop(conn.frame_id if frame_id is None else frame_id, None)
+            if ref is not None:
+                # same-host client: answer through the request's slot, in the request's kind
+                slot, kind = ref
+                if kind == KIND_RAW:
+                    out_ref = conn.ring.write(conn.ring.output_region(slot), frame, KIND_RAW, slot)
+                else:
+                    buffer = self.codec.encode(frame, jpeg_quality)
+                    out_ref = conn.ring.write(conn.ring.output_region(slot), buffer, KIND_JPEG, slot)
+                if out_ref is not None:
+                    conn.send_result(out_ref, frame_id, timestamp_us, flags=FLAG_SHM)
+                    return
+            # Encode frame as JPEG and send the encoder's buffer without copying it
+            buffer = self.codec.encode(frame, jpeg_quality)
+            conn.send_result(buffer, frame_id, timestamp_us)
         except Exception as e:
             print(f"Error sending frame: {e}")
+
+    def send_layer(self, conn, layer, frame_shape):
+        """Send the garment layer for the client to composite over the frame it sent (see gpu_protocol)"""
+        try:
+            # a frame passed through shared memory is answered inline; the client frees its slot
+            conn.ring_refs.pop(conn.frame_id, None)
+            view_transform, view_w, view_h = self.preprocess_transform(frame_shape)
+            atlas = None
+            if layer is not None:
+                roi_target, roi_alpha, inv_trans2roi = layer
+                # the matte naive_overlay_alpha cuts with, so both output modes look alike
+                roi_alpha = erode((roi_alpha > 128).astype(np.uint8) * 255)
+                # only the garment's bounding box, on JPEG block boundaries
+                x, y, w, h = cv2.boundingRect(roi_alpha)
+                if w > 0 and h > 0:
+                    x0, y0 = x // 8 * 8, y // 8 * 8
+                    x1 = min(-(-(x + w) // 8) * 8, roi_alpha.shape[1])
+                    y1 = min(-(-(y + h) // 8) * 8, roi_alpha.shape[0])
+                    atlas = np.hstack([roi_target[y0:y1, x0:x1],
+                                       cv2.cvtColor(roi_alpha[y0:y1, x0:x1], cv2.COLOR_GRAY2BGR)])
+                    layer_transform = np.array(inv_trans2roi, dtype=np.float64).copy()
+                    layer_transform[:, 2] += layer_transform[:, :2] @ np.array([x0, y0], dtype=np.float64)
+            if atlas is None:
+                conn.send_layer(LAYER_HEADER.pack(*([0.0] * 6), *view_transform.reshape(-1), view_w, view_h, 0, 0))
+                return
+            buffer = self.codec.encode(atlas, self.result_quality(conn))
+            header = LAYER_HEADER.pack(*layer_transform.reshape(-1), *view_transform.reshape(-1),
+                                       view_w, view_h, atlas.shape[1] // 2, atlas.shape[0])
+            conn.send_layer(header + buffer.tobytes())
+        except Exception as e:
+            print(f"Error sending garment layer: {e}")
     
     def cleanup(self):
         """Clean up server resources"""
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.frame_processor.batcher is not None:
+            self.frame_processor.batcher.stop()
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.status_server is not None:
+            self.status_server.shutdown()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            if os.path.exists(self.unix_socket_path):
+                os.remove(self.unix_socket_path)
         self.socket.close()
+        self.codec.shutdown()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Real-Time Network RTV Server')
+    parser.add_argument('--port', type=int, default=9999, help='TCP port to listen on')
+    parser.add_argument('--pipelined', action='store_true', default=False,
+                        help='run FrameProcessor stages as pipelined workers (overlaps CPU and GPU work)')
+    parser.add_argument('--pipeline_queue_size', type=int, default=2, help='bounded queue size between pipeline stages')
+    parser.add_argument('--max_clients', type=int, default=1,
+                        help='serve up to this many clients concurrently, each with its own session state')
+    parser.add_argument('--batch_generator', action='store_true', default=False,
+                        help='batch generator calls of concurrent sessions into one forward pass per garment')
+    parser.add_argument('--max_batch_size', type=int, default=4, help='largest generator batch')
+    parser.add_argument('--batch_window_ms', type=float, default=5.0,
+                        help='longest time a generator request waits for others to join its batch')
+    parser.add_argument('--gpu_budget_mb', type=int, default=2048,
+                        help='GPU memory for resident garment models (0 = unlimited)')
+    parser.add_argument('--host_budget_mb', type=int, default=8192,
+                        help='pinned host memory for warm garment models (0 = unlimited)')
+    parser.add_argument('--residency_policy', choices=['lru', 'lfu'], default='lru',
+                        help='which garment leaves the GPU first when its budget is exceeded')
+    parser.add_argument('--checkpoint_store', type=str, default=None,
+                        help='memory-mapped checkpoint store directory (default <ckpt_dir>/store if it exists)')
+    parser.add_argument('--weight_cache', type=str, default=None,
+                        help='local DensePose/BEV weight cache (default $RTV_WEIGHT_CACHE or ~/.cache/rtv_weights)')
+    parser.add_argument('--status_port', type=int, default=None,
+                        help='HTTP port for the readiness endpoint (default: --port + 1, 0 disables it)')
+    parser.add_argument('--prefetch_plan', type=str, default=None,
+                        help='garment prefetch plan from the web tier: JSON file or URL, e.g. '
+                             'http://<web-host>:5000/api/prefetch-plan')
+    parser.add_argument('--prefetch_refresh_s', type=float, default=300.0,
+                        help='how often the prefetch plan is reloaded (0 = load once)')
+    parser.add_argument('--max_inflight', type=int, default=2,
+                        help='concurrent sessions: frames processed at the same time across all sessions')
+    parser.add_argument('--interactive_limit', type=int, default=None,
+                        help='most interactive try-on frames in flight (default: --max_inflight)')
+    parser.add_argument('--still_limit', type=int, default=1, help='most still-photo requests in flight')
+    parser.add_argument('--still_max_garments', type=int, default=32,
+                        help='most garments in one still-photo request (POST /still on the status port)')
+    parser.add_argument('--batch_limit', type=int, default=1, help='most offline batch requests in flight')
+    parser.add_argument('--frame_slo_ms', type=float, default=0,
+                        help='p95 frame-time target; above it quality degrades step by step and, as a last '
+                             'resort, new sessions are turned away as busy (0 = off)')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='also listen on this unix socket; same-host clients can pass frames through '
+                             'shared memory (see shm_transport.py)')
+    parser.add_argument('--motion_gate', action='store_true', default=False,
+                        help='reuse the last garment layer on near-static frames instead of rerunning pose, '
+                             'DensePose and the generator (not in --pipelined mode)')
+    parser.add_argument('--motion_still_threshold', type=float, default=1.5,
+                        help='mean grey-level difference in the person ROI below which a frame counts as still')
+    parser.add_argument('--motion_move_threshold', type=float, default=4.0,
+                        help='difference above which a static stream is processed again')
+    parser.add_argument('--motion_enter_frames', type=int, default=3,
+                        help='consecutive still frames before frames are skipped')
+    parser.add_argument('--motion_max_skip', type=int, default=10,
+                        help='most frames skipped in a row before the garment layer is refreshed')
+    parser.add_argument('--flow_propagation', action='store_true', default=False,
+                        help='run the generator on keyframes only and carry its output to the frames in '
+                             'between with optical flow (RAFT small; not in --pipelined mode)')
+    parser.add_argument('--flow_max_interval', type=int, default=4,
+                        help='most frames propagated from one keyframe')
+    parser.add_argument('--flow_max_error', type=float, default=12.0,
+                        help='mean grey-level error of the flow-warped keyframe under the garment above '
+                             'which a new keyframe is generated (drift, occlusion)')
+    parser.add_argument('--flow_max_motion', type=float, default=24.0,
+                        help='mean flow under the garment, in flow-crop pixels, above which a new keyframe is generated')
+    parser.add_argument('--flow_size', type=int, default=256, help='side of the ROI crop the flow is estimated on')
+    parser.add_argument('--pose_prediction', action='store_true', default=False,
+                        help='extrapolate reused poses to the frame they dress with a constant-velocity model '
+                             'and log its error at the client-measured latency')
+    parser.add_argument('--prediction_max_horizon_ms', type=float, default=250.0,
+                        help='farthest the pose is extrapolated')
+    parser.add_argument('--codec_threads', type=int, default=CODEC_THREADS,
+                        help='worker threads decoding received JPEGs and encoding results, shared by all clients')
+    args = parser.parse_args()
+    if args.status_port is None:
+        args.status_port = args.port + 1
+    if args.pipelined and args.max_clients > 1:
+        parser.error('--pipelined serves a single stream; use it with --max_clients 1')
+    return args
 
 def main():
+    args = parse_args()
     print("Starting Real-Time Network RTV Server...")
     
     # Only garments with trained models available in rtv_ckpts folder
@@ -222,7 +978,29 @@ def main():
     print(f"Available garments: {garment_name_list}")
     print(f"Total garments: {len(garment_name_list)}")
     
-    server = NetworkRTVServer(garment_name_list)
+    server = NetworkRTVServer(garment_name_list, port=args.port, pipelined=args.pipelined,
+                              pipeline_queue_size=args.pipeline_queue_size, max_clients=args.max_clients,
+                              batch_generator=args.batch_generator, max_batch_size=args.max_batch_size,
+                              batch_window_ms=args.batch_window_ms, gpu_budget_mb=args.gpu_budget_mb,
+                              host_budget_mb=args.host_budget_mb, residency_policy=args.residency_policy,
+                              checkpoint_store=args.checkpoint_store, weight_cache_dir=args.weight_cache,
+                              status_port=args.status_port, prefetch_plan=args.prefetch_plan,
+                              prefetch_refresh_s=args.prefetch_refresh_s, max_inflight=args.max_inflight,
+                              class_limits={'interactive': args.interactive_limit or args.max_inflight,
+                                            'still': args.still_limit, 'batch': args.batch_limit},
+                              frame_slo_ms=args.frame_slo_ms, unix_socket=args.unix_socket,
+                              still_max_garments=args.still_max_garments,
+                              motion_gate=dict(still_threshold=args.motion_still_threshold,
+                                               move_threshold=args.motion_move_threshold,
+                                               enter_frames=args.motion_enter_frames,
+                                               max_skip=args.motion_max_skip) if args.motion_gate else None,
+                              flow_propagation=dict(max_interval=args.flow_max_interval,
+                                                    max_error=args.flow_max_error,
+                                                    max_motion=args.flow_max_motion,
+                                                    flow_size=args.flow_size) if args.flow_propagation else None,
+                              pose_prediction=dict(max_horizon_ms=args.prediction_max_horizon_ms)
+                              if args.pose_prediction else None,
+                              codec_threads=args.codec_threads)
     
     try:
         server.start_server()
@@ -0,0 +1,116 @@
+"""
+Garment prefetch planner
+Turns the try-on history in tryon_sessions into a ranked preload plan for the GPU server:
+time-decayed garment popularity plus "tried next" transitions between garments of the same
+shopper. The plan is written to PREFETCH_PLAN_PATH and served at /api/prefetch-plan; the GPU
+server (network_rtv_server.py --prefetch_plan) warms garments in that order.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from dotenv import load_dotenv
+
+import database as db
+
+load_dotenv()
+
+PLAN_PATH = os.getenv('PREFETCH_PLAN_PATH', 'prefetch_plan.json')
+HALF_LIFE_HOURS = float(os.getenv('PREFETCH_HALF_LIFE_HOURS', 72))
+REFRESH_MINUTES = float(os.getenv('PREFETCH_REFRESH_MINUTES', 10))
+HISTORY_DAYS = int(os.getenv('PREFETCH_HISTORY_DAYS', 90))
+# two try-ons of one shopper this close together count as "tried next"
+NEXT_WINDOW_MINUTES = 30
+TOP_NEXT = 3
+# weight of overall popularity when ranking next garments (fallback for sparse transitions)
+POPULARITY_PRIOR = 0.5
+
+latest_plan = None
+
+
+def decay_weight(age_seconds, half_life_hours=HALF_LIFE_HOURS):
+    return math.pow(0.5, max(age_seconds, 0.0) / (half_life_hours * 3600.0))
+
+
+def build_plan(sessions, now=None, half_life_hours=HALF_LIFE_HOURS, next_window_minutes=NEXT_WINDOW_MINUTES,
+               top_next=TOP_NEXT):
+    """Build the preload plan from try-on sessions (dicts with user_id, garment_id, created_at)"""
+    now = now or datetime.now()
+    popularity = defaultdict(float)
+    transitions = defaultdict(lambda: defaultdict(float))
+
+    sessions = sorted(sessions, key=lambda s: (s['user_id'], s['created_at']))
+    previous = None
+    for s in sessions:
+        weight = decay_weight((now - s['created_at']).total_seconds(), half_life_hours)
+        popularity[s['garment_id']] += weight
+        if previous is not None and previous['user_id'] == s['user_id'] \
+                and previous['garment_id'] != s['garment_id'] \
+                and (s['created_at'] - previous['created_at']).total_seconds() <= next_window_minutes * 60:
+            transitions[previous['garment_id']][s['garment_id']] += weight
+        previous = s
+
+    total = sum(popularity.values()) or 1.0
+    ranking = sorted(popularity, key=lambda g: popularity[g], reverse=True)
+    next_garments = dict()
+    for garment in ranking:
+        scores = {g: transitions[garment].get(g, 0.0) + POPULARITY_PRIOR * popularity[g] / total
+                  for g in ranking if g != garment}
+        next_garments[garment] = sorted(scores, key=lambda g: scores[g], reverse=True)[:top_next]
+
+    return {
+        'generated_at': now.isoformat(timespec='seconds'),
+        'half_life_hours': half_life_hours,
+        'sessions': len(sessions),
+        'ranking': ranking,
+        'popularity': {g: round(popularity[g], 4) for g in ranking},
+        'next': next_garments,
+    }
+
+
+def publish_plan(plan, path=PLAN_PATH):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def refresh_plan(path=PLAN_PATH):
+    """Rebuild the plan from the database and publish it; returns the plan or None"""
+    global latest_plan
+    result = db.get_tryon_history(HISTORY_DAYS)
+    if not result['success']:
+        print(f"✗ Failed to read try-on history: {result['error']}")
+        return None
+    plan = build_plan(result['sessions'])
+    publish_plan(plan, path)
+    latest_plan = plan
+    print(f"✓ Prefetch plan updated from {plan['sessions']} sessions: top {plan['ranking'][:5]}")
+    return plan
+
+
+def get_plan():
+    return latest_plan if latest_plan is not None else refresh_plan()
+
+
+def run_refresh_loop(interval_minutes=REFRESH_MINUTES):
+    while True:
+        try:
+            refresh_plan()
+        except Exception as e:
+            print(f"✗ Prefetch plan refresh failed: {e}")
+        time.sleep(interval_minutes * 60)
+
+
+def start_refresh_thread(interval_minutes=REFRESH_MINUTES):
+    t = threading.Thread(target=run_refresh_loop, args=(interval_minutes,), daemon=True)
+    t.start()
+    return t
+
+
+if __name__ == '__main__':
+    if db.init_db_pool():
+        print(json.dumps(refresh_plan(), indent=1))
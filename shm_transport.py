@@ -0,0 +1,110 @@
+"""
+Shared-memory frame ring for a web tier and GPU server on the same host
+
+The client (web tier) creates a ring of fixed-size slots in POSIX shared memory and
+announces it over the protocol connection (usually a unix domain socket) with an
+attach_shm command. A frame is then written into a free slot's input region and only a
+small slot reference travels over the socket (protocol v2 message with FLAG_SHM); the
+server writes the result into the same slot's output region and answers with a
+reference as well. Slots are owned by the client until the result arrives.
+
+Slot contents are either JPEG bytes or raw 8-bit BGR pixels (KIND_RAW, height x width x 3);
+the server answers in the kind of the request.
+"""
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+# slot | nbytes | height | width | kind
+SLOT_REF = struct.Struct('!IIHHB')
+KIND_JPEG = 0
+KIND_RAW = 1
+
+DEFAULT_SLOTS = 4
+DEFAULT_SLOT_BYTES = 4 * 1024 * 1024
+
+
+class FrameRing:
+    """Fixed slots in one shared-memory block; each slot has an input and an output region"""
+
+    def __init__(self, shm, slots, slot_bytes, owner):
+        self.shm = shm
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = owner
+        self.free = list(range(slots))
+        self.buffer = memoryview(shm.buf)
+
+    @staticmethod
+    def create(slots=DEFAULT_SLOTS, slot_bytes=DEFAULT_SLOT_BYTES):
+        shm = shared_memory.SharedMemory(create=True, size=slots * 2 * slot_bytes)
+        return FrameRing(shm, slots, slot_bytes, owner=True)
+
+    @staticmethod
+    def attach(name, slots, slot_bytes):
+        shm = shared_memory.SharedMemory(name=name)
+        # the creating process owns the block; keep this process's tracker from unlinking it at exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        if shm.size < slots * 2 * slot_bytes:
+            shm.close()
+            raise ValueError(f"shared memory {name} is smaller than {slots} slots of {slot_bytes} bytes")
+        return FrameRing(shm, slots, slot_bytes, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def describe(self):
+        return {'type': 'attach_shm', 'name': self.shm.name, 'slots': self.slots, 'slot_bytes': self.slot_bytes}
+
+    def input_region(self, slot):
+        start = 2 * slot * self.slot_bytes
+        return self.buffer[start:start + self.slot_bytes]
+
+    def output_region(self, slot):
+        start = (2 * slot + 1) * self.slot_bytes
+        return self.buffer[start:start + self.slot_bytes]
+
+    def acquire(self):
+        """A free slot index, or None when every slot is in flight"""
+        return self.free.pop() if self.free else None
+
+    def release(self, slot):
+        self.free.append(slot)
+
+    def write(self, region, data, kind=KIND_JPEG, slot=0):
+        """Copy JPEG bytes or a BGR image into a region; returns its reference, or None if too big"""
+        if kind == KIND_RAW:
+            height, width = data.shape[:2]
+            data = np.ascontiguousarray(data).reshape(-1)
+        else:
+            height = width = 0
+        data = memoryview(data).cast('B')
+        if len(data) > self.slot_bytes:
+            return None
+        region[:len(data)] = data
+        return SLOT_REF.pack(slot, len(data), height, width, kind)
+
+    def read(self, region, ref):
+        """(kind, view) for a slot reference: raw images as an ndarray view, JPEG as a memoryview"""
+        slot, nbytes, height, width, kind = SLOT_REF.unpack(bytes(ref[:SLOT_REF.size]))
+        if nbytes > self.slot_bytes:
+            raise ValueError(f"slot reference of {nbytes} bytes exceeds the slot size")
+        if kind == KIND_RAW:
+            return kind, np.frombuffer(region, np.uint8, count=nbytes).reshape(height, width, 3)
+        return kind, region[:nbytes]
+
+    def close(self):
+        try:
+            self.buffer.release()
+            self.shm.close()
+        except BufferError:
+            # a frame view is still alive; the mapping goes away with it
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def slot_of(ref):
+    return SLOT_REF.unpack(bytes(ref[:SLOT_REF.size]))[0]
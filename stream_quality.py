@@ -0,0 +1,182 @@
+"""
+Adaptive capture settings for one browser stream, driven by measured round trips
+
+The browser reports the round trip of every answered frame by frame id (send to result,
+on its own clock). The web tier knows when each frame arrived and how long the GPU server
+took for it, so a round trip splits into server time and network time (upload of the
+frame and download of the result). Once per stats interval the controller:
+  - sets the send interval to the slower of the GPU time and the network time (plus
+    headroom): faster than the GPU only fills the drop slot, faster than the uplink only
+    queues frames in the browser's socket
+  - moves down a ladder of capture sizes / JPEG qualities when the round trip exceeds
+    STREAM_TARGET_RTT_MS and the network is the larger part of it, and back up after
+    recover_windows windows well below the target
+The browser applies the parameters it is sent ('stream_params'); the result JPEG quality
+of each rung is passed on to the GPU server (set_result_quality). The GPU server scales
+frames of a reduced width back up to its 720-row serving view, so the models always see
+the view size they were warmed up for and a lower rung only costs detail.
+
+All parameters stay within the STREAM_* bounds.
+"""
+import os
+from collections import OrderedDict, deque
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STREAM_ADAPTIVE = os.getenv('STREAM_ADAPTIVE', 'true').lower() in ('1', 'true', 'yes')
+STREAM_TARGET_RTT_MS = float(os.getenv('STREAM_TARGET_RTT_MS', 300))
+STREAM_MIN_WIDTH = int(os.getenv('STREAM_MIN_WIDTH', 480))
+STREAM_MAX_WIDTH = int(os.getenv('STREAM_MAX_WIDTH', 1280))
+STREAM_MIN_JPEG_QUALITY = float(os.getenv('STREAM_MIN_JPEG_QUALITY', 0.5))
+STREAM_MAX_JPEG_QUALITY = float(os.getenv('STREAM_MAX_JPEG_QUALITY', 0.8))
+STREAM_MIN_INTERVAL_MS = float(os.getenv('STREAM_MIN_INTERVAL_MS', 66))
+STREAM_MAX_INTERVAL_MS = float(os.getenv('STREAM_MAX_INTERVAL_MS', 500))
+# frames kept per stream until the browser reports their round trip
+MAX_TRACKED_FRAMES = 64
+
+
+class StreamLevel:
+    """One rung of the capture ladder; every step down sends fewer bytes"""
+
+    def __init__(self, name, width, jpeg_quality, result_quality):
+        self.name = name
+        # capture width in the browser (the height follows the camera's aspect ratio)
+        self.width = width
+        # canvas.toBlob quality of the frames the browser sends
+        self.jpeg_quality = jpeg_quality
+        # JPEG quality of the frames the GPU server sends back
+        self.result_quality = result_quality
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+DEFAULT_LADDER = [
+    StreamLevel('hd', 1280, 0.8, 90),
+    StreamLevel('hd_q70', 1280, 0.7, 85),
+    StreamLevel('hd_q60', 1280, 0.6, 80),
+    StreamLevel('960', 960, 0.65, 80),
+    StreamLevel('640', 640, 0.65, 75),
+    StreamLevel('640_q50', 640, 0.5, 70),
+    StreamLevel('480', 480, 0.5, 70),
+]
+
+
+def bounded_ladder(ladder=None, min_width=STREAM_MIN_WIDTH, max_width=STREAM_MAX_WIDTH,
+                   min_quality=STREAM_MIN_JPEG_QUALITY, max_quality=STREAM_MAX_JPEG_QUALITY):
+    """The ladder clamped to the configured bounds, without repeated rungs"""
+    bounded = []
+    for level in ladder or DEFAULT_LADDER:
+        width = min(max(level.width, min_width), max_width)
+        quality = round(min(max(level.jpeg_quality, min_quality), max_quality), 2)
+        if bounded and (bounded[-1].width, bounded[-1].jpeg_quality) == (width, quality):
+            continue
+        bounded.append(StreamLevel(level.name, width, quality, level.result_quality))
+    return bounded
+
+
+class StreamQualityController:
+    """Per-stream feedback from round trips to capture size, JPEG quality and send interval.
+
+    frame_received / frame_answered time each frame on the server by its id, client_rtts
+    adds the browser's round trips, and evaluate() (once per stats interval) returns the
+    new parameters when they changed. A level change is followed by one window of settling.
+    """
+
+    def __init__(self, ladder=None, target_rtt_ms=STREAM_TARGET_RTT_MS, min_interval_ms=STREAM_MIN_INTERVAL_MS,
+                 max_interval_ms=STREAM_MAX_INTERVAL_MS, headroom=1.1, recover_ratio=0.6, recover_windows=3):
+        self.ladder = bounded_ladder(ladder)
+        self.target_rtt_ms = target_rtt_ms
+        self.min_interval_ms = min_interval_ms
+        self.max_interval_ms = max(max_interval_ms, min_interval_ms)
+        self.headroom = headroom
+        self.recover_ratio = recover_ratio
+        self.recover_windows = recover_windows
+        self.level = 0
+        self.interval_ms = self.clamp_interval(100.0)
+        # frame id -> [received (s), bytes, server ms, GPU ms], until the browser reports its round trip
+        self.frames = OrderedDict()
+        # (round trip ms, server ms, GPU ms, bytes) of the frames answered in this window
+        self.samples = []
+        self.good_windows = 0
+        self.settling = False
+        self.transitions = deque(maxlen=20)
+        self.last = dict(rtt_ms=0.0, server_ms=0.0, gpu_ms=0.0, network_ms=0.0, kb_per_frame=0.0)
+
+    @property
+    def params(self):
+        level = self.ladder[self.level]
+        return {'level': level.name, 'width': level.width, 'jpeg_quality': level.jpeg_quality,
+                'interval_ms': round(self.interval_ms), 'result_quality': level.result_quality}
+
+    def clamp_interval(self, interval_ms):
+        return min(max(interval_ms, self.min_interval_ms), self.max_interval_ms)
+
+    def frame_received(self, frame_id, size, now):
+        self.frames[frame_id] = [now, size, None, None]
+        self.frames.move_to_end(frame_id)
+        while len(self.frames) > MAX_TRACKED_FRAMES:
+            self.frames.popitem(last=False)
+
+    def frame_answered(self, frame_id, gpu_ms, now):
+        frame = self.frames.get(frame_id)
+        if frame is not None:
+            frame[2] = (now - frame[0]) * 1000.0
+            frame[3] = gpu_ms
+
+    def client_rtts(self, samples):
+        """Round trips the browser measured, as [[frame id, ms], ...]"""
+        for frame_id, rtt_ms in samples:
+            frame = self.frames.pop(frame_id, None)
+            if frame is None or frame[2] is None:
+                continue
+            self.samples.append((float(rtt_ms), frame[2], frame[3], frame[1]))
+
+    def evaluate(self):
+        """New parameters if this window changed them, else None"""
+        if not self.samples:
+            return None
+        rtt_ms, server_ms, gpu_ms, size = (float(v) for v in np.median(np.array(self.samples, dtype=np.float64), axis=0))
+        self.samples = []
+        # the browser's clock is not ours: whatever the round trip has beyond server time is network
+        network_ms = max(rtt_ms - server_ms, 0.0)
+        self.last = dict(rtt_ms=round(rtt_ms, 1), server_ms=round(server_ms, 1), gpu_ms=round(gpu_ms, 1),
+                         network_ms=round(network_ms, 1), kb_per_frame=round(size / 1024.0, 1))
+        before = self.params
+
+        self.interval_ms = self.clamp_interval(max(gpu_ms, network_ms) * self.headroom)
+        if self.settling:
+            # the window straddled a level change
+            self.settling = False
+        elif rtt_ms > self.target_rtt_ms and network_ms > server_ms:
+            self.good_windows = 0
+            if self.level < len(self.ladder) - 1:
+                self.change_level(self.level + 1, rtt_ms, network_ms)
+        elif rtt_ms < self.target_rtt_ms * self.recover_ratio:
+            self.good_windows += 1
+            if self.good_windows >= self.recover_windows and self.level > 0:
+                self.good_windows = 0
+                self.change_level(self.level - 1, rtt_ms, network_ms)
+        else:
+            self.good_windows = 0
+
+        after = self.params
+        interval_change = abs(after['interval_ms'] - before['interval_ms'])
+        if after['level'] != before['level'] or interval_change > 0.1 * before['interval_ms']:
+            return after
+        return None
+
+    def change_level(self, level, rtt_ms, network_ms):
+        direction = 'Lowering' if level > self.level else 'Raising'
+        print(f"{'⚠' if level > self.level else '✓'} {direction} stream to {self.ladder[level].name} "
+              f"(round trip {rtt_ms:.0f}ms, network {network_ms:.0f}ms, target {self.target_rtt_ms:.0f}ms)")
+        self.transitions.append({'from': self.ladder[self.level].name, 'to': self.ladder[level].name,
+                                 'rtt_ms': round(rtt_ms, 1), 'network_ms': round(network_ms, 1)})
+        self.level = level
+        self.settling = True
+
+    def get_stats(self):
+        return dict(self.params, target_rtt_ms=self.target_rtt_ms, transitions=list(self.transitions), **self.last)
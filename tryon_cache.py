@@ -0,0 +1,166 @@
+"""
+Disk cache of still try-on results, per user and content addressed
+
+A result is stored under the user, the SHA-256 of the uploaded photo, the garment and the
+version of the garment's generator (its checkpoint digest, reported by the GPU servers), so
+a repeated view is served from disk without touching a GPU and a retrained garment never
+serves an old image. The cache holds at most TRYON_CACHE_MB; the least recently used
+results are deleted first, and results of a superseded model version are deleted as soon
+as the new version is seen.
+
+Layout: <TRYON_CACHE_DIR>/<user id>/<photo sha256>/<garment>-<model version>.jpg
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CACHE_DIR = os.getenv('TRYON_CACHE_DIR', 'tryon_cache')
+CACHE_MB = int(os.getenv('TRYON_CACHE_MB', 512))
+# characters of the model version kept in file names
+VERSION_CHARS = 16
+SAFE_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+def photo_digest(photo_data):
+    return hashlib.sha256(photo_data).hexdigest()
+
+
+class TryOnCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MB * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # relative path -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # garment -> newest model version seen
+        self.versions = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if self.enabled:
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def load(self):
+        """Index the results already on disk, oldest access first"""
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not filename.endswith('.jpg'):
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, os.path.relpath(path, self.root), stat.st_size))
+        with self.lock:
+            for _, relpath, size in sorted(found):
+                self.entries[relpath] = size
+                self.total_bytes += size
+            self.evict()
+        if found:
+            print(f"✓ Try-on cache: {len(self.entries)} results, {self.total_bytes / 1024 / 1024:.1f}MB in {self.root}")
+
+    def entry_path(self, user_id, photo_hash, garment_id, version):
+        if not SAFE_NAME.match(garment_id) or not re.match(r'^[0-9a-f]{64}$', photo_hash):
+            raise ValueError(f"invalid cache key {garment_id}/{photo_hash}")
+        version = re.sub(r'[^A-Za-z0-9]', '', version)[:VERSION_CHARS]
+        return os.path.join(str(int(user_id)), photo_hash, f'{garment_id}-{version}.jpg')
+
+    def get(self, user_id, photo_hash, garment_id, version):
+        """Relative path of a cached result, or None"""
+        if not self.enabled or not version:
+            return None
+        relpath = self.entry_path(user_id, photo_hash, garment_id, version)
+        with self.lock:
+            if relpath not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(relpath)
+            self.hits += 1
+        try:
+            # the file time carries the LRU order across restarts
+            os.utime(os.path.join(self.root, relpath))
+        except OSError:
+            with self.lock:
+                self.drop(relpath)
+            return None
+        return relpath
+
+    def put(self, user_id, photo_hash, garment_id, version, jpeg_data):
+        """Store a result; returns its relative path, or None if it is not cacheable"""
+        if not self.enabled or not version or len(jpeg_data) > self.max_bytes:
+            return None
+        relpath = self.entry_path(user_id, photo_hash, garment_id, version)
+        path = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(jpeg_data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes -= self.entries.pop(relpath, 0)
+            self.entries[relpath] = len(jpeg_data)
+            self.total_bytes += len(jpeg_data)
+            self.evict()
+        return relpath
+
+    def observe_version(self, garment_id, version):
+        """Note a garment's current model version; results of older versions are deleted"""
+        if not self.enabled or not version:
+            return
+        with self.lock:
+            if self.versions.get(garment_id) == version:
+                return
+            # first sighting (results kept on disk across a restart) or a new checkpoint
+            self.versions[garment_id] = version
+            current = f"{garment_id}-{re.sub(r'[^A-Za-z0-9]', '', version)[:VERSION_CHARS]}.jpg"
+            stale = [p for p in self.entries
+                     if os.path.basename(p).rsplit('-', 1)[0] == garment_id and os.path.basename(p) != current]
+            for relpath in stale:
+                self.drop(relpath)
+                self.invalidations += 1
+        if stale:
+            print(f"Garment {garment_id} model changed: dropped {len(stale)} cached try-on results")
+
+    def drop(self, relpath):
+        # called with self.lock held
+        size = self.entries.pop(relpath, None)
+        if size is None:
+            return
+        self.total_bytes -= size
+        path = os.path.join(self.root, relpath)
+        try:
+            os.remove(path)
+            # the photo's directory goes with its last result
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def evict(self):
+        # called with self.lock held
+        while self.total_bytes > self.max_bytes and self.entries:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'results': len(self.entries),
+                'mb': round(self.total_bytes / 1024 / 1024, 1),
+                'max_mb': round(self.max_bytes / 1024 / 1024, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
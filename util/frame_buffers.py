@@ -0,0 +1,248 @@
+"""
+Reused frame buffers and the single-pass preprocessing of the serving path
+
+The server mirrors every received frame, scales portrait frames to 1024 rows and crops it
+to 9:16 (rtl_demo.py's preprocessing), then warps the rendered body and DensePose SDP into
+the 512x512 garment ROI and the generated garment back onto the frame. Done step by step,
+each of these allocates a new frame-sized array per frame.
+
+FramePreprocessor composes mirror, resize and crop into one affine map (what a client that
+composites the garment layer itself needs) and produces the view in one pass over the
+pixels it keeps: a cv2.flip of the crop, straight into a reused buffer, after a cv2.resize
+into another one for portrait frames. That is exact and faster than running the map
+through cv2.warpAffine, whose general interpolation loop is 3-5x slower than flip / resize
+here. The view and the ROI / composition warps write into buffers FrameBuffers reuses:
+    scratch(name, shape)   the calling thread's buffer of that name, valid until the same
+                           thread asks for the name again (one frame at a time per thread)
+    acquire(shape) / release(buffer)
+                           buffers handed between threads, e.g. along the pipelined stages
+Both count allocations and reuses (get_stats).
+
+Benchmark (time and new memory per frame, step by step vs preallocated), which also checks
+that transform() describes the view produced, e.g. for a reduced capture size:
+    python -m util.frame_buffers --width 1920 --height 1080
+    python -m util.frame_buffers --width 480 --height 270 --min_height 720
+"""
+import argparse
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+from util.image_warp import crop2_169, resize_img
+
+# pooled buffers kept per shape once released
+MAX_FREE_PER_SHAPE = 8
+
+
+class FrameBuffers:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (shape, dtype) -> released buffers
+        self.free = defaultdict(list)
+        self.allocations = 0
+        self.allocated_bytes = 0
+        self.reuses = 0
+
+    def allocate(self, shape, dtype):
+        buffer = np.empty(shape, dtype)
+        with self.lock:
+            self.allocations += 1
+            self.allocated_bytes += buffer.nbytes
+        return buffer
+
+    def scratch(self, name, shape, dtype=np.uint8):
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = dict()
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = buffers[name] = self.allocate(shape, dtype)
+        else:
+            with self.lock:
+                self.reuses += 1
+        return buffer
+
+    def acquire(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            if self.free[key]:
+                self.reuses += 1
+                return self.free[key].pop()
+        return self.allocate(shape, dtype)
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+        key = (buffer.shape, buffer.dtype)
+        with self.lock:
+            if len(self.free[key]) < MAX_FREE_PER_SHAPE:
+                self.free[key].append(buffer)
+
+    def get_stats(self):
+        with self.lock:
+            requests = self.allocations + self.reuses
+            return {
+                'allocations': self.allocations,
+                'allocated_mb': round(self.allocated_bytes / 1024 / 1024, 1),
+                'reuses': self.reuses,
+                'reuse_rate': round(self.reuses / requests, 3) if requests else 0.0,
+                'pooled': sum(len(buffers) for buffers in self.free.values()),
+            }
+
+    def format_stats(self):
+        stats = self.get_stats()
+        return (f"{stats['reuses']} reuses, {stats['allocations']} allocations ({stats['allocated_mb']}MB), "
+                f"reuse rate {stats['reuse_rate'] * 100:.1f}%")
+
+
+class FramePreprocessor:
+    """Mirror, scale portrait frames to max_height rows and crop to 9:16, into reused buffers.
+
+    With min_height, landscape frames with fewer rows are scaled up to min_height first, so a
+    client that lowers its capture size still yields the view size the models serve at.
+    transform() is the same preprocessing as an affine map (received frame -> view), with
+    cv2.resize's pixel-centre convention; without min_height the output matches
+    flip + resize_img + crop2_169.
+    """
+
+    def __init__(self, buffers=None, max_height=1024, min_height=None):
+        self.buffers = buffers if buffers is not None else FrameBuffers()
+        self.max_height = max_height
+        self.min_height = min_height
+        # frame (height, width) -> (transform, view width, view height, crop x0, crop y0, scaled (w, h) or None)
+        self.layouts = dict()
+
+    def scaled_height(self, h, w):
+        # rows the frame is resized to before the crop, or None to keep its size
+        if h > w:
+            return self.max_height
+        if self.min_height and h < self.min_height:
+            return self.min_height
+        return None
+
+    def layout(self, shape):
+        h, w = shape[:2]
+        layout = self.layouts.get((h, w))
+        if layout is not None:
+            return layout
+        # mirror
+        transform = np.array([[-1.0, 0.0, w - 1.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+        scaled = None
+        new_h = self.scaled_height(h, w)
+        if new_h is not None:
+            new_w = int(w * new_h / h)
+            sx, sy = new_w / float(w), new_h / float(h)
+            transform = np.array([[sx, 0.0, 0.5 * sx - 0.5], [0.0, sy, 0.5 * sy - 0.5], [0.0, 0.0, 1.0]]) @ transform
+            h, w = new_h, new_w
+            scaled = (new_w, new_h)
+        # centre crop to 9:16
+        x0 = y0 = 0
+        if 9 * h > 16 * w:
+            y0 = int((h - w * 16 / 9) / 2)
+        else:
+            x0 = int((w - h * 9 / 16) / 2)
+        transform = np.array([[1.0, 0.0, -x0], [0.0, 1.0, -y0], [0.0, 0.0, 1.0]]) @ transform
+        layout = self.layouts[shape[:2]] = (transform[:2], w - 2 * x0, h - 2 * y0, x0, y0, scaled)
+        return layout
+
+    def transform(self, shape):
+        """(2x3 received frame -> view, view width, view height) for a frame of this shape"""
+        return self.layout(shape)[:3]
+
+    def __call__(self, frame, out=None):
+        """The preprocessed frame, in out or else in this thread's reused 'view' buffer"""
+        _, view_w, view_h, x0, y0, scaled = self.layout(frame.shape)
+        if out is None:
+            out = self.buffers.scratch('view', (view_h, view_w, 3))
+        if scaled is not None:
+            frame = cv2.resize(frame, scaled, dst=self.buffers.scratch('resized', (scaled[1], scaled[0], 3)))
+        # the mirror of the crop: view column x is column (width - 1 - x0 - x) of the scaled frame
+        width = frame.shape[1]
+        return cv2.flip(frame[y0:y0 + view_h, width - x0 - view_w:width - x0], 1, dst=out)
+
+    def out_shape(self, shape):
+        _, view_w, view_h = self.transform(shape)
+        return view_h, view_w, 3
+
+
+def step_by_step(frame, trans2roi, inv_trans2roi, roi_size):
+    view = np.ascontiguousarray(crop2_169(resize_img(cv2.flip(frame, 1), max_height=1024)))
+    roi = cv2.warpAffine(view, trans2roi, (roi_size, roi_size), flags=cv2.INTER_LINEAR)
+    back = cv2.warpAffine(roi, inv_trans2roi, (view.shape[1], view.shape[0]), flags=cv2.INTER_LINEAR)
+    return view, back
+
+
+def preallocated(preprocessor, frame, trans2roi, inv_trans2roi, roi_size):
+    buffers = preprocessor.buffers
+    view = preprocessor(frame)
+    roi = cv2.warpAffine(view, trans2roi, (roi_size, roi_size), dst=buffers.scratch('roi', (roi_size, roi_size, 3)),
+                         flags=cv2.INTER_LINEAR)
+    back = cv2.warpAffine(roi, inv_trans2roi, (view.shape[1], view.shape[0]), dst=buffers.scratch('back', view.shape),
+                          flags=cv2.INTER_LINEAR)
+    return view, back
+
+
+def measure(fn, frames):
+    """(ms per frame, peak bytes of new memory per frame)"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    peak = 0
+    for _ in range(frames):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return elapsed * 1000.0 / frames, peak / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark step-by-step vs preallocated frame preprocessing')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--roi_size', type=int, default=512)
+    parser.add_argument('--min_height', type=int, default=0,
+                        help='scale smaller landscape frames up to this many rows (the server uses 720)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frame = cv2.GaussianBlur(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8), (0, 0), 3)
+    preprocessor = FramePreprocessor(min_height=args.min_height or None)
+    transform, view_w, view_h = preprocessor.transform(frame.shape)
+    # a person-sized ROI in the middle of the view
+    side = 0.8 * min(view_w, view_h)
+    scale = args.roi_size / side
+    trans2roi = np.array([[scale, 0.0, -scale * (view_w - side) / 2], [0.0, scale, -scale * (view_h - side) / 2]])
+    inv_trans2roi = cv2.invertAffineTransform(trans2roi)
+
+    view, _ = preallocated(preprocessor, frame, trans2roi, inv_trans2roi, args.roi_size)
+    # the affine map renders and ROIs are placed with must describe the view actually produced
+    mapped = cv2.warpAffine(frame, transform, (view_w, view_h), flags=cv2.INTER_LINEAR)
+    misalignment = np.abs(mapped.astype(np.int16) - view)[8:-8, 8:-8].mean()
+    # rtl_demo.py's preprocessing never scales frames up
+    scaled_up = args.height <= args.width and preprocessor.scaled_height(args.height, args.width) is not None
+    reference = None if scaled_up else step_by_step(frame, trans2roi, inv_trans2roi, args.roi_size)[0]
+
+    step_ms, step_bytes = measure(lambda: step_by_step(frame, trans2roi, inv_trans2roi, args.roi_size), args.frames)
+    pre_ms, pre_bytes = measure(lambda: preallocated(preprocessor, frame, trans2roi, inv_trans2roi, args.roi_size),
+                                args.frames)
+    print(f"{args.width}x{args.height} -> {view_w}x{view_h} view, {args.roi_size} ROI, {args.frames} frames")
+    print(f"step by step: {step_ms:.2f}ms/frame, {step_bytes / 1024 / 1024:.2f}MB new memory/frame")
+    print(f"preallocated: {pre_ms:.2f}ms/frame, {pre_bytes / 1024 / 1024:.2f}MB new memory/frame")
+    difference = 'n/a' if reference is None else f"{np.abs(reference.astype(np.int16) - view).mean():.3f}"
+    print(f"view difference: {difference} grey levels, transform vs view: {misalignment:.3f} | "
+          f"buffers: {preprocessor.buffers.format_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Local content-addressed cache for pretrained perception weights (DensePose, BEV)
+
+Files are stored once as <cache>/blobs/<sha256><ext> and named in <cache>/manifest.json,
+so the GPU server resolves every weight file locally at startup and never has to download.
+Seed the cache once per host (this is the only step that may use the network):
+    python -m util.weight_cache seed
+    python -m util.weight_cache add densepose_rcnn_R_50_FPN_s1x /path/to/model_final_162be9.pkl
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import urllib.request
+
+DEFAULT_CACHE_DIR = os.getenv('RTV_WEIGHT_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'rtv_weights'))
+MANIFEST_NAME = 'manifest.json'
+
+DENSEPOSE_WEIGHTS = 'densepose_rcnn_R_50_FPN_s1x'
+DENSEPOSE_WEIGHTS_URL = ('https://dl.fbaipublicfiles.com/densepose/densepose_rcnn_R_50_FPN_s1x/165712039/'
+                         'model_final_162be9.pkl')
+# cache name -> attribute of bev.main.default_settings holding the file path
+BEV_WEIGHT_SETTINGS = {
+    'bev_model': 'model_path',
+    'bev_smpl': 'smpl_path',
+    'bev_smil': 'smil_path',
+}
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def default_sources():
+    """Where each known weight file normally comes from (URL or the path the library uses)"""
+    sources = {DENSEPOSE_WEIGHTS: DENSEPOSE_WEIGHTS_URL}
+    try:
+        import bev
+        settings = bev.main.default_settings
+        for name, attr in BEV_WEIGHT_SETTINGS.items():
+            if getattr(settings, attr, None):
+                sources[name] = getattr(settings, attr)
+    except ImportError:
+        print("bev is not installed, skipping BEV weights")
+    return sources
+
+
+class WeightCache:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.blob_dir = os.path.join(self.cache_dir, 'blobs')
+        self.manifest_path = os.path.join(self.cache_dir, MANIFEST_NAME)
+        self.manifest = dict()
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def blob_path(self, entry):
+        return os.path.join(self.blob_dir, entry['sha256'] + entry['ext'])
+
+    def resolve(self, name):
+        """Local path of a cached weight file, or None if it is not (correctly) cached"""
+        entry = self.manifest.get(name)
+        if entry is None:
+            return None
+        path = self.blob_path(entry)
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            print(f"✗ Cached weights for {name} are missing or truncated: {path}")
+            return None
+        return path
+
+    def resolve_bev(self):
+        """BEV settings overrides (settings attribute -> local path) for every cached BEV file"""
+        paths = dict()
+        for name, attr in BEV_WEIGHT_SETTINGS.items():
+            path = self.resolve(name)
+            if path is not None:
+                paths[attr] = path
+        return paths
+
+    def add(self, name, source):
+        """Copy (or download) a weight file into the cache under its content hash"""
+        os.makedirs(self.blob_dir, exist_ok=True)
+        ext = os.path.splitext(source.split('?')[0])[1]
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                if source.startswith(('http://', 'https://')):
+                    print(f"Downloading {name} from {source}")
+                    with urllib.request.urlopen(source) as response:
+                        shutil.copyfileobj(response, out)
+                else:
+                    with open(os.path.expanduser(source), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+            entry = {'sha256': file_sha256(tmp_path), 'ext': ext, 'size': os.path.getsize(tmp_path),
+                     'source': source}
+            os.replace(tmp_path, self.blob_path(entry))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.manifest[name] = entry
+        self.save_manifest()
+        print(f"✓ Cached {name} ({entry['size'] / (1024 * 1024):.1f} MB, sha256 {entry['sha256'][:12]})")
+        return self.blob_path(entry)
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def verify(self):
+        """Recompute every blob's hash; returns the names that do not match"""
+        bad = []
+        for name, entry in self.manifest.items():
+            path = self.blob_path(entry)
+            if not os.path.isfile(path) or file_sha256(path) != entry['sha256']:
+                bad.append(name)
+        return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local perception weight cache')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('seed', help='cache DensePose and BEV weights from their default sources')
+    add = sub.add_parser('add', help='cache one file or URL under a name')
+    add.add_argument('name')
+    add.add_argument('source')
+    sub.add_parser('verify', help='check every cached file against its hash')
+    sub.add_parser('list', help='show cached files')
+    args = parser.parse_args()
+
+    cache = WeightCache(args.cache_dir)
+    if args.command == 'seed':
+        for name, source in default_sources().items():
+            if cache.resolve(name) is None:
+                cache.add(name, source)
+            else:
+                print(f"✓ {name} already cached")
+    elif args.command == 'add':
+        cache.add(args.name, args.source)
+    elif args.command == 'verify':
+        bad = cache.verify()
+        print("✓ All cached weights verified" if not bad else f"✗ Corrupt or missing: {bad}")
+    else:
+        for name, entry in sorted(cache.manifest.items()):
+            print(f"{name}: {cache.blob_path(entry)} ({entry['size'] / (1024 * 1024):.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()